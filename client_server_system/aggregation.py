@@ -0,0 +1,380 @@
+import asyncio
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from masking import mask_dtype
+
+
+def check_values(values, base: int):
+    """
+    Raise ValueError unless values is a numpy vector of ints in [0, base), which is what the accumulators
+    count on to know when their uint64 sums need reducing. Python ints (object arrays) are only accepted
+    for bases above 2^63, which are summed as python ints anyway.
+    """
+    if not isinstance(values, np.ndarray) or values.ndim != 1:
+        raise ValueError(f"Expected a vector of values but received {type(values).__name__}.")
+    if not len(values):
+        return
+    if values.dtype == object:
+        if mask_dtype(base) is not object:
+            raise ValueError(f"Expected values packed for base {base} but received python ints.")
+        if not all(isinstance(x, (int, np.integer)) for x in values):
+            raise ValueError("Expected integer values.")
+    elif values.dtype.kind not in "ui":
+        raise ValueError(f"Expected integer values but received {values.dtype}.")
+    elif values.dtype.kind == "u" and np.iinfo(values.dtype).max < base:
+        # too narrow to hold anything out of range (e.g. a base of 2^32 packed in uint32)
+        return
+    # unsigned values can't be negative, so one pass will do for them
+    if (values.dtype.kind != "u" and values.min() < 0) or values.max() >= base:
+        raise ValueError(f"Values must be in [0, {base}).")
+
+
+class ModularAccumulator:
+    """ Running element-wise sum of client vectors modulo base.
+    Initialized with:
+        - the number of values in each vector
+        - the cryptographic base that the sum is reduced by
+        - (optionally) the size of the coordinate ranges that vectors will be streamed in
+
+    Vectors are added with a single numpy call. Since every incoming value is in [0, base) (add_chunk checks), we only
+    need to reduce mod base every so often, right before the uint64 sum could overflow. We keep track
+    of this per block of block_size coordinates, so that when clients stream their vectors in chunks
+    only the slice a chunk touches ever has to be reduced. """
+
+    def __init__(self, num_values: int, base: int, block_size: int = None):
+        self.num_values = num_values
+        self.base = base
+        self.agg = np.zeros(num_values, dtype=mask_dtype(base))
+
+        if self.agg.dtype == object:
+            # python ints never overflow, so there's no need to reduce until the end
+            self.max_pending = None
+        else:
+            # after a reduction every entry is <= base-1, and each add contributes at most base-1 more
+            self.max_pending = (2 ** 64 - 1) // max(base - 1, 1) - 1
+
+        self.block_size = block_size if block_size else max(num_values, 1)
+        num_blocks = -(-num_values // self.block_size)
+        # number of adds into each block since it was last reduced
+        self.pending = np.zeros(max(num_blocks, 1), dtype=np.int64)
+        # number of full vectors added in total
+        self.count = 0
+
+    def add(self, values):
+        """
+        Add a vector of values in [0, base) to the running sum.
+        """
+        if len(values) != self.num_values:
+            raise ValueError(
+                f"Expected {self.num_values} values but received {len(values)}.")
+
+        self.add_chunk(0, values)
+        self.count += 1
+
+    def add_chunk(self, offset: int, values):
+        """
+        Add values in [0, base) to the coordinates [offset, offset + len(values)) of the running sum.
+        Raises ValueError for values that aren't (see check_values).
+        """
+        check_values(values, self.base)
+        end = offset + len(values)
+        if offset < 0 or end > self.num_values:
+            raise ValueError(
+                f"Chunk [{offset}, {end}) is out of range for {self.num_values} values.")
+        if offset == end:
+            return
+
+        first_block = offset // self.block_size
+        last_block = (end - 1) // self.block_size + 1
+
+        if self.max_pending is not None and self.pending[first_block:last_block].max() >= self.max_pending:
+            self.reduce(first_block * self.block_size,
+                        min(last_block * self.block_size, self.num_values))
+
+        np.add(self.agg[offset:end], values, out=self.agg[offset:end])
+        self.pending[first_block:last_block] += 1
+
+    async def add_async(self, values):
+        """
+        Same as add, for callers that also use a ShardedAccumulator (the work is done right away here).
+        """
+        self.add(values)
+
+    async def add_chunk_async(self, offset: int, values):
+        """
+        Same as add_chunk, for callers that also use a ShardedAccumulator.
+        """
+        self.add_chunk(offset, values)
+
+    async def result_async(self):
+        """
+        Same as result, for callers that also use a ShardedAccumulator.
+        """
+        return self.result()
+
+    def reduce(self, start: int = 0, end: int = None):
+        """
+        Reduce the coordinates [start, end) mod base. start and end should be on block boundaries.
+        """
+        end = self.num_values if end is None else end
+        if self.agg.dtype == object:
+            self.agg[start:end] = self.agg[start:end] % self.base
+        else:
+            np.remainder(self.agg[start:end], np.uint64(self.base),
+                         out=self.agg[start:end])
+        self.pending[start // self.block_size:-(-end // self.block_size)] = 0
+
+    def result(self):
+        """
+        The aggregate reduced mod base (as a mask array, see masking.mask_dtype).
+        """
+        self.reduce()
+        return self.agg
+
+    def close(self):
+        """
+        Release any resources held by the accumulator (nothing to do here, see ShardedAccumulator).
+        """
+        pass
+
+
+class ShardedAccumulator:
+    """ Same as ModularAccumulator, but the coordinate range is split across worker processes.
+    Initialized with:
+        - the number of values in each vector
+        - the cryptographic base that the sum is reduced by (at most 2^63, so the sum fits in uint64)
+        - the number of worker processes
+
+    The running sum lives in shared memory, and each worker owns a contiguous slice [start, end) of it.
+    An incoming vector (e.g. the packed payload of a message, see wire_format.py) is copied as is, still
+    packed, into a shared input buffer, which is the only copy made of it. Then every worker whose
+    slice it touches widens that part of it to uint64 as it adds it in place, and the pipes to the
+    workers carry only (offset, length, dtype) commands. Since the slices are contiguous, the result is just the shared sum, with no
+    gathering step. The workers are started on the first add and stopped by close().
+
+    add_async, add_chunk_async and result_async wait for the workers by watching their pipes from the
+    event loop, so the loop keeps serving other clients while the workers add. They take turns with
+    the input buffer, so only one vector is being added at a time. A session may close the accumulator
+    while they wait (when its round is aborted), so once it's closed they do nothing and result_async
+    returns None, while the blocking methods raise a ValueError. """
+
+    def __init__(self, num_values: int, base: int, num_workers: int):
+        if mask_dtype(base) is object:
+            raise ValueError("Sharded aggregation needs a base of at most 2^63.")
+
+        self.num_values = num_values
+        self.base = base
+        self.num_workers = max(min(num_workers, num_values), 1)
+        self.max_pending = (2 ** 64 - 1) // max(base - 1, 1) - 1
+        bounds = np.linspace(0, num_values, self.num_workers + 1).astype(int)
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+
+        # running sum and input buffer (big enough for values packed in anything up to 8 bytes), shared with the workers
+        self.agg_memory = shared_memory.SharedMemory(create=True, size=max(8 * num_values, 1))
+        self.input_memory = shared_memory.SharedMemory(create=True, size=max(8 * num_values, 1))
+        self.agg = np.ndarray(num_values, dtype=np.uint64, buffer=self.agg_memory.buf)
+        self.agg[:] = 0
+        # held while a vector is in the input buffer, by the async methods
+        self.lock = asyncio.Lock()
+
+        # (process, pipe) for each worker, once started
+        self.workers = None
+        # number of full vectors added in total
+        self.count = 0
+
+    def start_workers(self):
+        self.workers = []
+        for (start, end) in self.shards:
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_shard_worker, daemon=True,
+                args=(worker_conn, self.agg_memory.name, self.input_memory.name, self.num_values,
+                      int(start), int(end), self.base, self.max_pending))
+            process.start()
+            self.workers.append((process, conn))
+
+    def add(self, values):
+        """
+        Add a vector of values in [0, base) to the running sum.
+        """
+        if len(values) != self.num_values:
+            raise ValueError(
+                f"Expected {self.num_values} values but received {len(values)}.")
+
+        self.add_chunk(0, values)
+        self.count += 1
+
+    def add_chunk(self, offset: int, values):
+        """
+        Add values in [0, base) to the coordinates [offset, offset + len(values)) of the running sum.
+        Raises ValueError for values that aren't (see check_values). Blocks until the workers are done,
+        so don't mix this with the async methods.
+        """
+        for conn in self.dispatch("add", offset, values):
+            conn.recv()
+
+    async def add_async(self, values):
+        """
+        Same as add, but waits for the workers without blocking the event loop.
+        """
+        if len(values) != self.num_values:
+            raise ValueError(
+                f"Expected {self.num_values} values but received {len(values)}.")
+
+        await self.add_chunk_async(0, values)
+        self.count += 1
+
+    async def add_chunk_async(self, offset: int, values):
+        """
+        Same as add_chunk, but waits for the workers without blocking the event loop.
+        """
+        async with self.lock:
+            if self.closed():
+                return
+            await self.wait_for(self.dispatch("add", offset, values))
+
+    def result(self):
+        """
+        The aggregate reduced mod base (a copy, since the shared memory goes away on close).
+        """
+        for conn in self.dispatch("reduce"):
+            conn.recv()
+        return self.agg.copy()
+
+    async def result_async(self):
+        """
+        Same as result, but waits for the workers without blocking the event loop. Returns None if the
+        accumulator is closed before the sum is reduced.
+        """
+        async with self.lock:
+            if self.closed():
+                return None
+            await self.wait_for(self.dispatch("reduce"))
+            if self.closed():
+                return None
+            return self.agg.copy()
+
+    def dispatch(self, command, offset: int = None, values=None):
+        """
+        Send command ("add" or "reduce") to the workers it concerns and return their pipes, which each
+        get one reply once that worker is done. For an add, values are first copied into the input buffer.
+        """
+        if self.closed():
+            raise ValueError("The accumulator has been closed.")
+        if values is not None:
+            check_values(values, self.base)
+        if self.workers is None:
+            if values is None:
+                # nothing has been added yet, so there's nothing to do
+                return []
+            self.start_workers()
+
+        if values is None:
+            busy = [conn for (_, conn) in self.workers]
+            message = (command,)
+        else:
+            end = offset + len(values)
+            if offset < 0 or end > self.num_values:
+                raise ValueError(
+                    f"Chunk [{offset}, {end}) is out of range for {self.num_values} values.")
+            if offset == end:
+                return []
+            # the one copy, a plain memcpy of the packed values: the workers widen their own slices
+            np.ndarray(len(values), dtype=values.dtype, buffer=self.input_memory.buf)[:] = values
+            busy = [conn for ((start, stop), (_, conn)) in zip(self.shards, self.workers)
+                    if start < end and offset < stop]
+            message = (command, offset, len(values), values.dtype.str)
+
+        for conn in busy:
+            conn.send(message)
+        return busy
+
+    async def wait_for(self, conns):
+        """
+        Wait for one reply on each of conns, without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        remaining = set(conns)
+        done = loop.create_future()
+
+        def reply_ready(conn):
+            loop.remove_reader(conn.fileno())
+            try:
+                conn.recv()
+            except EOFError:
+                # the worker is gone (the accumulator was closed), so there's nothing left to wait for
+                pass
+            remaining.discard(conn)
+            if not remaining and not done.done():
+                done.set_result(None)
+
+        if not remaining:
+            return
+        for conn in conns:
+            loop.add_reader(conn.fileno(), reply_ready, conn)
+        try:
+            await done
+        finally:
+            # if we were cancelled, the workers may still be reading the input buffer, so wait for them
+            # before it can be reused
+            for conn in list(remaining):
+                loop.remove_reader(conn.fileno())
+                try:
+                    conn.recv()
+                except EOFError:
+                    pass
+
+    def closed(self):
+        return self.agg_memory is None
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory. Safe to call more than once.
+        """
+        if self.closed():
+            return
+        for (process, conn) in self.workers or []:
+            conn.send(("close",))
+            process.join()
+        self.workers = None
+
+        # drop our views before the memory they point into
+        self.agg = None
+        for memory in (self.agg_memory, self.input_memory):
+            memory.close()
+            memory.unlink()
+        self.agg_memory = self.input_memory = None
+
+
+def _shard_worker(conn, agg_name, input_name, num_values, start, end, base, max_pending):
+    # runs in a worker process of ShardedAccumulator, owning the coordinates [start, end)
+    agg_memory = shared_memory.SharedMemory(name=agg_name)
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    agg = np.ndarray(num_values, dtype=np.uint64, buffer=agg_memory.buf)[start:end]
+    pending = 0
+
+    while True:
+        command = conn.recv()
+        if command[0] == "add":
+            (_, offset, length, dtype) = command
+            lo, hi = max(offset, start), min(offset + length, end)
+            values = np.ndarray(length, dtype=dtype, buffer=input_memory.buf)[lo - offset:hi - offset]
+            if pending >= max_pending:
+                np.remainder(agg, np.uint64(base), out=agg)
+                pending = 0
+            # widen to uint64 on the way (check_values made sure the values fit)
+            np.add(agg[lo - start:hi - start], values, out=agg[lo - start:hi - start],
+                   dtype=np.uint64, casting="unsafe")
+            pending += 1
+            del values
+        elif command[0] == "reduce":
+            np.remainder(agg, np.uint64(base), out=agg)
+            pending = 0
+        else:
+            break
+        conn.send(None)
+
+    del agg
+    agg_memory.close()
+    input_memory.close()
@@ -0,0 +1,168 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from Crypto.Random import get_random_bytes
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement, import_x25519_public_key, import_x25519_private_key
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC
+from key_cache import default_key_cache
+
+
+"""
+
+Encryption of perturbation messages with one of several crypto suites, and an executor-backed engine
+that runs the per-peer encryptions/decryptions concurrently and off the asyncio event loop.
+
+The server picks the suite for a session and announces it in init_base_param:
+
+    rsa-oaep-eax              RSA-2048 OAEP wraps a fresh AES-128 key, which encrypts the data with EAX
+                              (hybrid_encrypt, the original scheme). Clients publish their RSA public key.
+    x25519-chacha20poly1305   X25519 key agreement between the sender's and the recipient's keys gives a
+                              pairwise key, which encrypts the data with ChaCha20-Poly1305. Clients publish
+                              a raw 32 byte X25519 public key, generated fresh for every round.
+    x25519-aes-gcm            The same, with AES-256-GCM.
+
+With the X25519 suites both ends of a pair derive the same key, so the receiver gets the key it
+needs for its peer's message for free when it encrypts its own message to that peer, as long as it
+keeps the key around in between. Callers pass in a dict to keep pairwise keys in, which should live
+no longer than the round (see SecureAggClient.pairwise_keys), and nothing is cached at module level.
+Since the keys are fresh every round, nothing encrypted in one round can be read with keys from another.
+
+suite_encrypt and suite_decrypt (like hybrid_encrypt and hybrid_decrypt) are module level functions
+so that they can also be shipped to a process pool. Worker processes can't share the caller's caches,
+so they keep their own RSA key cache and derive pairwise keys from scratch.
+
+"""
+
+CRYPTO_SUITES = ("rsa-oaep-eax", "x25519-chacha20poly1305", "x25519-aes-gcm")
+DEFAULT_CRYPTO_SUITE = "rsa-oaep-eax"
+
+
+def hybrid_encrypt(peer_pub_key_str, data: bytes, key_cache=None):
+    """
+    Encrypt data so that only the owner of peer_pub_key_str can read it.
+    Returns the (enc_session_key, nonce, tag, ciphertext) tuple that is relayed by the server.
+    """
+    key_cache = key_cache if key_cache is not None else default_key_cache
+
+    # Use an AES session key so that we can encrypt arbitrarily large data.
+    # If we only used RSA, we'd be limited to the size of the key.
+    session_key = get_random_bytes(16)
+
+    # Encrypt the session key with the peer's public RSA key.
+    # Note that we're sending public keys as strings generated by the export_key
+    # method, so we need to convert them back to RSA objects (the cache only does this once per key).
+    cipher_rsa = key_cache.get_cipher(peer_pub_key_str)
+    enc_session_key = cipher_rsa.encrypt(session_key)
+
+    # Encrypt the data with the AES session key
+    cipher_aes = AES.new(session_key, AES.MODE_EAX)
+    ciphertext, tag = cipher_aes.encrypt_and_digest(data)
+
+    return (enc_session_key, cipher_aes.nonce, tag, ciphertext)
+
+
+def hybrid_decrypt(priv_key_str, message, key_cache=None):
+    """
+    Decrypt a (enc_session_key, nonce, tag, ciphertext) tuple created with hybrid_encrypt.
+    """
+    key_cache = key_cache if key_cache is not None else default_key_cache
+
+    enc_session_key, nonce, tag, ciphertext = message
+    # First, decrypt the session key with the private RSA key
+    cipher_rsa = key_cache.get_cipher(priv_key_str)
+    session_key = cipher_rsa.decrypt(enc_session_key)
+    # Then, decrypt the data with the AES session key
+    cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
+    return cipher_aes.decrypt_and_verify(ciphertext, tag)
+
+
+def generate_x25519_keypair():
+    """
+    A fresh X25519 keypair for the X25519 suites, as (raw public key, private key seed) bytes.
+    """
+    key = ECC.generate(curve="Curve25519")
+    return key.public_key().export_key(format="raw"), key.seed
+
+
+def pairwise_key(priv_key_seed: bytes, peer_pub_key: bytes, cache: dict = None):
+    """
+    The 32 byte key shared by the owners of an X25519 private key and a peer's public key
+    (both ends get the same one). If given, cache is a dict the key is kept in, since each pair
+    needs it once to encrypt and once to decrypt.
+    """
+    if cache is not None and (priv_key_seed, peer_pub_key) in cache:
+        return cache[(priv_key_seed, peer_pub_key)]
+    key = key_agreement(
+        static_priv=import_x25519_private_key(priv_key_seed),
+        static_pub=import_x25519_public_key(peer_pub_key),
+        kdf=lambda shared_secret: HKDF(shared_secret, 32, b"secure-aggregation", SHA256, context=b"perturbations"))
+    if cache is not None:
+        cache[(priv_key_seed, peer_pub_key)] = key
+    return key
+
+
+def _aead(suite, key, nonce=None):
+    if suite == "x25519-chacha20poly1305":
+        return ChaCha20_Poly1305.new(key=key) if nonce is None else ChaCha20_Poly1305.new(key=key, nonce=nonce)
+    return AES.new(key, AES.MODE_GCM) if nonce is None else AES.new(key, AES.MODE_GCM, nonce=nonce)
+
+
+def suite_encrypt(suite, priv_key, peer_pub_key, data: bytes, key_cache=None, pairwise_keys=None):
+    """
+    Encrypt data with the given crypto suite so that only the owner of peer_pub_key can read it.
+    priv_key is our own private key, which only the X25519 suites need (they keep the pairwise key in
+    pairwise_keys if it's given, see pairwise_key). Returns the tuple that is relayed by the server.
+    Raises ValueError for unknown suites.
+    """
+    if suite == "rsa-oaep-eax":
+        return hybrid_encrypt(peer_pub_key, data, key_cache)
+    if suite not in CRYPTO_SUITES:
+        raise ValueError(f"Unknown crypto suite: {suite}")
+    cipher = _aead(suite, pairwise_key(priv_key, peer_pub_key, pairwise_keys))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return (cipher.nonce, tag, ciphertext)
+
+
+def suite_decrypt(suite, priv_key, peer_pub_key, message, key_cache=None, pairwise_keys=None):
+    """
+    Decrypt a message that the owner of peer_pub_key created for us with suite_encrypt.
+    peer_pub_key is only needed by the X25519 suites. Raises ValueError if the message doesn't check out.
+    """
+    if suite == "rsa-oaep-eax":
+        return hybrid_decrypt(priv_key, message, key_cache)
+    if suite not in CRYPTO_SUITES:
+        raise ValueError(f"Unknown crypto suite: {suite}")
+    nonce, tag, ciphertext = message
+    return _aead(suite, pairwise_key(priv_key, peer_pub_key, pairwise_keys), nonce).decrypt_and_verify(ciphertext, tag)
+
+
+class CryptoEngine:
+    """ Runs per-peer crypto work in an executor so that it happens concurrently and doesn't block the event loop.
+    Initialized with:
+        - the number of workers (None lets concurrent.futures pick)
+        - a boolean indicating whether to use a process pool instead of a thread pool
+
+    PyCryptodome does its RSA and AES work in C and releases the GIL while doing so, so a thread pool
+    already gets real parallelism. A process pool sidesteps the GIL for the python glue as well, at
+    the cost of pickling every message to and from the workers. """
+
+    def __init__(self, num_workers=None, use_processes=False):
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        if use_processes:
+            self.executor = ProcessPoolExecutor(num_workers)
+        else:
+            self.executor = ThreadPoolExecutor(
+                num_workers, thread_name_prefix="crypto")
+
+    async def map(self, fn, arg_tuples):
+        """
+        Run fn(*args) for every tuple in arg_tuples in the executor and return the results in order.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(self.executor, fn, *args) for args in arg_tuples])
+
+    def shutdown(self):
+        self.executor.shutdown()
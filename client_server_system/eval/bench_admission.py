@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import websockets
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from websocket_server_vector import SecureAggServer
+from websocket_client_vector import main as client_main
+
+
+"""
+
+Measures how many aggregation rounds per minute the server completes under a sustained client arrival
+rate, with the admission queue (clients wait for the next cohort) versus the original behaviour
+(clients are turned away and have to reconnect and retry).
+
+Clients arrive at random (exponentially distributed gaps) at the given rate and all join the same
+session. The server and every client run in this process on loopback. Like evaluate.py, the clients
+read their RSA keys from ./keys, so run this from the client_server_system directory.
+
+Example: python3 eval/bench_admission.py -n 5 -r 10 -t 30
+
+"""
+
+
+async def client_with_retries(values, port, retry_delay, stats):
+    while True:
+        result = await client_main(values, "localhost", port)
+        if result is not None:
+            stats["completed"] += 1
+            return
+        # turned away, so back off and try again
+        stats["rejections"] += 1
+        await asyncio.sleep(retry_delay * random.uniform(0.5, 1.5))
+
+
+async def run(queue_clients, args):
+    server = SecureAggServer(args.num_clients, args.base, args.num_values,
+                             mask_mode=args.mask_mode, queue_clients=queue_clients)
+    stats = {"completed": 0, "rejections": 0}
+    clients = []
+
+    async with websockets.serve(server.handler, "localhost", args.port, max_size=None):
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            values = [random.randint(0, 1000) for _ in range(args.num_values)]
+            clients.append(asyncio.create_task(
+                client_with_retries(values, args.port, args.retry_delay, stats)))
+            await asyncio.sleep(random.expovariate(args.rate))
+
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            client.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+    rounds = stats["completed"] // args.num_clients
+    return [("queue" if queue_clients else "reject-and-retry"), len(clients), stats["completed"],
+            stats["rejections"], rounds, 60 * rounds / elapsed]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, default=5,
+                        help="Number of clients per cohort")
+    parser.add_argument("-d", "--num_values", type=int, default=100,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-m", "--mask_mode", type=str, default="seed",
+                        help="Mask mode for the sessions")
+    parser.add_argument("-r", "--rate", type=float, default=10,
+                        help="Client arrivals per second")
+    parser.add_argument("-t", "--duration", type=float, default=30,
+                        help="Seconds to keep clients arriving for")
+    parser.add_argument("--retry_delay", type=float, default=1.0,
+                        help="Mean seconds a rejected client waits before reconnecting")
+    parser.add_argument("-p", "--port", type=int, default=8890)
+    args = parser.parse_args()
+
+    results = [asyncio.run(run(False, args)), asyncio.run(run(True, args))]
+
+    # the clients print a lot, so put the summary at the very end
+    print("\nmode, clients_arrived, clients_completed, rejections, rounds, rounds_per_minute")
+    for row in results:
+        print(", ".join(f"{x:.1f}" if isinstance(x, float) else str(x) for x in row))
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import time
+from Crypto.PublicKey import RSA
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from crypto_engine import CryptoEngine, hybrid_encrypt, hybrid_decrypt
+from masking import random_mask, encode_mask
+
+
+"""
+
+Compares the per-peer crypto of a single client run serially on the event loop (the original path)
+with the same work run on a CryptoEngine.
+
+For a cohort of n clients, one client has to:
+    - encrypt: hybrid-encrypt a perturbation for each of its n-1 peers
+    - decrypt: hybrid-decrypt the n-1 perturbations its peers created for it
+
+Every peer shares one RSA keypair here so that key generation doesn't dominate the benchmark.
+
+Example: python3 eval/bench_crypto_engine.py -n 50 100 150 -w 4 8
+
+"""
+
+
+async def time_phases(engine, pub_key, priv_key, plaintexts):
+    start = time.perf_counter()
+    if engine is None:
+        messages = [hybrid_encrypt(pub_key, data) for data in plaintexts]
+    else:
+        messages = await engine.map(hybrid_encrypt, [(pub_key, data) for data in plaintexts])
+    encrypt_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if engine is None:
+        decrypted = [hybrid_decrypt(priv_key, message) for message in messages]
+    else:
+        decrypted = await engine.map(hybrid_decrypt, [(priv_key, message) for message in messages])
+    decrypt_time = time.perf_counter() - start
+
+    assert decrypted == plaintexts, "decryption didn't round trip!"
+    return encrypt_time, decrypt_time
+
+
+async def run(args):
+    rsa_keys = RSA.generate(2048)
+    priv_key = rsa_keys.export_key()
+    pub_key = rsa_keys.publickey().export_key()
+
+    engines = [("serial", None)]
+    for num_workers in args.workers:
+        engines.append((f"threads-{num_workers}", CryptoEngine(num_workers)))
+        if args.processes:
+            engines.append(
+                (f"processes-{num_workers}", CryptoEngine(num_workers, use_processes=True)))
+
+    # warm up the key caches (and the worker processes) so that we only time the per-peer work
+    for (_, engine) in engines:
+        await time_phases(engine, pub_key, priv_key, [b"warmup"] * 8)
+
+    rows = []
+    for num_clients in args.num_clients:
+        plaintexts = [encode_mask(random_mask(args.num_values, args.base), args.base)
+                      for _ in range(num_clients - 1)]
+        for (name, engine) in engines:
+            encrypt_time, decrypt_time = await time_phases(engine, pub_key, priv_key, plaintexts)
+            row = [num_clients, args.num_values, name, encrypt_time, decrypt_time]
+            rows.append(row)
+            print(", ".join(f"{x:.4f}" if isinstance(x, float) else str(x) for x in row))
+
+    for (_, engine) in engines:
+        if engine is not None:
+            engine.shutdown()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, nargs="+", default=[50, 100, 150],
+                        help="Number of clients in the cohort")
+    parser.add_argument("-d", "--num_values", type=int, default=1000,
+                        help="Number of values in each perturbation vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[os.cpu_count()],
+                        help="Worker counts to try")
+    parser.add_argument("--processes", action="store_true",
+                        help="Also try process pools")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["num_clients", "num_values", "engine", "encrypt_s", "decrypt_s"]
+    print(", ".join(header))
+    rows = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import csv
+import os
+import random
+import sys
+import time
+import websockets
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from websocket_server_vector import SecureAggServer
+from websocket_client_vector import SecureAggClient, main as client_main
+from wire_format import encode, decode
+
+
+"""
+
+Measures how long a dropout-tolerant round (see session.py) takes when some of the clients drop out,
+and checks that the result is the sum of the survivors' values.
+
+Clients drop out either before sharing their secrets ("shares", they're left out of the round
+entirely) or after sharing them but before sending their value ("values", the server has to
+reconstruct their keys and cancel their masks). Without a recovery threshold any dropout after the key
+broadcast stalls the round forever, so the only baseline is a plain "dh" round with no dropouts.
+Rounds with fewer survivors than the threshold are expected to abort.
+
+The server and every client run in this process on loopback. Like evaluate.py, the clients read
+their RSA keys from ./keys, so run this from the client_server_system directory.
+
+Example: python3 eval/bench_dropout.py -n 20 -t 11 -k 0 2 5 9 -d 1000
+
+"""
+
+
+async def dropping_client(values, port, drop_at):
+    """
+    Follow the protocol like websocket_client_vector.main until the given phase, then disconnect.
+    """
+    async with websockets.connect(f"ws://localhost:{port}/", max_size=None) as websocket:
+        client = SecureAggClient(values, websocket)
+        async for m_raw in websocket:
+            m = decode(m_raw)
+            if m["type"] == "init_base_param":
+                client.set_base(m["base"])
+                client.set_mask_mode(m["mask_mode"])
+                client.set_recovery_threshold(m["recovery_threshold"])
+                await websocket.send(encode({"type": "public_key", "public_key": client.get_public_key(),
+                                             "share_key": client.share_pub_key}))
+            elif m["type"] == "public_key_broadcast":
+                if drop_at == "shares":
+                    return
+                share_messages = client.create_share_messages(m["public_keys"], m["share_keys"])
+                await websocket.send(encode({"type": "shares", "shares": share_messages}))
+            elif m["type"] == "shares":
+                return
+
+
+async def run(args, num_dropped, drop_at, recovery_threshold):
+    server = SecureAggServer(args.num_clients, args.base, args.num_values,
+                             mask_mode="dh", recovery_threshold=recovery_threshold)
+    values = [[random.randint(0, 1000) for _ in range(args.num_values)]
+              for _ in range(args.num_clients)]
+    survivors = values[num_dropped:]
+
+    async with websockets.serve(server.handler, "localhost", args.port, max_size=None):
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[dropping_client(v, args.port, drop_at) for v in values[:num_dropped]],
+            *[client_main(v, "localhost", args.port) for v in survivors])
+        elapsed = time.perf_counter() - start
+
+    expected = [sum(column) % args.base for column in zip(*survivors)]
+    results = results[num_dropped:]
+    if all(r is None for r in results):
+        outcome = "aborted"
+    else:
+        outcome = "ok" if all(r is not None and list(r) == expected for r in results) else "wrong"
+    return [args.num_clients, recovery_threshold, args.num_values, drop_at, num_dropped, elapsed, outcome]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, default=10,
+                        help="Number of clients in the cohort")
+    parser.add_argument("-t", "--threshold", type=int, default=6,
+                        help="Recovery threshold")
+    parser.add_argument("-k", "--num_dropped", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Numbers of clients to drop out")
+    parser.add_argument("-d", "--num_values", type=int, default=1000,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-p", "--port", type=int, default=8891)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(args, 0, None, None))]
+    for drop_at in ("shares", "values"):
+        for num_dropped in args.num_dropped:
+            rows.append(asyncio.run(run(args, num_dropped, drop_at, args.threshold)))
+
+    # the clients print a lot, so put the summary at the very end
+    header = ["num_clients", "threshold", "num_values", "drop_at", "num_dropped", "round_s", "outcome"]
+    print("\n" + ", ".join(header))
+    for row in rows:
+        print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
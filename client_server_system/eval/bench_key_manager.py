@@ -0,0 +1,77 @@
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from key_manager import KeyPool, KeyStore
+import websocket_client_vector
+from websocket_client_vector import SecureAggClient
+
+
+"""
+
+Measures how long it takes to create clients with fresh RSA keypairs (SecureAggClient(generate_keys=True)).
+
+    - "cold": the key pool is empty, so every client waits for RSA.generate (like before there was a pool)
+    - "warm": the pool was filled beforehand (KeyPool.fill), so clients just take a pre-generated keypair
+    - "store_first": the first KeyStore.get for each identity, which takes a keypair from a warm pool and writes it to disk
+    - "store_again": later KeyStore.get calls for the same identities, served from memory
+
+The pool holds as many keypairs as there are clients, so "warm" never runs dry.
+
+Example: python3 eval/bench_key_manager.py -n 20
+
+"""
+
+
+def create_clients(num_clients):
+    connection = SimpleNamespace(local_address=("client", 0))
+    start = time.perf_counter()
+    for _ in range(num_clients):
+        SecureAggClient([0], connection, generate_keys=True)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, default=20,
+                        help="Number of clients to create")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    rows = []
+    # swap in pools we control, one that never holds any keys for the cold run
+    websocket_client_vector.default_key_pool = pool = KeyPool(size=0)
+    rows.append(["cold", args.num_clients, create_clients(args.num_clients)])
+
+    websocket_client_vector.default_key_pool = pool = KeyPool(size=args.num_clients)
+    pool.fill()
+    rows.append(["warm", args.num_clients, create_clients(args.num_clients)])
+
+    pool.fill()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = KeyStore(tmp, pool)
+        for kind in ("store_first", "store_again"):
+            start = time.perf_counter()
+            for i in range(args.num_clients):
+                store.get(f"client-{i}")
+            rows.append([kind, args.num_clients, time.perf_counter() - start])
+    pool.close()
+
+    header = ["kind", "clients", "total_s", "per_client_ms"]
+    print(", ".join(header))
+    for row in rows:
+        row.append(1000 * row[2] / row[1])
+        print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,105 @@
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from masking import random_mask, zero_mask, to_mask_array, add_mod, sub_mod
+
+
+"""
+
+Compares the client-side mask arithmetic done with python lists (the original implementation of
+create_perturbation_messages / compute_values) with the numpy mask engine in masking.py.
+
+For a single client with n-1 peers and d values this times:
+    - generation: creating one random perturbation vector per peer
+    - combination: summing s_uv - s_vu over every peer and adding the client's own values
+
+Example: python3 eval/bench_masking.py -n 150 -d 10000
+
+"""
+
+
+def list_generate(num_peers, num_values, base):
+    return [[random.randint(0, base-1) for _ in range(num_values)] for _ in range(num_peers)]
+
+
+def list_combine(own, received, values, base):
+    to_send = [0] * len(values)
+    for (own_vals, received_vals) in zip(own, received):
+        for (idx, val) in enumerate(received_vals):
+            to_send[idx] += (own_vals[idx] - val) % base
+    return [(x + values[idx]) % base for (idx, x) in enumerate(to_send)]
+
+
+def numpy_generate(num_peers, num_values, base):
+    return [random_mask(num_values, base) for _ in range(num_peers)]
+
+
+def numpy_combine(own, received, values, base):
+    to_send = zero_mask(len(values), base)
+    for (own_vals, received_vals) in zip(own, received):
+        to_send = add_mod(to_send, sub_mod(own_vals, received_vals, base), base)
+    return add_mod(to_send, to_mask_array(values, base), base)
+
+
+def time_call(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def run(num_clients, num_values, base):
+    num_peers = num_clients - 1
+    values = [random.randint(0, 1000) for _ in range(num_values)]
+
+    list_own, list_gen_time = time_call(list_generate, num_peers, num_values, base)
+    list_received = list_generate(num_peers, num_values, base)
+    list_result, list_combine_time = time_call(
+        list_combine, list_own, list_received, values, base)
+
+    # feed the numpy engine the same perturbations so that we can check the results agree
+    np_own = [to_mask_array(vals, base) for vals in list_own]
+    np_received = [to_mask_array(vals, base) for vals in list_received]
+    _, np_gen_time = time_call(numpy_generate, num_peers, num_values, base)
+    np_result, np_combine_time = time_call(
+        numpy_combine, np_own, np_received, values, base)
+
+    assert np_result.tolist() == list_result, "numpy and list results disagree!"
+
+    return [num_clients, num_values, base, list_gen_time, np_gen_time, list_combine_time, np_combine_time,
+            (list_gen_time + list_combine_time) / (np_gen_time + np_combine_time)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, nargs="+", default=[10, 50, 150],
+                        help="Number of clients in the cohort (each client masks with n-1 peers)")
+    parser.add_argument("-d", "--num_values", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, nargs="+", default=[1000000],
+                        help="Cryptographic base")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["num_clients", "num_values", "base", "list_generate_s", "numpy_generate_s",
+              "list_combine_s", "numpy_combine_s", "speedup"]
+    rows = []
+    print(", ".join(header))
+    for base in args.base:
+        for num_clients in args.num_clients:
+            for num_values in args.num_values:
+                row = run(num_clients, num_values, base)
+                rows.append(row)
+                print(", ".join(f"{x:.4f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import csv
+import math
+import os
+import random
+import sys
+import time
+import websockets
+from types import SimpleNamespace
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from masking import neighbor_graph
+from websocket_server_vector import SecureAggServer
+from websocket_client_vector import SecureAggClient, main as client_main
+from wire_format import encode
+
+
+"""
+
+Compares masking with every other client (the complete graph) with masking along a sparse graph of
+k = 2*ceil(log2(n)) neighbors (see masking.neighbor_graph), for cohorts of n clients.
+
+"client" rows time the work one client does in a "vector" or "seed" mode round: creating and
+encrypting its perturbations, then decrypting the ones it receives and computing its masked vector.
+They also give the bytes that client's perturbations add to the server's relay traffic (which is
+the same again for the relay out). Every peer uses the same RSA key (the one in ./keys), so the
+timings are for the steady state of the key cache.
+
+"round" rows (with --e2e) run the full protocol on loopback with the server and all n clients in
+this process, which on one core takes as long as every client's work added together.
+
+Run this from the client_server_system directory, e.g.
+python3 eval/bench_masking_graph.py -n 100 200 500 1000 --e2e 100 200
+
+"""
+
+
+def client_work(num_clients, num_peers, num_values, base, mask_mode):
+    # a stand-in for the websocket, the client only reads its address from it
+    connection = SimpleNamespace(local_address=("client", 0))
+    client = SecureAggClient([random.randint(0, 1000) for _ in range(num_values)], connection)
+    client.set_base(base)
+    client.set_mask_mode(mask_mode)
+    public_keys = {f"peer:{i}": client.pub_key for i in range(num_peers)}
+
+    start = time.perf_counter()
+    client.create_perturbation_messages(public_keys)
+    encrypt_s = time.perf_counter() - start
+
+    relay_bytes = len(encode({"type": "perturbations", "perturbations": client.perturbation_messages}))
+
+    # everyone shares our key, so the messages we made for our peers are also valid messages to us
+    start = time.perf_counter()
+    client.compute_values(client.perturbation_messages)
+    decrypt_s = time.perf_counter() - start
+
+    return ["client", num_clients, num_peers, mask_mode, encrypt_s, decrypt_s, relay_bytes]
+
+
+async def round_time(num_clients, num_neighbors, num_values, base, mask_mode, port):
+    server = SecureAggServer(num_clients, base, num_values, mask_mode=mask_mode, num_neighbors=num_neighbors,
+                             max_sessions=1)
+    values = [[random.randint(0, 1000) for _ in range(num_values)] for _ in range(num_clients)]
+    async with websockets.serve(server.handler, "localhost", port, max_size=None):
+        start = time.perf_counter()
+        results = await asyncio.gather(*[client_main(v, "localhost", port) for v in values])
+        elapsed = time.perf_counter() - start
+
+    expected = [sum(column) % base for column in zip(*values)]
+    assert all(list(r) == expected for r in results)
+    num_peers = num_clients - 1 if num_neighbors is None else len(
+        next(iter(neighbor_graph(range(num_clients), num_neighbors, b"").values())))
+    return ["round", num_clients, num_peers, mask_mode, elapsed, None, None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, nargs="+", default=[100, 200, 500, 1000],
+                        help="Cohort sizes")
+    parser.add_argument("--e2e", type=int, nargs="*", default=[],
+                        help="Cohort sizes to also run full rounds for")
+    parser.add_argument("-d", "--num_values", type=int, default=100,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-m", "--mask_mode", type=str, default="seed",
+                        help="Mask mode ('vector' or 'seed')")
+    parser.add_argument("-p", "--port", type=int, default=8893)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["kind", "num_clients", "peers_per_client", "mask_mode", "time_s", "decrypt_s", "relay_bytes"]
+    rows = []
+    for num_clients in args.num_clients:
+        num_neighbors = 2 * math.ceil(math.log2(num_clients))
+        for num_peers in (num_clients - 1, num_neighbors):
+            rows.append(client_work(num_clients, num_peers, args.num_values, args.base, args.mask_mode))
+    for num_clients in args.e2e:
+        num_neighbors = 2 * math.ceil(math.log2(num_clients))
+        for graph in (None, num_neighbors):
+            rows.append(asyncio.run(round_time(num_clients, graph, args.num_values, args.base,
+                                               args.mask_mode, args.port)))
+
+    # the clients print a lot, so put the summary at the very end
+    print("\n" + ", ".join(header))
+    for row in rows:
+        print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import csv
+import os
+import random
+import sys
+import time
+import numpy as np
+import websockets
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from websocket_server_vector import SecureAggServer
+from websocket_client_vector import SecureAggClient, main as client_main
+from wire_format import encode, decode
+
+
+"""
+
+Measures how the server relays the perturbation bundles once every client's perturbations are in,
+with slow readers in the cohort: clients that follow the protocol but stop reading from their
+connection for a while right after sending their perturbations (like a client on a slow link).
+
+With --relay_parallelism 1 the server sends the bundles one after the other, so everyone whose
+bundle comes after a slow reader's waits for it. With more, the bundles go out concurrently and
+only the slow readers wait. For each setting we report how long the round took and percentiles of
+how long after the relay started each client's bundle was sent (session.relay_latencies).
+
+The bundles have to be bigger than what the kernel buffers on loopback for a slow reader to hold
+the server up at all, hence the long vectors in vector mode by default.
+
+The server and every client run in this process on loopback. Like evaluate.py, the clients read
+their RSA keys from ./keys, so run this from the client_server_system directory.
+
+Example: python3 eval/bench_relay.py -n 8 -s 1 -d 1000000 --delay 1
+
+"""
+
+
+async def slow_reader(values, port, delay):
+    """
+    Follow the protocol like websocket_client_vector.main, but stop reading for delay seconds after
+    sending our perturbations.
+    """
+    async with websockets.connect(f"ws://localhost:{port}/", max_size=None) as websocket:
+        client = SecureAggClient(values, websocket)
+        async for m_raw in websocket:
+            m = decode(m_raw)
+            if m["type"] == "init_base_param":
+                client.set_base(m["base"])
+                client.set_mask_mode(m["mask_mode"])
+                await websocket.send(encode({"type": "public_key", "public_key": client.get_public_key()}))
+            elif m["type"] == "public_key_broadcast":
+                client.create_perturbation_messages(m["public_keys"])
+                await client.send_perturbations()
+                # leave the bundle sitting in the kernel's buffers (and the server's)
+                websocket.transport.pause_reading()
+                asyncio.get_running_loop().call_later(delay, websocket.transport.resume_reading)
+            elif m["type"] == "perturbations":
+                try:
+                    await client.send_val(client.compute_values(m["perturbations"]))
+                except websockets.ConnectionClosed:
+                    # the server gave up on us while the bundle sat in our buffers
+                    return None
+            elif m["type"] == "aggregation_result":
+                return m["aggregation_result"]
+    return None
+
+
+async def run(args, relay_parallelism, send_timeout):
+    server = SecureAggServer(args.num_clients, args.base, args.num_values, relay_parallelism=relay_parallelism,
+                             send_timeout=send_timeout)
+    # hold on to the sessions so we can read their relay latencies after they finish
+    sessions = []
+    create_session = server.create_session
+    server.create_session = lambda *params: sessions.append(create_session(*params)) or sessions[-1]
+
+    values = [[random.randint(0, 1000) for _ in range(args.num_values)]
+              for _ in range(args.num_clients)]
+
+    async with websockets.serve(server.handler, "localhost", args.port, max_size=None):
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[slow_reader(v, args.port, args.delay) for v in values[:args.num_slow]],
+            *[client_main(v, "localhost", args.port) for v in values[args.num_slow:]])
+        elapsed = time.perf_counter() - start
+
+    expected = [sum(column) % args.base for column in zip(*values)]
+    if all(r is None for r in results):
+        outcome = "aborted"
+    else:
+        outcome = "ok" if all(r is not None and list(r) == expected for r in results) else "wrong"
+    latencies = list(sessions[0].relay_latencies.values()) or [float("nan")]
+    p50, p90 = np.percentile(latencies, [50, 90])
+    return [relay_parallelism, send_timeout, outcome, elapsed, len(sessions[0].relay_latencies), p50, p90,
+            max(latencies)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, default=8,
+                        help="Number of clients in the cohort")
+    parser.add_argument("-s", "--num_slow", type=int, default=1,
+                        help="Number of clients that stop reading for a while")
+    parser.add_argument("--delay", type=float, default=1,
+                        help="Seconds the slow readers stop reading for")
+    parser.add_argument("-d", "--num_values", type=int, default=1000000,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-P", "--relay_parallelism", type=int, nargs="+", default=[1, 64],
+                        help="Relay parallelism settings to compare")
+    parser.add_argument("-p", "--port", type=int, default=8893)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(args, parallelism, None)) for parallelism in args.relay_parallelism]
+    # a send timeout shorter than the slow readers' pause aborts the round instead of waiting for them
+    rows.append(asyncio.run(run(args, max(args.relay_parallelism), args.delay / 2)))
+
+    # the clients print a lot, so put the summary at the very end
+    header = ["relay_parallelism", "send_timeout", "outcome", "round_s", "bundles_sent",
+              "relay_p50_s", "relay_p90_s", "relay_max_s"]
+    print("\n" + ", ".join(header))
+    for row in rows:
+        print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,94 @@
+import argparse
+import csv
+import os
+import sys
+import time
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aggregation import ModularAccumulator, ShardedAccumulator
+from masking import random_mask
+from wire_format import encode, decode
+
+
+"""
+
+Times server-side aggregation of long vectors on the event loop (ModularAccumulator, reported as 0
+workers) against the coordinate-sharded accumulator (ShardedAccumulator) with a varying number of
+worker processes.
+
+Each vector is encoded and decoded with the wire format first, so the accumulators are fed exactly
+what the server gets from a client: a read-only view of the received message, packed as narrowly as
+the base allows. We report the mean time per add (after the workers have started), how much of it
+the event loop's process spends before it can get back to other clients (all of it without workers,
+just the copy into shared memory with them), and the time to get the result. Adding in parallel
+needs a core per worker, so look at the cpus column before comparing worker counts.
+
+Example: python3 eval/bench_sharded_aggregation.py -d 1000000 4000000 -w 0 1 2 4
+
+"""
+
+
+def run(num_values, base, num_workers, num_vectors):
+    vectors = [decode(encode({"type": "value", "value": random_mask(num_values, base)}, base))["value"]
+               for _ in range(2)]
+    if num_workers:
+        agg = ShardedAccumulator(num_values, base, num_workers)
+    else:
+        agg = ModularAccumulator(num_values, base)
+
+    try:
+        # the first add starts the workers, so leave it out of the timing
+        agg.add(vectors[0])
+        loop_s = 0.0
+        start = time.perf_counter()
+        for i in range(num_vectors):
+            if num_workers:
+                # same as agg.add, but timing the part that runs on the event loop
+                dispatch_start = time.perf_counter()
+                conns = agg.dispatch("add", 0, vectors[i % 2])
+                loop_s += time.perf_counter() - dispatch_start
+                for conn in conns:
+                    conn.recv()
+            else:
+                agg.add(vectors[i % 2])
+        add_s = (time.perf_counter() - start) / num_vectors
+        loop_s = loop_s / num_vectors if num_workers else add_s
+
+        start = time.perf_counter()
+        agg.result()
+        result_s = time.perf_counter() - start
+    finally:
+        agg.close()
+
+    return [num_values, base, num_workers, num_vectors, add_s, loop_s, result_s, os.cpu_count()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--num_values", type=int, nargs="+", default=[1000000, 4000000],
+                        help="Number of values in each vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-w", "--num_workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Worker counts to try (0 is the unsharded accumulator)")
+    parser.add_argument("-n", "--num_vectors", type=int, default=50,
+                        help="Number of vectors to add")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["num_values", "base", "num_workers", "num_vectors", "add_s", "loop_s", "result_s", "cpus"]
+    rows = []
+    print(", ".join(header))
+    for num_values in args.num_values:
+        for num_workers in args.num_workers:
+            row = run(num_values, args.base, num_workers, args.num_vectors)
+            rows.append(row)
+            print(", ".join(f"{x:.6f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
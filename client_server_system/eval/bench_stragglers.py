@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import csv
+import os
+import random
+import sys
+import time
+import websockets
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from websocket_server_vector import SecureAggServer
+from websocket_client_vector import SecureAggClient, main as client_main
+from wire_format import encode, decode
+
+
+"""
+
+Measures rounds with stragglers: clients that stay connected but stop responding at some phase.
+The server is given a deadline for every phase (see session.PHASES), so instead of waiting forever it
+cuts the stragglers when the deadline passes and finishes with the rest (or aborts, when the
+stragglers hold up the value phase of a round without dropout recovery).
+
+For each phase we report how long the round took, the outcome, and the number of clients the
+server cut in each phase.
+
+The server and every client run in this process on loopback. Like evaluate.py, the clients read
+their RSA keys from ./keys, so run this from the client_server_system directory.
+
+Example: python3 eval/bench_stragglers.py -n 10 -k 2 --deadline 2
+
+"""
+
+# (phase the stragglers stall in, mask mode, recovery threshold or None to use -t)
+SCENARIOS = [
+    ("keys", "seed", None),
+    ("perturbations", "seed", None),
+    ("values", "dh", None),
+    ("shares", "dh", "t"),
+    ("values", "dh", "t"),
+]
+
+
+async def straggler(values, port, stall_at):
+    """
+    Follow the protocol like websocket_client_vector.main, but go quiet (without disconnecting) at the given phase.
+    """
+    async with websockets.connect(f"ws://localhost:{port}/", max_size=None) as websocket:
+        client = SecureAggClient(values, websocket)
+        async for m_raw in websocket:
+            m = decode(m_raw)
+            if m["type"] == "init_base_param" and stall_at != "keys":
+                client.set_base(m["base"])
+                client.set_mask_mode(m["mask_mode"])
+                client.set_recovery_threshold(m["recovery_threshold"])
+                key_message = {"type": "public_key", "public_key": client.get_public_key()}
+                if client.recovery_threshold is not None:
+                    key_message["share_key"] = client.share_pub_key
+                await websocket.send(encode(key_message))
+            elif m["type"] == "public_key_broadcast" and client.recovery_threshold is not None and stall_at != "shares":
+                share_messages = client.create_share_messages(m["public_keys"], m["share_keys"])
+                await websocket.send(encode({"type": "shares", "shares": share_messages}))
+        # the server closed the connection on us after cutting us
+
+
+async def run(args, stall_at, mask_mode, recovery_threshold):
+    deadlines = {phase: args.deadline for phase in ("keys", "perturbations", "shares", "values", "unmask")}
+    server = SecureAggServer(args.num_clients, args.base, args.num_values, mask_mode=mask_mode,
+                             recovery_threshold=recovery_threshold, deadlines=deadlines)
+    # hold on to the sessions so we can read their cut counts after they finish
+    sessions = []
+    create_session = server.create_session
+    server.create_session = lambda *params: sessions.append(create_session(*params)) or sessions[-1]
+
+    values = [[random.randint(0, 1000) for _ in range(args.num_values)]
+              for _ in range(args.num_clients)]
+    on_time = values[args.num_stragglers:]
+
+    async with websockets.serve(server.handler, "localhost", args.port, max_size=None):
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[straggler(v, args.port, stall_at) for v in values[:args.num_stragglers]],
+            *[client_main(v, "localhost", args.port) for v in on_time])
+        elapsed = time.perf_counter() - start
+
+    expected = [sum(column) % args.base for column in zip(*on_time)]
+    results = results[args.num_stragglers:]
+    if all(r is None for r in results):
+        outcome = "aborted"
+    else:
+        outcome = "ok" if all(r is not None and list(r) == expected for r in results) else "wrong"
+    cut_counts = sessions[0].cut_counts
+    return [stall_at, mask_mode, recovery_threshold, elapsed, outcome] + list(cut_counts.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, default=10,
+                        help="Number of clients in the cohort")
+    parser.add_argument("-k", "--num_stragglers", type=int, default=2,
+                        help="Number of clients that stop responding")
+    parser.add_argument("-t", "--threshold", type=int, default=6,
+                        help="Recovery threshold for the scenarios that use dropout recovery")
+    parser.add_argument("--deadline", type=float, default=2,
+                        help="Seconds the server gives every phase")
+    parser.add_argument("-d", "--num_values", type=int, default=1000,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-p", "--port", type=int, default=8892)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    rows = []
+    for (stall_at, mask_mode, recovery_threshold) in SCENARIOS:
+        recovery_threshold = args.threshold if recovery_threshold == "t" else None
+        rows.append(asyncio.run(run(args, stall_at, mask_mode, recovery_threshold)))
+
+    # the clients print a lot, so put the summary at the very end
+    header = ["stall_at", "mask_mode", "threshold", "round_s", "outcome",
+              "cut_keys", "cut_perturbations", "cut_shares", "cut_values", "cut_unmask"]
+    print("\n" + ", ".join(header))
+    for row in rows:
+        print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import contextlib
+import csv
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+# setting path
+SYSTEM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(SYSTEM_DIR)
+from websocket_client_vector import main as client_main
+
+
+"""
+
+Measures how aggregation throughput scales with the number of leaves in an aggregation tree
+(see websocket_root_server.py).
+
+For each leaf count L we start a root aggregator and L leaf servers (websocket_server_vector.py -r ...)
+as separate processes on loopback, plus one client driver process per leaf. Each driver runs the given
+number of rounds against its leaf, with the given number of clients per round, so every global round
+aggregates L * clients values. With -l 1 we also run a plain server without a root for comparison.
+
+Throughput is the number of client vectors aggregated per second over the whole run. Note that
+the leaves only run in parallel if the machine has the cores for them (os.cpu_count() is reported).
+
+Like evaluate.py, the clients read their RSA keys from ./keys, so run this from the client_server_system
+directory, e.g. python3 eval/bench_tree.py -l 1 2 4 -c 10 -r 5 -d 10000
+
+"""
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("localhost", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def drive(port, num_clients, num_values, num_rounds):
+    # the clients print a lot
+    sys.stdout = open(os.devnull, "w")
+
+    async def run_rounds():
+        for _ in range(num_rounds):
+            values = [[random.randint(0, 1000) for _ in range(num_values)] for _ in range(num_clients)]
+            results = await asyncio.gather(*[client_main(v, "localhost", port) for v in values])
+            assert all(r is not None for r in results)
+
+    asyncio.run(run_rounds())
+
+
+def run(num_leaves, use_root, args):
+    processes = []
+    try:
+        leaf_command = [sys.executable, os.path.join(SYSTEM_DIR, "websocket_server_vector.py"),
+                        "-n", str(args.clients), "-v", str(args.num_values), "-b", str(args.base),
+                        "-m", args.mask_mode]
+        if use_root:
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(SYSTEM_DIR, "websocket_root_server.py"),
+                 "-l", str(num_leaves), "-p", str(args.port)], stdout=subprocess.DEVNULL))
+            wait_for_port(args.port)
+            leaf_command += ["-r", f"ws://localhost:{args.port}"]
+
+        leaf_ports = [args.port + 1 + i for i in range(num_leaves)]
+        for leaf_port in leaf_ports:
+            processes.append(subprocess.Popen(leaf_command + ["-p", str(leaf_port)], stdout=subprocess.DEVNULL))
+        for leaf_port in leaf_ports:
+            wait_for_port(leaf_port)
+
+        start = time.perf_counter()
+        drivers = [multiprocessing.Process(target=drive, args=(leaf_port, args.clients, args.num_values, args.rounds))
+                   for leaf_port in leaf_ports]
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        elapsed = time.perf_counter() - start
+
+        if any(driver.exitcode != 0 for driver in drivers):
+            raise RuntimeError("A client driver failed.")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                process.wait(5)
+
+    num_vectors = num_leaves * args.clients * args.rounds
+    return [num_leaves, use_root, args.clients, args.num_values, args.rounds, elapsed, num_vectors / elapsed,
+            os.cpu_count()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--num_leaves", type=int, nargs="+", default=[1, 2, 4],
+                        help="Leaf counts to run")
+    parser.add_argument("-c", "--clients", type=int, default=10,
+                        help="Clients per leaf per round")
+    parser.add_argument("-r", "--rounds", type=int, default=5,
+                        help="Rounds each leaf runs")
+    parser.add_argument("-d", "--num_values", type=int, default=10000,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-m", "--mask_mode", type=str, default="dh",
+                        help="Mask mode for the leaves")
+    parser.add_argument("-p", "--port", type=int, default=8900,
+                        help="Port of the root, the leaves get the ports after it")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["num_leaves", "root", "clients_per_leaf", "num_values", "rounds", "total_s", "vectors_per_s",
+              "cpus"]
+    rows = []
+    print(", ".join(header))
+    for num_leaves in args.num_leaves:
+        for use_root in ((False, True) if num_leaves == 1 else (True,)):
+            row = run(num_leaves, use_root, args)
+            rows.append(row)
+            print(", ".join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,97 @@
+import argparse
+import csv
+import os
+import pickle
+import sys
+import time
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from masking import random_mask
+from wire_format import encode, decode, pack_vector, unpack_vector
+
+
+"""
+
+Compares the binary wire format (wire_format.py) with the original pickle / comma-joined text encoding.
+
+Two payloads are measured for every (d, base) pair:
+    - value: the masked vector a client sends to the server (previously a pickled dict holding a list)
+    - perturbation: the plaintext of a perturbation vector before encryption (previously ",".join of the values)
+
+For each we report the encoded size in bytes and the time it takes to decode it back into integers.
+
+Example: python3 eval/bench_wire_format.py -d 1000 100000 -b 1000000 4294967296
+
+"""
+
+
+def time_call(f, *args, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def pickle_decode_value(raw):
+    return pickle.loads(raw)["value"]
+
+
+def text_decode_perturbation(raw):
+    return [int(val) for val in raw.decode("utf-8").split(",")]
+
+
+def run(num_values, base):
+    mask = random_mask(num_values, base)
+    as_list = mask.tolist()
+
+    pickle_value = pickle.dumps({"type": "value", "value": as_list})
+    binary_value = encode({"type": "value", "value": mask}, base)
+    text_perturbation = ",".join([str(val) for val in as_list]).encode("utf-8")
+    binary_perturbation = pack_vector(mask, base)
+
+    decoded, pickle_value_time = time_call(pickle_decode_value, pickle_value)
+    assert decoded == as_list
+    decoded, binary_value_time = time_call(lambda raw: decode(raw)["value"], binary_value)
+    assert decoded.tolist() == as_list
+    decoded, text_perturbation_time = time_call(text_decode_perturbation, text_perturbation)
+    assert decoded == as_list
+    decoded, binary_perturbation_time = time_call(unpack_vector, binary_perturbation)
+    assert decoded.tolist() == as_list
+
+    return [
+        [num_values, base, "value", len(pickle_value), len(binary_value),
+         pickle_value_time, binary_value_time],
+        [num_values, base, "perturbation", len(text_perturbation), len(binary_perturbation),
+         text_perturbation_time, binary_perturbation_time],
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--num_values", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="Number of values in each vector")
+    parser.add_argument("-b", "--base", type=int, nargs="+", default=[1000, 1000000, 2 ** 40],
+                        help="Cryptographic base")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional CSV file to write the results to")
+    args = parser.parse_args()
+
+    header = ["num_values", "base", "payload", "old_bytes", "binary_bytes",
+              "old_decode_s", "binary_decode_s"]
+    rows = []
+    print(", ".join(header))
+    for base in args.base:
+        for num_values in args.num_values:
+            for row in run(num_values, base):
+                rows.append(row)
+                print(", ".join(f"{x:.6f}" if isinstance(x, float) else str(x) for x in row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
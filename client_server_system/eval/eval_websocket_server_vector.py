@@ -2,10 +2,15 @@ import asyncio
 import websockets
 import argparse
 import sys
-import pickle
 import copy
 import csv
 import time
+import os
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aggregation import ModularAccumulator
+from wire_format import encode, decode
 
 NUM_VALUES = 5
 
@@ -35,7 +40,7 @@ class SecureAggServer:
         self.num_perturbation_received = 0
 
         # the final aggregation result
-        self.agg = [0] * NUM_VALUES
+        self.agg = ModularAccumulator(NUM_VALUES, base)
         # the number of value vectors received so far
         self.received_value_count = 0
 
@@ -45,7 +50,7 @@ class SecureAggServer:
     async def handler(self, websocket):
         # Turn away new connections if we already have enough clients
         if len(self.connections) >= self.client_threshold:
-            await websocket.send(pickle.dumps({"type": "message", "message": "Enough clients have already connected."}))
+            await websocket.send(encode({"type": "message", "message": "Enough clients have already connected."}))
             return
 
         if len(self.connections) == 0:
@@ -58,7 +63,7 @@ class SecureAggServer:
         self.connections[user_id] = websocket
 
         # Send the client the base for this session
-        await websocket.send(pickle.dumps({"type": "init_base_param", "base": self.base}))
+        await websocket.send(encode({"type": "init_base_param", "base": self.base}))
 
         # This big try block handles the client when it's connected, and the finally block
         # removes it from the connections dict when it disconnects.
@@ -66,8 +71,8 @@ class SecureAggServer:
             # For each message received over this socket
             async for m_raw in websocket:
                 try:
-                    # Try to unpickle the message
-                    m = pickle.loads(m_raw)
+                    # Try to decode the binary message (see wire_format.py)
+                    m = decode(m_raw)
                     message_type = m["type"]
                 except (TypeError, ValueError, KeyError) as e:
                     print(f"Unable to decode message: {m_raw}")
@@ -105,22 +110,21 @@ class SecureAggServer:
                         self.eval_metrics.append(time.time())
                         print("Received all perturbations.")
                         for peer_id, peer_generated_perturbations in self.perturbations.items():
-                            await self.message_user(peer_id, pickle.dumps({"type": "perturbations", "perturbations": peer_generated_perturbations}))
+                            await self.message_user(peer_id, encode({"type": "perturbations", "perturbations": peer_generated_perturbations}))
 
                 if message_type == "value":
-                    print(f"Received value {m['value']} from client {user_id}")
+                    print(f"Received value from client {user_id}")
 
-                    for (idx, x) in enumerate(m['value']):
-                        self.agg[idx] += x
+                    # fold the vector into the running sum in one go (the payload is decoded straight into an array)
+                    self.agg.add(m['value'])
 
                     self.received_value_count += 1
 
                     if self.received_value_count == self.client_threshold:
-                        for (idx, x) in enumerate(self.agg):
-                            self.agg[idx] = self.agg[idx] % self.base
+                        result = self.agg.result()
                         print(
-                            f"✨🔐 SECURE AGGREGATION 🔐✨ \n✨🔐    Result: {self.agg}     🔐✨\n")
-                        await self.broadcast({"type": "aggregation_result", "aggregation_result": self.agg})
+                            f"✨🔐 SECURE AGGREGATION 🔐✨ \n✨🔐    Result: {result}     🔐✨\n")
+                        await self.broadcast({"type": "aggregation_result", "aggregation_result": result})
                         # fourth timer: all clients have sent values, aggregate has been computed
                         self.eval_metrics.append(time.time())
 
@@ -134,8 +138,8 @@ class SecureAggServer:
             if user_id in self.connections:
                 del self.connections[user_id]
 
-    async def broadcast(self, unpickled_payload):
-        message = pickle.dumps(unpickled_payload)
+    async def broadcast(self, payload):
+        message = encode(payload, self.base)
         websockets.broadcast(
             self.connections.values(), message)
 
@@ -156,7 +160,7 @@ class SecureAggServer:
         self.pub_keys = dict()
         self.perturbations = dict()
         self.num_perturbation_received = 0
-        self.agg = [0]*NUM_VALUES
+        self.agg = ModularAccumulator(NUM_VALUES, self.base)
         self.received_value_count = 0
 
         with open('./results/limia_as_server.csv', 'a') as f:
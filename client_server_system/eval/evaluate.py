@@ -11,6 +11,8 @@ import os
 # setting path
 sys.path.append('../')
 sys.path.append('../../')
+# the client imports its helper modules (e.g. masking.py) from its own directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from client_server_system.websocket_client_vector import main
 
 
@@ -56,7 +58,7 @@ if __name__ == "__main__":
                         print(row)
                         print(matrix[0])
                         exit(1)
-            return_val = return_vals[0]
+            return_val = return_vals[0].tolist()
             expected_value = expected_sum_arr.tolist()
 
             writer = csv.writer(f, delimiter=',')
@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import numpy as np
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from key_manager import read_keypair
+from websocket_client_vector import main as client_main
+
+
+"""
+
+Load generator that simulates a large cohort (1000+ clients) against a running server.
+
+Unlike evaluate.py, which gives every client its own thread and event loop, the clients here are
+coroutines on one event loop, optionally spread over a few processes (-P). They all share one RSA
+keypair, read once from ./keys, and the process-wide key cache. The cohort's parameters go in the
+session path (see session.parse_session_path), so any server works, e.g.
+
+    python3 websocket_server_vector.py -p 8001 &
+    python3 eval/loadgen.py -n 1000 -d 100 -m dh -k 20 -r 3
+
+For every round we report the server's throughput (client vectors aggregated per second of wall
+time) and, for every step of the protocol as the clients see it, percentiles of how long the
+clients waited for it. A step is named after the message that ends it, e.g. "public_key_broadcast"
+is the time from receiving init_base_param until the server broadcast the keys, so it includes
+waiting for the rest of the cohort to connect. "total" is from starting to connect until the result.
+
+Results can be written as JSON (with the throughput of every round) or as a CSV of the percentiles,
+depending on the extension of -o.
+
+Like evaluate.py, run this from the client_server_system directory so ./keys is found. With
+1000+ clients you may need a server with a deadline for the key phase (-d keys=...) in case some
+connections fail.
+
+"""
+
+
+def run_clients(host, port, session, value_lists, expected, keys):
+    """
+    Run one client per value list on this process's event loop. Returns a list of (whether the client
+    got the expected result, its timings) in the same order.
+    """
+    async def run_client(values):
+        timings = dict()
+        try:
+            result = await client_main(values, host, port, session=session, keys=keys, timings=timings)
+        except OSError:
+            result = None
+        return result is not None and list(result) == expected, timings
+
+    async def run_all():
+        return await asyncio.gather(*[run_client(values) for values in value_lists])
+
+    # the clients print a lot
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        return asyncio.run(run_all())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def drive(host, port, session, value_lists, expected, keys, results):
+    results.put(run_clients(host, port, session, value_lists, expected, keys))
+
+
+def run_round(args, round_index, keys):
+    rng = random.Random(f"{args.seed}-{round_index}")
+    value_lists = [[rng.randint(0, 1000) for _ in range(args.num_values)] for _ in range(args.num_clients)]
+    expected = [sum(column) % args.base for column in zip(*value_lists)]
+    session = (f"{args.session}?num_clients={args.num_clients}&num_values={args.num_values}&base={args.base}"
+               f"&mask_mode={args.mask_mode}")
+    if args.num_neighbors:
+        session += f"&num_neighbors={args.num_neighbors}"
+    if args.crypto_suite:
+        session += f"&crypto_suite={args.crypto_suite}"
+
+    start = time.perf_counter()
+    if args.processes == 1:
+        outcomes = run_clients(args.host, args.port, session, value_lists, expected, keys)
+    else:
+        results = multiprocessing.Queue()
+        drivers = [multiprocessing.Process(target=drive, args=(args.host, args.port, session,
+                                                               value_lists[i::args.processes], expected, keys,
+                                                               results))
+                   for i in range(args.processes)]
+        for driver in drivers:
+            driver.start()
+        outcomes = [outcome for _ in drivers for outcome in results.get()]
+        for driver in drivers:
+            driver.join()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, outcomes
+
+
+def step_latencies(outcomes):
+    """
+    Maps each step of the protocol (named after the event that ends it) -> how long each client took for it.
+    """
+    steps = dict()
+    for (_, timings) in outcomes:
+        events = sorted(timings.items(), key=lambda event: event[1])
+        for ((_, previous), (name, t)) in zip(events, events[1:]):
+            steps.setdefault(name, []).append(t - previous)
+        if "aggregation_result" in timings:
+            steps.setdefault("total", []).append(timings["aggregation_result"] - timings["start"])
+    return steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-n", "--num_clients", type=int, default=1000,
+                        help="Number of clients in the cohort")
+    parser.add_argument("-d", "--num_values", type=int, default=100,
+                        help="Number of values in each client's vector")
+    parser.add_argument("-b", "--base", type=int, default=1000000,
+                        help="Cryptographic base")
+    parser.add_argument("-m", "--mask_mode", type=str, default="dh",
+                        help="Mask mode for the cohort")
+    parser.add_argument("-k", "--num_neighbors", type=int,
+                        help="Have each client mask with only this many neighbors (see masking.neighbor_graph)")
+    parser.add_argument("-e", "--crypto_suite", type=str,
+                        help="Crypto suite for the cohort's perturbations (see crypto_engine.CRYPTO_SUITES)")
+    parser.add_argument("-r", "--rounds", type=int, default=1,
+                        help="Number of rounds to run, one after the other")
+    parser.add_argument("-P", "--processes", type=int, default=1,
+                        help="Spread the clients over this many processes")
+    parser.add_argument("-s", "--session", type=str, default="loadgen",
+                        help="Session id to use on the server")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the clients' values")
+    parser.add_argument("-h", "--host", type=str, default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=8001)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional file to write the results to (JSON if it ends in .json, otherwise CSV)")
+    args = parser.parse_args()
+
+    # every client holds a socket open (as does the server, if it's on this machine)
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    keys = read_keypair("./keys/public.pem", "./keys/private.pem")
+
+    header = ["round", "step", "clients", "p50_s", "p90_s", "p99_s", "max_s"]
+    rows = []
+    rounds = []
+    for round_index in range(args.rounds):
+        elapsed, outcomes = run_round(args, round_index, keys)
+        num_ok = sum(ok for (ok, _) in outcomes)
+        rounds.append({"round": round_index, "clients": args.num_clients, "ok": num_ok, "round_s": elapsed,
+                       "vectors_per_s": num_ok / elapsed})
+        print(f"Round {round_index}: {num_ok}/{args.num_clients} clients got the right result in {elapsed:.3f} s "
+              f"({num_ok / elapsed:.1f} vectors/s)")
+
+        print(", ".join(header))
+        for (step, latencies) in step_latencies(outcomes).items():
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            row = {"round": round_index, "step": step, "clients": len(latencies),
+                   "p50_s": p50, "p90_s": p90, "p99_s": p99, "max_s": max(latencies)}
+            rows.append(row)
+            print(", ".join(f"{row[k]:.4f}" if isinstance(row[k], float) else str(row[k]) for k in header))
+
+    total_ok = sum(r["ok"] for r in rounds)
+    total_s = sum(r["round_s"] for r in rounds)
+    print(f"\nOverall: {total_ok} vectors in {total_s:.3f} s ({total_ok / total_s:.1f} vectors/s)")
+
+    if args.output and args.output.endswith(".json"):
+        with open(args.output, 'w') as f:
+            json.dump({"params": vars(args), "rounds": rounds, "steps": rows}, f, indent=1)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,330 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+import numpy as np
+import Crypto
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+# setting path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aggregation import ModularAccumulator
+from crypto_engine import (CRYPTO_SUITES, hybrid_encrypt, hybrid_decrypt, generate_x25519_keypair,
+                           suite_encrypt, suite_decrypt)
+from key_cache import KeyCache
+from masking import (SEED_BYTES, random_mask, expand_seed, zero_mask, add_mod, sub_mod, encode_mask,
+                     generate_dh_key, derive_pairwise_seed)
+from secret_sharing import split_secret, combine_shares
+from wire_format import encode, decode
+
+
+"""
+
+Microbenchmarks for the primitives the protocol is built from, each timed in isolation over a grid
+of cohort sizes (n), vector lengths (d) and bases.
+
+Every benchmark only runs for the grid parameters it depends on (RSA key generation runs once, mask
+generation once per (d, base), and so on). Parameters it doesn't use are left empty in the output.
+Each benchmark is timed with timeit: the number of calls per repetition is picked so that one
+repetition takes at least 0.2 s, and we report the median and minimum time per call over the
+repetitions.
+
+Results can be written as JSON (with the environment they were measured in) or CSV, depending on the
+extension of -o. Passing --baseline with an earlier JSON run compares every matching row against it,
+and flags rows whose median got slower by more than --tolerance. The script exits with status 1 if
+there are any such regressions, so it can gate CI.
+
+eval/results/microbench_baseline.json holds a full run with the default grid.
+
+Examples:
+    python3 eval/microbench.py -o eval/results/microbench_baseline.json
+    python3 eval/microbench.py --baseline eval/results/microbench_baseline.json -k mask_ accumulate
+
+"""
+
+
+# maps benchmark names -> (setup(n, d, base) returning the callable to time, grid parameters it depends on)
+BENCHMARKS = dict()
+
+
+def benchmark(name, params=()):
+    def register(setup):
+        BENCHMARKS[name] = (setup, params)
+        return setup
+    return register
+
+
+@benchmark("rsa_keygen")
+def setup_rsa_keygen(n, d, base):
+    return lambda: RSA.generate(2048)
+
+
+@benchmark("rsa_import")
+def setup_rsa_import(n, d, base):
+    pem = RSA.generate(2048).export_key()
+    return lambda: RSA.import_key(pem)
+
+
+@benchmark("oaep_encrypt")
+def setup_oaep_encrypt(n, d, base):
+    cipher = PKCS1_OAEP.new(RSA.generate(2048).publickey())
+    session_key = get_random_bytes(16)
+    return lambda: cipher.encrypt(session_key)
+
+
+@benchmark("oaep_decrypt")
+def setup_oaep_decrypt(n, d, base):
+    key = RSA.generate(2048)
+    enc_session_key = PKCS1_OAEP.new(key.publickey()).encrypt(get_random_bytes(16))
+    cipher = PKCS1_OAEP.new(key)
+    return lambda: cipher.decrypt(enc_session_key)
+
+
+@benchmark("aes_eax_encrypt", ("d", "base"))
+def setup_aes_eax_encrypt(n, d, base):
+    data = encode_mask(random_mask(d, base), base)
+    key = get_random_bytes(16)
+    return lambda: AES.new(key, AES.MODE_EAX).encrypt_and_digest(data)
+
+
+@benchmark("aes_eax_decrypt", ("d", "base"))
+def setup_aes_eax_decrypt(n, d, base):
+    key = get_random_bytes(16)
+    cipher = AES.new(key, AES.MODE_EAX)
+    ciphertext, tag = cipher.encrypt_and_digest(encode_mask(random_mask(d, base), base))
+    nonce = cipher.nonce
+    return lambda: AES.new(key, AES.MODE_EAX, nonce).decrypt_and_verify(ciphertext, tag)
+
+
+@benchmark("hybrid_encrypt_seed")
+def setup_hybrid_encrypt_seed(n, d, base):
+    # what a client does per peer in "seed" mode, with the peer's key already in the cache
+    pem = RSA.generate(2048).publickey().export_key()
+    key_cache = KeyCache()
+    seed = get_random_bytes(SEED_BYTES)
+    return lambda: hybrid_encrypt(pem, seed, key_cache)
+
+
+@benchmark("hybrid_decrypt_seed")
+def setup_hybrid_decrypt_seed(n, d, base):
+    key = RSA.generate(2048)
+    priv_pem = key.export_key()
+    key_cache = KeyCache()
+    message = hybrid_encrypt(key.publickey().export_key(), get_random_bytes(SEED_BYTES), key_cache)
+    return lambda: hybrid_decrypt(priv_pem, message, key_cache)
+
+
+def suite_keypair(suite):
+    if suite == "rsa-oaep-eax":
+        key = RSA.generate(2048)
+        return key.publickey().export_key(), key.export_key()
+    return generate_x25519_keypair()
+
+
+def register_suite_benchmarks(suite):
+    # what a client does per peer in "seed" mode with each crypto suite. With the X25519 suites each peer
+    # needs a fresh key agreement to encrypt, but decrypting reuses the pairwise key from encrypting
+    @benchmark(f"suite_encrypt_seed[{suite}]")
+    def setup_suite_encrypt(n, d, base):
+        pub_key, priv_key = suite_keypair(suite)
+        key_cache = KeyCache()
+        seed = get_random_bytes(SEED_BYTES)
+
+        # no pairwise key cache, so every call does its key agreement
+        return lambda: suite_encrypt(suite, priv_key, pub_key, seed, key_cache)
+
+    @benchmark(f"suite_decrypt_seed[{suite}]")
+    def setup_suite_decrypt(n, d, base):
+        pub_key, priv_key = suite_keypair(suite)
+        key_cache = KeyCache()
+        pairwise_keys = {}
+        message = suite_encrypt(suite, priv_key, pub_key, get_random_bytes(SEED_BYTES), key_cache, pairwise_keys)
+        return lambda: suite_decrypt(suite, priv_key, pub_key, message, key_cache, pairwise_keys)
+
+
+for suite in CRYPTO_SUITES:
+    register_suite_benchmarks(suite)
+
+
+@benchmark("dh_key_agreement")
+def setup_dh_key_agreement(n, d, base):
+    own_key, _ = generate_dh_key()
+    _, peer_pem = generate_dh_key()
+    return lambda: derive_pairwise_seed(own_key, peer_pem, "client:1", "client:2")
+
+
+@benchmark("mask_generate", ("d", "base"))
+def setup_mask_generate(n, d, base):
+    return lambda: random_mask(d, base)
+
+
+@benchmark("seed_expand", ("d", "base"))
+def setup_seed_expand(n, d, base):
+    seed = get_random_bytes(SEED_BYTES)
+    return lambda: expand_seed(seed, d, base)
+
+
+@benchmark("mask_combine", ("n", "d", "base"))
+def setup_mask_combine(n, d, base):
+    # a client folding its own and its n-1 peers' masks into its net mask, as SecureAggClient does
+    own = [random_mask(d, base) for _ in range(n - 1)]
+    received = [random_mask(d, base) for _ in range(n - 1)]
+
+    def combine():
+        net_mask = zero_mask(d, base)
+        for (own_vals, received_vals) in zip(own, received):
+            net_mask = add_mod(net_mask, own_vals, base)
+            net_mask = sub_mod(net_mask, received_vals, base)
+        return net_mask
+    return combine
+
+
+@benchmark("encode_value", ("d", "base"))
+def setup_encode_value(n, d, base):
+    mask = random_mask(d, base)
+    return lambda: encode({"type": "value", "value": mask}, base)
+
+
+@benchmark("decode_value", ("d", "base"))
+def setup_decode_value(n, d, base):
+    raw = encode({"type": "value", "value": random_mask(d, base)}, base)
+    return lambda: decode(raw)
+
+
+@benchmark("accumulate", ("n", "d", "base"))
+def setup_accumulate(n, d, base):
+    # the server adding up n decoded value messages and reducing the result
+    vectors = [decode(encode({"type": "value", "value": random_mask(d, base)}, base))["value"]
+               for _ in range(min(n, 8))]
+
+    def accumulate():
+        agg = ModularAccumulator(d, base)
+        for i in range(n):
+            agg.add(vectors[i % len(vectors)])
+        return agg.result()
+    return accumulate
+
+
+@benchmark("shamir_split", ("n",))
+def setup_shamir_split(n, d, base):
+    secret = get_random_bytes(32)
+    return lambda: split_secret(secret, n, n // 2 + 1)
+
+
+@benchmark("shamir_combine", ("n",))
+def setup_shamir_combine(n, d, base):
+    shares = split_secret(get_random_bytes(32), n, n // 2 + 1)[:n // 2 + 1]
+    return lambda: combine_shares(shares, 32)
+
+
+def grid_points(params, args):
+    """
+    Every combination of the grid values for the parameters a benchmark depends on (None for the rest).
+    """
+    points = [dict(n=None, d=None, base=None)]
+    for (param, values) in (("n", args.num_clients), ("d", args.num_values), ("base", args.base)):
+        if param in params:
+            points = [{**point, param: value} for point in points for value in values]
+    return points
+
+
+def run_benchmark(name, point, repeat):
+    setup, _ = BENCHMARKS[name]
+    timer = timeit.Timer(setup(point["n"], point["d"], point["base"]))
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"benchmark": name, **point, "number": number, "repeat": repeat,
+            "median_s": statistics.median(times), "min_s": min(times)}
+
+
+def row_key(row):
+    return (row["benchmark"], row["n"], row["d"], row["base"])
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "pycryptodome": Crypto.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(rows, baseline, tolerance):
+    """
+    Compare rows with a baseline run. Returns the rows that regressed by more than tolerance.
+    """
+    baseline_rows = {row_key(row): row for row in baseline["results"]}
+    regressions = []
+    print("\nbenchmark, n, d, base, baseline_median_s, median_s, ratio, status")
+    for row in rows:
+        old = baseline_rows.get(row_key(row))
+        if old is None:
+            status, ratio = "new", None
+        else:
+            ratio = row["median_s"] / old["median_s"]
+            if ratio > 1 + tolerance:
+                status = "REGRESSION"
+                regressions.append(row)
+            elif ratio < 1 - tolerance:
+                status = "improved"
+            else:
+                status = "ok"
+        print(", ".join(str(x) for x in [row["benchmark"], row["n"], row["d"], row["base"],
+                                         f"{old['median_s']:.9f}" if old else None, f"{row['median_s']:.9f}",
+                                         f"{ratio:.2f}" if ratio is not None else None, status]))
+
+    if baseline.get("environment") != environment():
+        print(f"\nNote: the baseline was measured in a different environment: {baseline.get('environment')}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_clients", type=int, nargs="+", default=[10, 100],
+                        help="Cohort sizes")
+    parser.add_argument("-d", "--num_values", type=int, nargs="+", default=[1000, 100000],
+                        help="Vector lengths")
+    parser.add_argument("-b", "--base", type=int, nargs="+", default=[1000000, 2 ** 40],
+                        help="Cryptographic bases")
+    parser.add_argument("-k", "--only", type=str, nargs="+",
+                        help="Only run benchmarks whose names start with one of these")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Repetitions per benchmark")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional file to write the results to (JSON if it ends in .json, otherwise CSV)")
+    parser.add_argument("--baseline", type=str,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower (as a fraction) a benchmark can get before it counts as a regression")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS
+             if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+
+    header = ["benchmark", "n", "d", "base", "number", "repeat", "median_s", "min_s"]
+    rows = []
+    print(", ".join(header))
+    for name in names:
+        for point in grid_points(BENCHMARKS[name][1], args):
+            row = run_benchmark(name, point, args.repeat)
+            rows.append(row)
+            print(", ".join(f"{row[k]:.9f}" if isinstance(row[k], float) else str(row[k]) for k in header))
+
+    if args.output and args.output.endswith(".json"):
+        with open(args.output, 'w') as f:
+            json.dump({"environment": environment(), "results": rows}, f, indent=1)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}.")
+            exit(1)
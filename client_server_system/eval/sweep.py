@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# setting path
+SYSTEM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(SYSTEM_DIR)
+from microbench import environment
+from crypto_engine import DEFAULT_CRYPTO_SUITE
+from session import PHASES
+from websocket_client_vector import main as client_main
+from bench_tree import wait_for_port
+
+
+"""
+
+Runs the whole protocol end to end on loopback over a grid of parameters and writes one row per round.
+
+The sweep is the cross product of client counts (n), vector lengths (d), bases, mask modes, crypto
+suites (see crypto_engine.CRYPTO_SUITES) and relay modes (see session.RELAY_MODES), each run for a
+number of repetitions. Suites and relay modes only matter in "vector" and "seed" modes. For every grid point we start a fresh websocket_server_vector.py
+process, then run one round per repetition against it. The n clients of a round are spread over
+separate driver processes (one per client by default, or --client_processes of them), which start
+at the same time and connect right away.
+
+Each row has:
+    - the outcome of the round and whether every client got the right sum
+    - the seconds the server spent in each phase of the round (see session.PHASES), and in the whole
+      round, from the server's round log (websocket_server_vector.py -l)
+    - the median and slowest client's wall time, from connecting to getting the result
+    - the CPU seconds the server used during the round and its peak RSS so far
+    - the CPU seconds used by all client processes together and the largest client process's peak RSS
+
+Client values are drawn from a seeded RNG, so a rerun with the same definition does the same work.
+Note that on a machine with fewer cores than processes the clients and the server share the CPUs,
+so phase timings include time spent waiting to be scheduled (os.cpu_count() is recorded with JSON
+output).
+
+The sweep can be given on the command line or as a JSON file with the same keys as the long options,
+e.g. {"num_clients": [5, 10], "num_values": [1000], "base": [1000000], "mask_mode": ["seed", "dh"],
+"repetitions": 3}. Options given on the command line override the file.
+
+Like evaluate.py, the clients read their RSA keys from ./keys, so run this from the client_server_system
+directory, e.g. python3 eval/sweep.py -n 5 10 -d 1000 10000 -m vector dh -r 3 -o eval/results/sweep.csv
+
+"""
+
+
+def drive(port, value_lists, expected, results):
+    """
+    Run one client per value list against the server at once, and report back how it went.
+    """
+    # the clients print a lot
+    sys.stdout = open(os.devnull, "w")
+
+    async def run_client(values):
+        start = time.perf_counter()
+        result = await client_main(values, "localhost", port)
+        return result, time.perf_counter() - start
+
+    async def run_clients():
+        return await asyncio.gather(*[run_client(values) for values in value_lists])
+
+    outcomes = asyncio.run(run_clients())
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({"correct": all(result is not None and list(result) == expected for (result, _) in outcomes),
+                 "latencies": [latency for (_, latency) in outcomes],
+                 "cpu_s": usage.ru_utime + usage.ru_stime, "max_rss_kb": usage.ru_maxrss})
+
+
+def read_round_log(path, num_rounds, timeout=10):
+    """
+    Wait until the server has logged num_rounds rounds and return the last one.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with open(path) as f:
+            lines = f.readlines()
+        if len(lines) >= num_rounds:
+            return json.loads(lines[num_rounds - 1])
+        time.sleep(0.05)
+    return None
+
+
+def run_round(port, num_clients, num_values, base, num_processes, rng, timeout):
+    value_lists = [[rng.randint(0, 1000) for _ in range(num_values)] for _ in range(num_clients)]
+    expected = [sum(column) % base for column in zip(*value_lists)]
+
+    results = multiprocessing.Queue()
+    drivers = [multiprocessing.Process(target=drive, args=(port, value_lists[i::num_processes], expected, results))
+               for i in range(num_processes)]
+    for driver in drivers:
+        driver.start()
+
+    reports = []
+    deadline = time.time() + timeout
+    with contextlib.suppress(Exception):
+        for _ in drivers:
+            reports.append(results.get(timeout=max(deadline - time.time(), 0)))
+    for driver in drivers:
+        driver.join(max(deadline - time.time(), 0))
+        if driver.is_alive():
+            driver.terminate()
+            driver.join()
+    return reports
+
+
+def run_point(point, args):
+    num_clients, num_values, base, mask_mode, crypto_suite, relay_mode = point
+    num_processes = min(args.client_processes or num_clients, num_clients)
+    rows = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        round_log = os.path.join(tmp, "rounds.jsonl")
+        open(round_log, "w").close()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(SYSTEM_DIR, "websocket_server_vector.py"),
+             "-n", str(num_clients), "-v", str(num_values), "-b", str(base), "-m", mask_mode,
+             "-e", crypto_suite, "--relay_mode", relay_mode, "-p", str(args.port), "-l", round_log,
+             # only our own clients connect over loopback, and in "vector" mode each one sends a
+             # perturbation vector per peer in one message, so don't cap the frame size
+             "--max_message_size", "0"],
+            stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            for repetition in range(args.repetitions):
+                rng = random.Random(f"{args.seed}-{num_clients}-{num_values}-{base}-{mask_mode}-{repetition}")
+                reports = run_round(args.port, num_clients, num_values, base, num_processes, rng, args.timeout)
+                summary = read_round_log(round_log, repetition + 1) if len(reports) == num_processes else None
+
+                row = {"num_clients": num_clients, "num_values": num_values, "base": base, "mask_mode": mask_mode,
+                       "crypto_suite": crypto_suite, "relay_mode": relay_mode, "client_processes": num_processes, "repetition": repetition}
+                if summary is None:
+                    # a client process died or the round hung, so the server is in an unknown state
+                    rows.append({**row, "outcome": "timeout"})
+                    break
+
+                latencies = [latency for report in reports for latency in report["latencies"]]
+                row.update({"outcome": summary["outcome"],
+                            "correct": all(report["correct"] for report in reports),
+                            "round_s": summary["round_s"]})
+                for phase in PHASES:
+                    row[f"{phase}_s"] = summary["phase_s"].get(phase)
+                row.update({"client_median_s": statistics.median(latencies), "client_max_s": max(latencies),
+                            "server_cpu_s": summary["cpu_s"], "server_peak_rss_kb": summary["max_rss_kb"],
+                            "clients_cpu_s": sum(report["cpu_s"] for report in reports),
+                            "client_peak_rss_kb": max(report["max_rss_kb"] for report in reports)})
+                rows.append(row)
+        finally:
+            server.terminate()
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                server.wait(5)
+    return rows
+
+
+HEADER = (["num_clients", "num_values", "base", "mask_mode", "crypto_suite", "relay_mode", "client_processes", "repetition", "outcome",
+           "correct", "round_s"] + [f"{phase}_s" for phase in PHASES] +
+          ["client_median_s", "client_max_s", "server_cpu_s", "server_peak_rss_kb", "clients_cpu_s",
+           "client_peak_rss_kb"])
+
+
+def format_row(row):
+    return ", ".join("" if row.get(k) is None else f"{row[k]:.4f}" if isinstance(row[k], float) else str(row[k])
+                     for k in HEADER)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str,
+                        help="JSON file with the sweep definition (keys as the long options below)")
+    parser.add_argument("-n", "--num_clients", type=int, nargs="+", default=[5, 10],
+                        help="Client counts")
+    parser.add_argument("-d", "--num_values", type=int, nargs="+", default=[1000],
+                        help="Vector lengths")
+    parser.add_argument("-b", "--base", type=int, nargs="+", default=[1000000],
+                        help="Cryptographic bases")
+    parser.add_argument("-m", "--mask_mode", type=str, nargs="+", default=["vector", "seed", "dh"],
+                        help="Mask modes")
+    parser.add_argument("-e", "--crypto_suite", type=str, nargs="+", default=[DEFAULT_CRYPTO_SUITE],
+                        help="Crypto suites")
+    parser.add_argument("-R", "--relay_mode", type=str, nargs="+", default=["batch"],
+                        help="Relay modes")
+    parser.add_argument("-r", "--repetitions", type=int, default=3,
+                        help="Rounds per grid point")
+    parser.add_argument("-P", "--client_processes", type=int,
+                        help="Spread each round's clients over at most this many processes (default: one per client)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the clients' values")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Seconds to wait for a round before giving up on the grid point")
+    parser.add_argument("-p", "--port", type=int, default=8894)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Optional file to write the results to (JSON if it ends in .json, otherwise CSV)")
+    config_args, _ = parser.parse_known_args()
+    if config_args.config:
+        with open(config_args.config) as f:
+            parser.set_defaults(**json.load(f))
+    args = parser.parse_args()
+
+    points = [(n, d, base, mask_mode, crypto_suite, relay_mode) for n in args.num_clients for d in args.num_values
+              for base in args.base for mask_mode in args.mask_mode for crypto_suite in args.crypto_suite
+              for relay_mode in args.relay_mode
+              if mask_mode in ("vector", "seed") or (crypto_suite, relay_mode) == (args.crypto_suite[0], args.relay_mode[0])]
+    rows = []
+    print(", ".join(HEADER))
+    for point in points:
+        for row in run_point(point, args):
+            rows.append(row)
+            print(format_row(row))
+
+    if args.output and args.output.endswith(".json"):
+        with open(args.output, 'w') as f:
+            json.dump({"environment": environment(), "sweep": {k: v for (k, v) in vars(args).items()
+                                                               if k not in ("config", "output")},
+                       "results": rows}, f, indent=1)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=HEADER)
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+
+
+class KeyCache:
+    """ LRU cache of imported RSA key objects and their PKCS1_OAEP ciphers.
+    Initialized with:
+        - the maximum number of keys to keep around before evicting the least recently used one
+
+    Keys are looked up by the SHA-256 fingerprint of their PEM encoding, so each PEM string only
+    has to be parsed once no matter how many rounds or peers it shows up in. The cache can be shared
+    by the worker threads of a CryptoEngine (see crypto_engine.py). """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        # maps PEM fingerprint -> (RSA key object, PKCS1_OAEP cipher), least recently used first
+        self.entries = OrderedDict()
+        # counters so that we can tell how effective the cache is
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(pem):
+        if isinstance(pem, str):
+            pem = pem.encode("utf-8")
+        return hashlib.sha256(pem).digest()
+
+    def _get(self, pem):
+        fingerprint = self.fingerprint(pem)
+
+        with self.lock:
+            if fingerprint in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(fingerprint)
+                return self.entries[fingerprint]
+            self.misses += 1
+
+        # import outside the lock so that other threads aren't held up by the PEM parsing
+        key = RSA.import_key(pem)
+        entry = (key, PKCS1_OAEP.new(key))
+
+        with self.lock:
+            self.entries[fingerprint] = entry
+            if len(self.entries) > self.max_size:
+                # evict the least recently used key
+                self.entries.popitem(last=False)
+        return entry
+
+    def get_key(self, pem):
+        """
+        The RSA key object for a PEM encoded key (public or private).
+        """
+        return self._get(pem)[0]
+
+    def get_cipher(self, pem):
+        """
+        A PKCS1_OAEP cipher for a PEM encoded key. Public keys can encrypt, private keys can also decrypt.
+        """
+        return self._get(pem)[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+# Cache shared by every client in this process
+default_key_cache = KeyCache()
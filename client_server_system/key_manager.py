@@ -0,0 +1,212 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from Crypto.PublicKey import RSA
+
+
+"""
+
+Where clients get their RSA keypairs from, without paying for RSA.generate (hundreds of milliseconds
+for a 2048-bit key) when a client is created:
+
+    - KeyPool keeps a few freshly generated keypairs ready, once filled (optionally refilled by a background thread)
+    - KeyStore persists one keypair per client identity on disk and rotates it according to a policy,
+      taking replacements from a KeyPool
+    - read_keypair reads a keypair from PEM files once per process (e.g. the shared ./keys pair)
+
+Keypairs are passed around as (public PEM, private PEM) bytes, like SecureAggClient stores them.
+
+"""
+
+
+def generate_keypair(key_bits=2048):
+    key = RSA.generate(key_bits)
+    return key.publickey().export_key(), key.export_key()
+
+
+@functools.lru_cache(maxsize=None)
+def read_keypair(public_path, private_path):
+    """
+    Read a (public PEM, private PEM) keypair from files, only touching the disk the first time.
+    """
+    with open(public_path, "rb") as f:
+        pub_key = f.read()
+    with open(private_path, "rb") as f:
+        priv_key = f.read()
+    return pub_key, priv_key
+
+
+class KeyPool:
+    """ Pool of pre-generated RSA keypairs.
+    Initialized with:
+        - the number of keypairs to keep ready
+        - the RSA key size in bits
+
+    Only helps a process that creates many clients: call fill() at startup so that later take()s
+    don't wait. If the pool is empty, take() generates a keypair on the spot, just like not having a
+    pool. A long-lived process can also call start_refill() to have a daemon thread top the pool up
+    whenever a keypair is taken, but PyCryptodome holds the GIL for much of key generation, so that
+    thread competes with everything else the process is doing. """
+
+    def __init__(self, size: int = 8, key_bits: int = 2048):
+        self.size = size
+        self.key_bits = key_bits
+        self.keys = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        # counters so that we can tell whether the pool keeps up
+        self.hits = 0
+        self.misses = 0
+
+    def take(self):
+        """
+        A fresh (public PEM, private PEM) keypair that nobody else gets.
+        """
+        with self.condition:
+            if self.keys:
+                self.hits += 1
+                keypair = self.keys.popleft()
+                self.condition.notify()
+                return keypair
+            self.misses += 1
+            self.condition.notify()
+        return generate_keypair(self.key_bits)
+
+    def fill(self):
+        """
+        Block until the pool is full.
+        """
+        while True:
+            with self.condition:
+                if len(self.keys) >= self.size:
+                    return
+            keypair = generate_keypair(self.key_bits)
+            with self.condition:
+                self.keys.append(keypair)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "ready": len(self.keys)}
+
+    def start_refill(self):
+        """
+        Start a daemon thread that keeps the pool full from now on (until close()).
+        """
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._refill, name="key-pool", daemon=True)
+                self.thread.start()
+
+    def _refill(self):
+        while True:
+            with self.condition:
+                while len(self.keys) >= self.size and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            keypair = generate_keypair(self.key_bits)
+            with self.condition:
+                self.keys.append(keypair)
+
+
+class KeyStore:
+    """ On-disk store of RSA keypairs, one per client identity.
+    Initialized with:
+        - the directory to keep the keys in (created if needed)
+        - (optionally) the KeyPool to take new keypairs from, by default the one shared by the process
+        - (optionally) the maximum age in seconds of a keypair before it's rotated
+        - (optionally) the maximum number of times a keypair is handed out before it's rotated
+
+    Each identity gets a subdirectory (named after the SHA-256 of the identity) with public.pem,
+    private.pem (readable by the owner only) and meta.json, which records when the keypair was created
+    and how often it has been used. Files are replaced atomically, so several processes can share a
+    store. Keypairs are also kept in memory, so the disk is only read the first time. """
+
+    def __init__(self, directory: str, pool: KeyPool = None, max_age: float = None, max_uses: int = None):
+        self.directory = directory
+        self.pool = pool if pool is not None else default_key_pool
+        self.max_age = max_age
+        self.max_uses = max_uses
+        # maps identity -> (keypair, metadata)
+        self.entries = dict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, identity: str):
+        """
+        The (public PEM, private PEM) keypair for an identity, creating it (or rotating it, if the
+        policy says it's due) first if necessary.
+        """
+        with self.lock:
+            entry = self.entries.get(identity) or self._load(identity)
+            if entry is None or self._due(entry[1]):
+                entry = self._replace(identity)
+            keypair, meta = entry
+            meta["uses"] += 1
+            self._write(identity, "meta.json", json.dumps(meta).encode())
+            self.entries[identity] = entry
+            return keypair
+
+    def rotate(self, identity: str):
+        """
+        Replace an identity's keypair with a fresh one from the pool, and return it.
+        """
+        with self.lock:
+            keypair, _ = self.entries[identity] = self._replace(identity)
+            return keypair
+
+    def path(self, identity: str):
+        return os.path.join(self.directory, hashlib.sha256(identity.encode("utf-8")).hexdigest())
+
+    def _due(self, meta):
+        if self.max_age is not None and time.time() - meta["created"] >= self.max_age:
+            return True
+        return self.max_uses is not None and meta["uses"] >= self.max_uses
+
+    def _load(self, identity):
+        path = self.path(identity)
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            with open(os.path.join(path, "public.pem"), "rb") as f:
+                pub_key = f.read()
+            with open(os.path.join(path, "private.pem"), "rb") as f:
+                priv_key = f.read()
+        except (OSError, ValueError):
+            return None
+        return (pub_key, priv_key), meta
+
+    def _replace(self, identity):
+        pub_key, priv_key = self.pool.take()
+        meta = {"identity": identity, "created": time.time(), "uses": 0}
+        self._write(identity, "private.pem", priv_key, mode=0o600)
+        self._write(identity, "public.pem", pub_key)
+        self._write(identity, "meta.json", json.dumps(meta).encode())
+        return (pub_key, priv_key), meta
+
+    def _write(self, identity, name, data, mode=0o644):
+        path = self.path(identity)
+        os.makedirs(path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path)
+        try:
+            os.fchmod(fd, mode)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(path, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+# Pool shared by every client in this process
+default_key_pool = KeyPool()
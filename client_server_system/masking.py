@@ -0,0 +1,203 @@
+import random
+import numpy as np
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC
+from Crypto.Random import get_random_bytes
+from wire_format import pack_vector, unpack_vector
+
+
+"""
+
+Helpers for generating the pairwise masks ("perturbations") used by the vector aggregation protocol.
+
+Instead of shipping a full d-length perturbation vector to every peer, a client can send a short
+random seed. Both ends of the pair then expand that seed locally into the same d-length mask using
+AES in CTR mode as a pseudorandom generator, so the server only ever relays O(1)-sized ciphertexts.
+
+All mask arithmetic is done on numpy arrays. As long as the base fits in 63 bits we use uint64
+arrays (the sum of two values < base can't overflow), otherwise we fall back to object arrays of
+python ints, which are slower but exact for any base.
+
+In "dh" mode clients go one step further and never send each other anything: every client publishes
+an X25519 public key, and each pair derives its shared seed with Diffie-Hellman key agreement.
+
+By default every client masks with every other one, which is O(n^2) work across the cohort. With a
+sparse masking graph (neighbor_graph) each client only masks with O(log n) neighbors instead.
+
+"""
+
+# Number of random bytes in a seed (which doubles as the AES-128 key for the PRG)
+SEED_BYTES = 16
+
+# The mask modes a server can ask clients to use:
+#  - "vector": send every peer an encrypted vector of num_values random ints (the original protocol)
+#  - "seed": send every peer an encrypted seed that both ends expand into the mask
+#  - "dh": derive every pairwise seed from an X25519 key agreement (no perturbation round at all)
+MASK_MODES = ("vector", "seed", "dh")
+
+# Number of bytes in an X25519 private key seed
+DH_SEED_BYTES = 32
+
+
+def _keystream(seed: bytes, num_bytes: int, offset: int = 0):
+    # AES-CTR over an all-zero plaintext is just the keystream. Seeds are only ever used once per
+    # session, so a fixed (empty) nonce is fine here.
+    cipher = AES.new(seed, AES.MODE_CTR, nonce=b"", initial_value=offset)
+    return cipher.encrypt(bytes(num_bytes))
+
+
+def mask_dtype(base: int):
+    """
+    The numpy dtype used for vectors of values mod base.
+    """
+    return np.uint64 if base <= 2 ** 63 else object
+
+
+def to_mask_array(values, base: int):
+    """
+    Convert a list of ints into a mask array with every entry reduced mod base.
+    """
+    if mask_dtype(base) is object:
+        return np.array([int(val) % base for val in values], dtype=object)
+    return np.array(values, dtype=np.uint64) % np.uint64(base)
+
+
+def zero_mask(num_values: int, base: int):
+    return np.zeros(num_values, dtype=mask_dtype(base))
+
+
+def random_mask(num_values: int, base: int):
+    """
+    Generate a fresh uniformly random mask by expanding a random seed.
+    """
+    return expand_seed(get_random_bytes(SEED_BYTES), num_values, base)
+
+
+def add_mod(a, b, base: int):
+    """
+    Element-wise (a + b) mod base for two mask arrays with entries in [0, base).
+    """
+    if a.dtype == object:
+        return (a + b) % base
+    return (a + b) % np.uint64(base)
+
+
+def sub_mod(a, b, base: int):
+    """
+    Element-wise (a - b) mod base for two mask arrays with entries in [0, base).
+    """
+    if a.dtype == object:
+        return (a - b) % base
+    # add base first so that the unsigned subtraction can't wrap around
+    return (a + (np.uint64(base) - b)) % np.uint64(base)
+
+
+def encode_mask(mask, base: int):
+    """
+    Serialize a mask array as packed little-endian ints (the format peers expect in "vector" mode).
+    """
+    return pack_vector(mask, base)
+
+
+def decode_mask(raw_data: bytes, base: int):
+    """
+    Parse a mask produced by encode_mask back into a mask array.
+    """
+    return unpack_vector(raw_data).astype(mask_dtype(base), copy=False)
+
+
+def expand_seed(seed: bytes, num_values: int, base: int):
+    """
+    Deterministically expand a seed into num_values pseudorandom ints in the range [0, base).
+    Returns a mask array (see mask_dtype).
+    """
+    if base <= 2 ** 64:
+        return _expand_seed_u64(seed, num_values, base).astype(mask_dtype(base), copy=False)
+
+    # For huge bases, read (bits + 64)-bit chunks so that the bias introduced by the final
+    # reduction mod base is negligible (< 2^-64).
+    width = (base.bit_length() + 64 + 7) // 8
+    stream = _keystream(seed, width * num_values)
+    return np.array([int.from_bytes(stream[i*width:(i+1)*width], "little") % base
+                     for i in range(num_values)], dtype=object)
+
+
+def _expand_seed_u64(seed: bytes, num_values: int, base: int):
+    # Rejection sampling: take 64-bit words from the keystream, keep only the low bits needed to
+    # represent base-1 and throw away anything >= base. This is unbiased, and since at least half
+    # of the candidates are accepted we rarely need more than a couple of passes.
+    bit_mask = np.uint64((1 << max((base - 1).bit_length(), 1)) - 1)
+    out = np.empty(num_values, dtype=np.uint64)
+    filled = 0
+    block = 0  # the AES block counter to resume the keystream from
+    while filled < num_values:
+        # draw a little more than we need so that one pass is almost always enough
+        wanted = num_values - filled
+        num_words = wanted + wanted // 2 + 16
+        num_words += num_words % 2  # keep to a whole number of 16 byte AES blocks
+        words = np.frombuffer(_keystream(seed, 8 * num_words, block), dtype="<u8") & bit_mask
+        block += num_words // 2
+
+        accepted = words[words < np.uint64(base)] if base < 2 ** 64 else words
+        take = min(len(accepted), wanted)
+        out[filled:filled + take] = accepted[:take]
+        filled += take
+    return out
+
+
+def generate_dh_key():
+    """
+    Generate a fresh X25519 keypair for "dh" mode. Returns (private key object, public key PEM bytes).
+    """
+    dh_key = ECC.generate(curve="Curve25519")
+    return dh_key, dh_key.public_key().export_key(format="PEM").encode("utf-8")
+
+
+def import_dh_key(seed: bytes):
+    """
+    Rebuild an X25519 private key from its 32 byte seed (dh_key.seed), e.g. after recovering it from shares.
+    """
+    return ECC.construct(curve="Curve25519", seed=seed)
+
+
+def derive_pairwise_seed(dh_key, peer_pub_key_pem, own_id: str, peer_id: str, purpose: bytes = b"mask"):
+    """
+    Derive the seed shared by this client and a peer from our X25519 private key and their public key.
+    Both ends of the pair get the same seed since the HKDF context doesn't depend on who is asking.
+    purpose separates keys derived from the same pair for different jobs (e.g. masks vs. encrypting shares).
+    """
+    context = purpose + b"|" + "|".join(sorted([own_id, peer_id])).encode("utf-8")
+    return key_agreement(
+        static_priv=dh_key,
+        static_pub=ECC.import_key(peer_pub_key_pem),
+        kdf=lambda shared_secret: HKDF(shared_secret, SEED_BYTES, b"secure-aggregation", SHA256, context=context))
+
+
+
+def neighbor_graph(client_ids, num_neighbors: int, seed: bytes):
+    """
+    The sparse masking graph of Bell et al. (2020), "Secure Single-Server Aggregation with (Poly)Logarithmic
+    Overhead": a Harary graph over a pseudorandom permutation of the clients derived from seed. After
+    shuffling, the clients sit in a ring and each one is connected to the num_neighbors // 2 clients on
+    either side of it (num_neighbors is rounded up to an even number).
+    Returns a dict mapping each client id to the set of ids of its neighbors.
+    """
+    order = sorted(client_ids)
+    random.Random(seed).shuffle(order)
+
+    n = len(order)
+    half = min(-(-num_neighbors // 2), (n - 1) // 2)
+    neighbors = {client_id: set() for client_id in order}
+    for (i, client_id) in enumerate(order):
+        for offset in range(1, half + 1):
+            neighbors[client_id].add(order[(i + offset) % n])
+            neighbors[client_id].add(order[(i - offset) % n])
+
+    if 2 * half < num_neighbors and 2 * half < n - 1:
+        # an even cohort where we'd need the client directly across the ring too (so everyone is connected)
+        for (i, client_id) in enumerate(order):
+            neighbors[client_id].add(order[(i + n // 2) % n])
+    return neighbors
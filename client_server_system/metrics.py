@@ -0,0 +1,181 @@
+import asyncio
+import bisect
+import json
+from collections import defaultdict
+
+
+"""
+
+Server instrumentation: counters and histograms for traffic, per-client latencies and round phases,
+rendered in the Prometheus text exposition format (version 0.0.4) and served over plain HTTP, plus
+an optional JSON-lines sink with one summary per round.
+
+Metric names all start with secagg_. Latency histograms are in seconds and size histograms in bytes.
+
+"""
+
+# bucket upper bounds, in seconds and bytes
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+class Histogram:
+    """ Class representing a cumulative histogram like Prometheus's.
+    Initialized with:
+        - the upper bounds of the buckets, in increasing order (an implicit +Inf bucket is added) """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the number of observations in each bucket (not cumulative), the last one being +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        """
+        The lines of the Prometheus text format for this histogram, with the given labels (a dict).
+        """
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+class ServerMetrics:
+    """ Class collecting the metrics of a SecureAggServer and its sessions.
+    Initialized with:
+        - (optionally) a file to append a JSON line to for every round that ends
+
+    Sessions report every message they receive and send as it happens, so the counters are live,
+    and report their phase timings once a round ends (see AggregationSession.round_summary). """
+
+    def __init__(self, sink: str = None):
+        self.sink = sink
+        # maps message types -> number of messages and bytes received from clients
+        self.messages_received = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        # maps message types -> number of messages and bytes sent (a broadcast counts once per recipient)
+        self.messages_sent = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        # maps message types -> histogram of message sizes
+        self.message_sizes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        # maps message types -> histogram of how long after the phase started clients sent them
+        self.client_latencies = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        # histogram of how long after the perturbation relay started each client's bundle was sent
+        self.relay_latencies = Histogram(LATENCY_BUCKETS)
+        # maps phases -> histogram of how long rounds spent in them
+        self.phase_durations = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.round_durations = Histogram(LATENCY_BUCKETS)
+        # maps outcomes ("ok" or "aborted") -> number of rounds
+        self.rounds = defaultdict(int)
+        # maps phases -> number of clients cut for missing that phase's deadline
+        self.cut_clients = defaultdict(int)
+
+    def message_received(self, message_type, size, latency):
+        self.messages_received[message_type] += 1
+        self.bytes_received[message_type] += size
+        self.message_sizes[message_type].observe(size)
+        if latency is not None:
+            self.client_latencies[message_type].observe(latency)
+
+    def message_sent(self, message_type, size, num_recipients=1):
+        self.messages_sent[message_type] += num_recipients
+        self.bytes_sent[message_type] += size * num_recipients
+        self.message_sizes[message_type].observe(size)
+
+    def relay_sent(self, latency):
+        self.relay_latencies.observe(latency)
+
+    def round_ended(self, summary):
+        """
+        Record a round summary (see AggregationSession.round_summary), and append it to the sink if there is one.
+        """
+        self.rounds[summary["outcome"]] += 1
+        self.round_durations.observe(summary["round_s"])
+        for (phase, seconds) in summary["phase_s"].items():
+            self.phase_durations[phase].observe(seconds)
+        for (phase, count) in summary["cut"].items():
+            self.cut_clients[phase] += count
+
+        if self.sink is not None:
+            with open(self.sink, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+
+    def render(self, gauges=None):
+        """
+        All metrics in the Prometheus text format, plus the given gauges (a dict mapping names -> (help, value)).
+        """
+        lines = []
+        for (name, (help_text, value)) in (gauges or dict()).items():
+            lines += [f"# HELP secagg_{name} {help_text}", f"# TYPE secagg_{name} gauge", f"secagg_{name} {value}"]
+
+        counters = [
+            ("messages_received_total", "Messages received from clients, by type.", "type", self.messages_received),
+            ("bytes_received_total", "Bytes received from clients, by message type.", "type", self.bytes_received),
+            ("messages_sent_total", "Messages sent to clients, by type.", "type", self.messages_sent),
+            ("bytes_sent_total", "Bytes sent to clients, by message type.", "type", self.bytes_sent),
+            ("rounds_total", "Rounds that ended, by outcome.", "outcome", self.rounds),
+            ("clients_cut_total", "Clients cut for missing a deadline, by phase.", "phase", self.cut_clients),
+        ]
+        for (name, help_text, label, values) in counters:
+            lines += [f"# HELP secagg_{name} {help_text}", f"# TYPE secagg_{name} counter"]
+            lines += [f"secagg_{name}{_labels({label: key})} {value}" for (key, value) in sorted(values.items())]
+
+        histograms = [
+            ("message_size_bytes", "Size of messages sent and received, by type.", "type", self.message_sizes),
+            ("client_latency_seconds", "Time from the start of a phase until a client's message for it arrived, by type.",
+             "type", self.client_latencies),
+            ("relay_send_seconds", "Time from the start of the perturbation relay until a client's bundle was sent.",
+             None, {None: self.relay_latencies}),
+            ("phase_duration_seconds", "Time rounds spent in each phase.", "phase", self.phase_durations),
+            ("round_duration_seconds", "Time from the first client connecting until the round ended.", None,
+             {None: self.round_durations}),
+        ]
+        for (name, help_text, label, values) in histograms:
+            lines += [f"# HELP secagg_{name} {help_text}", f"# TYPE secagg_{name} histogram"]
+            for (key, histogram) in sorted(values.items(), key=lambda item: str(item[0])):
+                lines += histogram.render(f"secagg_{name}", {label: key} if label else dict())
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(render, host, port):
+    """
+    Serve the text returned by render() at http://host:port/metrics until cancelled.
+    """
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found. Metrics are at /metrics\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in labels.items()) + "}"
@@ -0,0 +1,105 @@
+import mmap
+import os
+import tempfile
+from wire_format import encode_entry, dict_message_prefix
+
+
+"""
+
+Where the server keeps the perturbations it relays in "batch" relay mode (see session.RELAY_MODES)
+until everyone's are in. Holding them as Python objects takes memory that grows with n² * d, so
+RelayStore appends each one, already encoded for the wire, to a file per recipient instead. Once the
+relay starts, each recipient's file is turned into a complete message in place and sent straight
+from a memory map of it, and the file is dropped as soon as its message has been sent.
+
+The files are unlinked as soon as they're created, so nothing is left behind if the server dies.
+The kernel keeps recently written pages in its page cache, and writes them back to disk under memory
+pressure. Once a file is memory mapped, the pages of it that are touched while sending do count
+towards the server's resident set (as RssFile), so the session only maps each recipient's file right
+before sending it and releases it right after. Since those pages are backed by the file, the kernel
+can drop them without swapping.
+
+"""
+
+
+class RelayStore:
+    """ Class holding the messages being relayed to each client in files, until they're sent.
+    Initialized with:
+        - the ids of the clients messages can be addressed to
+        - the message type and field of the messages the clients get, which map senders -> messages
+          (e.g. {"type": "perturbations", "perturbations": {sender: perturbation}})
+        - (optionally) the directory to keep the files in (default: the system's temporary directory)
+
+    Each recipient's file starts with room for the message header (see wire_format.dict_message_prefix),
+    which is filled in by bundle() once we know how many entries the message has. """
+
+    def __init__(self, recipients, message_type: str, field: str, directory: str = None):
+        self.recipients = set(recipients)
+        self.message_type = message_type
+        self.field = field
+        self.directory = directory
+        self.prefix_size = len(dict_message_prefix(message_type, field, 0))
+        # maps recipients -> file descriptor of their file (only once something was added for them)
+        self.files = dict()
+        # maps recipients -> number of entries in their file
+        self.counts = dict()
+        # maps recipients -> (memory map, view of it) once their message has been handed out by bundle()
+        self.maps = dict()
+        # total number of bytes written to the files
+        self.bytes_stored = 0
+
+    def add(self, recipient, sender, message):
+        """
+        Append sender's message for recipient (anything wire_format can encode) to recipient's file.
+        """
+        if recipient not in self.recipients:
+            raise KeyError(recipient)
+        fd = self.files.get(recipient)
+        if fd is None:
+            fd = self.files[recipient] = self._create()
+            self.counts[recipient] = 0
+        entry = encode_entry(sender, message)
+        os.write(fd, entry)
+        self.counts[recipient] += 1
+        self.bytes_stored += len(entry)
+
+    def bundle(self, recipient):
+        """
+        The complete encoded message for recipient, as a read-only memoryview of its file. The view
+        is only valid until release(recipient).
+        """
+        fd = self.files.get(recipient)
+        if fd is None:
+            # nothing was sent to this client, so there's no file to map
+            return dict_message_prefix(self.message_type, self.field, 0)
+        os.pwrite(fd, dict_message_prefix(self.message_type, self.field, self.counts[recipient]), 0)
+        memory_map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        view = memoryview(memory_map)
+        self.maps[recipient] = (memory_map, view)
+        return view
+
+    def release(self, recipient):
+        """
+        Drop recipient's file (and its memory map), e.g. once its message has been sent.
+        """
+        memory_map, view = self.maps.pop(recipient, (None, None))
+        if memory_map is not None:
+            view.release()
+            try:
+                memory_map.close()
+            except BufferError:
+                # something still holds a slice of the map, which unmaps it once it lets go
+                pass
+        fd = self.files.pop(recipient, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        for recipient in list(self.files):
+            self.release(recipient)
+
+    def _create(self):
+        fd, path = tempfile.mkstemp(prefix="relay-", dir=self.directory)
+        os.unlink(path)
+        os.write(fd, bytes(self.prefix_size))
+        return fd
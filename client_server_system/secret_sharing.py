@@ -0,0 +1,96 @@
+import secrets
+import struct
+
+
+"""
+
+Shamir secret sharing, used by the dropout recovery mode of the vector protocol.
+
+A secret (a short byte string such as a seed) is turned into an int s and hidden as the constant term
+of a random polynomial f of degree threshold-1 over the prime field GF(PRIME). Share i is the point
+(i, f(i)). Any threshold shares determine f, and so s, by Lagrange interpolation at 0, while fewer
+shares reveal nothing about s.
+
+PRIME is the Mersenne prime 2^521 - 1, which comfortably fits the 32 byte X25519 seeds we share.
+
+"""
+
+PRIME = 2 ** 521 - 1
+
+# the largest secret we can share, in bytes
+MAX_SECRET_BYTES = (PRIME.bit_length() - 1) // 8
+
+_X = struct.Struct("<H")
+_Y_BYTES = (PRIME.bit_length() + 7) // 8
+
+# number of bytes in a packed share
+SHARE_BYTES = _X.size + _Y_BYTES
+
+
+def split_secret(secret: bytes, num_shares: int, threshold: int):
+    """
+    Split secret into num_shares shares, any threshold of which can reconstruct it.
+    Returns a list of (x, y) points with x = 1, ..., num_shares.
+    """
+    if not 1 <= threshold <= num_shares:
+        raise ValueError(
+            f"Threshold must be between 1 and the number of shares ({num_shares}), got {threshold}.")
+    if num_shares >= 2 ** 16:
+        raise ValueError("Too many shares.")
+    if len(secret) > MAX_SECRET_BYTES:
+        raise ValueError(f"Secret is longer than {MAX_SECRET_BYTES} bytes.")
+
+    coefficients = [int.from_bytes(secret, "little")] + \
+        [secrets.randbelow(PRIME) for _ in range(threshold - 1)]
+
+    shares = []
+    for x in range(1, num_shares + 1):
+        # Horner's rule
+        y = 0
+        for coefficient in reversed(coefficients):
+            y = (y * x + coefficient) % PRIME
+        shares.append((x, y))
+    return shares
+
+
+def combine_shares(shares, secret_len: int):
+    """
+    Reconstruct a secret of secret_len bytes from a list of (x, y) shares.
+    The shares must all come from the same split and there must be at least threshold of them,
+    otherwise the result is garbage (which we can only sometimes tell, in which case this raises ValueError).
+    """
+    xs = [x for (x, _) in shares]
+    if len(set(xs)) != len(xs):
+        raise ValueError("Shares must have distinct x coordinates.")
+
+    secret = 0
+    for (i, (x_i, y_i)) in enumerate(shares):
+        # Lagrange basis polynomial for x_i, evaluated at 0
+        numerator, denominator = 1, 1
+        for (j, x_j) in enumerate(xs):
+            if i != j:
+                numerator = numerator * x_j % PRIME
+                denominator = denominator * (x_j - x_i) % PRIME
+        secret = (secret + y_i * numerator * pow(denominator, -1, PRIME)) % PRIME
+
+    if secret.bit_length() > 8 * secret_len:
+        raise ValueError("Shares don't reconstruct a secret of the expected length.")
+    return secret.to_bytes(secret_len, "little")
+
+
+def pack_share(share) -> bytes:
+    """
+    Serialize an (x, y) share as SHARE_BYTES bytes.
+    """
+    x, y = share
+    return _X.pack(x) + y.to_bytes(_Y_BYTES, "little")
+
+
+def unpack_share(raw: bytes):
+    """
+    Inverse of pack_share.
+    """
+    if len(raw) != SHARE_BYTES:
+        raise ValueError("Data is not a packed share.")
+    (x,) = _X.unpack_from(raw, 0)
+    return x, int.from_bytes(raw[_X.size:], "little")
@@ -0,0 +1,962 @@
+import asyncio
+import copy
+import time
+import websockets
+from Crypto.Random import get_random_bytes
+from urllib.parse import urlsplit, parse_qs
+from masking import (MASK_MODES, mask_dtype, DH_SEED_BYTES, SEED_BYTES, expand_seed, derive_pairwise_seed, import_dh_key,
+                     zero_mask, add_mod, sub_mod, neighbor_graph)
+from secret_sharing import combine_shares
+from crypto_engine import CRYPTO_SUITES, DEFAULT_CRYPTO_SUITE
+from wire_format import encode, decode, message_type as wire_message_type, vector_width
+from aggregation import ModularAccumulator, ShardedAccumulator, check_values
+from relay_store import RelayStore
+
+
+# The phases of a round, in order. Which ones a round goes through depends on the mask mode:
+#  - "keys": waiting for every client's public key (and for the cohort to fill up)
+#  - "perturbations": waiting for every client's perturbations ("vector" and "seed" modes)
+#  - "shares": waiting for every client's secret shares (dropout recovery only)
+#  - "values": waiting for every client's masked vector
+#  - "unmask": waiting for the survivors' shares (dropout recovery only)
+#  - "forward": waiting for the root to combine our result with the other leaves' (aggregation trees only)
+PHASES = ("keys", "perturbations", "shares", "values", "unmask", "forward")
+
+# How the server relays perturbations ("vector" and "seed" modes):
+#  - "batch": once every client's perturbations are in, send each client a bundle of the ones for it
+#  - "eager": forward each perturbation to its recipient as soon as it arrives, so clients can decrypt
+#    while the stragglers are still sending theirs
+RELAY_MODES = ("batch", "eager")
+
+# by default, the most perturbation bundles a session sends at once
+DEFAULT_RELAY_PARALLELISM = 16
+
+# by default, the largest values a client may ask for these session parameters in its session path
+# (each client's vector costs the server about num_values * the bytes per value of base)
+DEFAULT_SESSION_LIMITS = {"num_clients": 10000, "num_values": 10 ** 7, "base": 2 ** 256, "chunk_size": 10 ** 7}
+
+# bytes allowed for a message's header and its other fields on top of its vector (see max_message_size)
+MESSAGE_OVERHEAD = 2 ** 16
+# the smallest frame size limit we'll set, which is websockets' default
+MIN_MESSAGE_SIZE = 2 ** 20
+
+
+class AggregationSession:
+    """ Class representing one cohort of clients running the secure aggregation protocol together.
+    Initialized with:
+        - the id of the session (clients pick it with the path they connect to)
+        - the number of clients that will participate in the protocol
+        - the cryptographic value that will be used in modular arithmetic for maksing values
+        - the number of values in each client's vector
+        - the mask mode clients should use ("vector", "seed" or "dh", see masking.py)
+        - (optionally) the number of coordinates per chunk if clients should stream their values in chunks
+        - (optionally) a Shamir threshold t to make the round tolerate clients dropping out ("dh" mode only)
+        - (optionally) a dict mapping phases (see PHASES) to how many seconds clients get to finish them
+        - (optionally) the fewest clients the round may continue with after stragglers are cut
+        - (optionally) the number of neighbors each client masks with, instead of every other client
+        - (optionally) the number of worker processes to split the coordinates of the aggregate across
+        - (optionally) the crypto suite clients encrypt perturbations with (see crypto_engine.CRYPTO_SUITES)
+        - (optionally) the most perturbation bundles to send at once
+        - (optionally) the seconds a client's connection gets to take its perturbations before the round is aborted
+        - (optionally) how to relay perturbations (see RELAY_MODES)
+        - (optionally) the directory to keep perturbations waiting to be relayed in (see relay_store.py)
+
+    With eager relaying, the server forwards every perturbation to its recipient as soon as the
+    sender's arrive, instead of waiting for everyone's. Each client decrypts them as they come in and
+    sends its value as soon as it has one from each of its peers, which can be before the last
+    client's perturbations are in. If the perturbation deadline cuts clients, the server tells the
+    rest which clients made it, so they stop waiting for the ones that didn't.
+
+    With a recovery threshold, the round follows Bonawitz et al. (2017). After the key broadcast each
+    client Shamir-shares its X25519 private key and a fresh self-mask seed with its peers (encrypted
+    under a second X25519 "share key", which is never shared, so recovering a dropped client's mask
+    key doesn't let the server read the shares that were sent to it), and adds
+    the self-mask to its masked vector on top of the pairwise masks. Once the values are in, the
+    server asks the survivors for shares of the dropped clients' private keys (so it can recompute
+    and cancel the pairwise masks those clients left behind) and of the survivors' self-mask seeds.
+    Since no client ever reveals both kinds of share for the same peer, a late value from a client
+    that was declared dropped stays hidden behind its self-mask. The round finishes as long as at
+    least t clients make it through every phase.
+
+    When a phase has a deadline, the server stops waiting once it passes and cuts the clients that
+    haven't done their part yet. Late clients can be cut from the key, perturbation and share phases
+    of any round, since nobody has masked anything with them yet. Cutting them from the value phase
+    needs dropout recovery to cancel their masks, so without it a missed value deadline aborts the
+    round. A round also aborts if cutting would leave fewer than min_survivors clients.
+
+    With num_neighbors set, the session draws a fresh seed when the round starts and derives a sparse
+    masking graph from it (see masking.neighbor_graph). Each client only gets its neighbors' public
+    keys, and so it only masks with them. Perturbations are only relayed along the graph's edges. The
+    seed is drawn by the server, so this assumes an honest-but-curious server, like the rest of the protocol.
+
+    A session runs a single round. Once the result has been broadcast it is marked finished, and the
+    server starts a fresh session for the next clients that connect with the same id. The server decides
+    who gets in (see SecureAggServer.admit); the session just runs the protocol with them. """
+
+    def __init__(self, session_id: str, client_threshold: int, base: int, num_values: int, mask_mode: str = "vector",
+                 chunk_size: int = None, recovery_threshold: int = None, deadlines: dict = None,
+                 min_survivors: int = None, num_neighbors: int = None, aggregation_workers: int = None,
+                 crypto_suite: str = DEFAULT_CRYPTO_SUITE, relay_parallelism: int = DEFAULT_RELAY_PARALLELISM,
+                 send_timeout: float = None, relay_mode: str = "batch", relay_dir: str = None):
+        self.id = session_id
+        # wait for this many clients to connect before running protocol
+        self.client_threshold = client_threshold
+        # maps client ids -> websocket connection
+        self.connections = dict()
+        # maps client ids -> client public keys
+        self.pub_keys = dict()
+        # maps client ids -> the X25519 public keys clients encrypt shares to each other with (dropout recovery only)
+        self.share_keys = dict()
+        # the number of values each client has
+        self.num_values = num_values
+        # the cryptographic value that will be used in modular arithmetic
+        self.base = base
+        # whether clients exchange full perturbation vectors or short seeds that they expand locally
+        self.mask_mode = mask_mode
+        # how clients encrypt the perturbations they send each other ("vector" and "seed" modes)
+        self.crypto_suite = crypto_suite
+        # if set, clients upload their masked vector as value_chunk messages of this many coordinates
+        self.chunk_size = chunk_size
+        # if set, clients secret-share their mask secrets so the round can finish with this many survivors
+        self.recovery_threshold = recovery_threshold
+        # maps phases -> seconds to wait for clients in that phase before cutting the stragglers
+        self.deadlines = deadlines if deadlines is not None else dict()
+        # the fewest clients a round can continue with after cutting stragglers (a lone client's
+        # "aggregate" would just be its own value)
+        self.min_survivors = min_survivors if min_survivors is not None else max(recovery_threshold or 0, 2)
+        # if set, each client masks with this many neighbors in a sparse graph rather than with everyone
+        self.num_neighbors = num_neighbors
+        # maps client ids -> the ids of the clients they mask with (None if everyone masks with everyone)
+        self.neighbors = None
+        # the perturbations waiting to be relayed to each client, kept in files (see relay_store.py)
+        self.relay_store = None
+        # the directory the relay store keeps its files in (None for the system's temporary directory)
+        self.relay_dir = relay_dir
+        # the clients whose perturbations are in
+        self.perturbation_senders = set()
+        # whether perturbations are relayed in one bundle per client or forwarded as they arrive (see RELAY_MODES)
+        self.relay_mode = relay_mode
+        # the most perturbation bundles the server sends at once when it relays them
+        self.relay_parallelism = relay_parallelism
+        # if set, seconds a client's socket gets to take its perturbation bundle before the round is aborted
+        self.send_timeout = send_timeout
+
+        # the final aggregation result
+        if aggregation_workers and mask_dtype(base) is not object:
+            # for long vectors, adding them up is the bottleneck, so spread the coordinates over processes
+            self.agg = ShardedAccumulator(
+                self.num_values, self.base, aggregation_workers)
+        else:
+            self.agg = ModularAccumulator(
+                self.num_values, self.base, self.chunk_size)
+        # the clients whose full masked vector is being added to the aggregate right now
+        self.adding_values = set()
+        # maps client ids -> number of coordinates received so far (when values are streamed in chunks)
+        self.received_coordinates = dict()
+        # number of clients the server has let into this session (see SecureAggServer.admit)
+        self.num_admitted = 0
+        # the clients whose full masked vector has been added to the aggregate
+        self.value_senders = set()
+
+        # dropout recovery state (only used with a recovery threshold)
+        # nested dict: share recipient -> {share creator -> encrypted bundle of shares}
+        self.share_bundles = dict()
+        # the clients that sent their shares in time, which are the ones every survivor masks its value with
+        self.share_holders = set()
+        # (dropped clients, surviving clients) once the survivors have been asked for shares
+        self.unmask_request = None
+        # maps client ids -> the shares they sent back for the unmask request
+        self.unmask_responses = dict()
+        # whether enough shares are in and the masks are being removed from the aggregate
+        self.unmasking = False
+
+        # the phase the round is in (see PHASES)
+        self.phase = "keys"
+        # task that cuts the stragglers once the current phase's deadline passes
+        self.deadline_task = None
+        # maps phases -> number of clients cut for missing that phase's deadline
+        self.cut_counts = {phase: 0 for phase in PHASES}
+        # the clients that have been cut
+        self.cut_clients = set()
+        # keeps references to connections that are closing in the background
+        self.background_tasks = set()
+
+        # which round of this session id this is, once the server has numbered it (see SecureAggServer.number_round)
+        self.round_index = None
+        # if set, an async function (session, result) -> (result, number of clients) that the aggregate
+        # goes through before it's broadcast, e.g. to add up the leaves of an aggregation tree
+        self.forward_result = None
+        # if set, a function (session) that's called once the round has finished or aborted
+        self.on_round_end = None
+
+        # maps phases -> time.perf_counter() when the round entered them, in order
+        self.phase_times = dict()
+        # time.perf_counter() when the round ended
+        self.end_time = None
+        # time.process_time() when the first client connected, to measure the CPU time the round took
+        self.cpu_start = None
+        # "ok" or "aborted" once the round has ended
+        self.outcome = None
+        # if set, the metrics.ServerMetrics that the session reports its traffic and latencies to as they happen
+        self.metrics = None
+        # maps message types -> bytes received from and sent to clients (a broadcast counts once per recipient)
+        self.bytes_received = dict()
+        self.bytes_sent = dict()
+        # maps client ids -> {message type -> seconds from the start of the phase until the client's first
+        # message of that type arrived}
+        self.client_latencies = dict()
+        # maps client ids -> seconds from the start of the perturbation relay until their bundle was sent
+        # (with eager relaying, from the start of the perturbations phase until the last one for them was)
+        self.relay_latencies = dict()
+
+        # set once every client's public key is in and the round has started
+        self.started = False
+        # set once the result has been broadcast
+        self.finished = False
+
+    def has_room(self):
+        return not self.finished and not self.started and self.num_admitted < self.client_threshold
+
+    def admit(self):
+        """
+        Reserve a spot in this session for a client that's about to join.
+        """
+        self.num_admitted += 1
+
+    async def handler(self, websocket):
+        # Store new connection
+        user_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
+        print(f"[{self.id}] Received connection from client: {user_id}")
+        if self.started or self.finished:
+            # the round started without this client while it was on its way in
+            await self.send(websocket, encode({"type": "message", "message": "Round has already started."}))
+            return
+        if not self.phase_times:
+            # the key phase's clock starts with the first client
+            self.phase_times["keys"] = time.perf_counter()
+            self.cpu_start = time.process_time()
+            self.set_deadline()
+
+        # This big try block handles the client when it's connected, and the finally block
+        # removes it from the connections dict (and gives up its spot) when it disconnects,
+        # even if that's before it got the session parameters.
+        try:
+            self.connections[user_id] = websocket
+
+            # Send the client the parameters for this session
+            await self.send(websocket, encode({"type": "init_base_param", "base": self.base,
+                                               "mask_mode": self.mask_mode, "chunk_size": self.chunk_size,
+                                               "recovery_threshold": self.recovery_threshold,
+                                               "crypto_suite": self.crypto_suite, "relay_mode": self.relay_mode}))
+
+            # For each message received over this socket
+            async for m_raw in websocket:
+                try:
+                    # Try to decode the binary message (see wire_format.py)
+                    m = decode(m_raw)
+                    message_type = m["type"]
+                except (TypeError, ValueError, KeyError) as e:
+                    print(f"Unable to decode message: {m_raw}")
+                    print(f"Error: {e}")
+                    continue
+
+                if user_id in self.cut_clients:
+                    break
+                self.record_received(user_id, message_type, len(m_raw))
+
+                if message_type == "public_key":
+                    if self.started:
+                        continue
+                    print(f"[{self.id}] Received public key from client {user_id}")
+
+                    # store the pub key
+                    self.pub_keys[user_id] = m["public_key"]
+                    if self.recovery_threshold is not None:
+                        self.share_keys[user_id] = m["share_key"]
+
+                    # if this was the last one we needed, start the round
+                    if len(self.pub_keys) == self.client_threshold:
+                        await self.start_round()
+
+                if message_type == "perturbations":
+                    if (self.phase != "perturbations" or user_id not in self.pub_keys
+                            or user_id in self.perturbation_senders):
+                        continue
+                    print(f"[{self.id}] Received perturbations from client {user_id}")
+                    self.perturbation_senders.add(user_id)
+
+                    if self.relay_mode == "eager":
+                        await self.forward_perturbations(user_id, m["perturbations"])
+                    else:
+                        # only the senders' perturbations ever go in, so only pairs that both made it get relayed
+                        for peer, perturbation_message in m["perturbations"].items():
+                            if peer in self.relay_store.recipients and peer != user_id:
+                                self.relay_store.add(peer, user_id, perturbation_message)
+                    # don't hold on to the message while we wait for this client's next one, the
+                    # perturbations are in the store (or on their way) now
+                    del m, m_raw
+
+                    # if we've received all perturbations, send each client their appropriate set of perturbations
+                    if not self.finished and self.perturbation_senders >= self.cohort():
+                        print(f"[{self.id}] Received all perturbations.")
+                        await self.relay_perturbations()
+
+                if message_type == "value":
+                    print(f"[{self.id}] Received value from client {user_id}")
+
+                    if not self.expecting_value(user_id):
+                        print(f"[{self.id}] Ignoring value from client {user_id} outside the value phase")
+                        continue
+                    if self.chunk_size:
+                        # the whole point of chunks is that we never hold a client's full vector
+                        print(f"[{self.id}] Dropping value from client {user_id}: "
+                              f"this session takes values in chunks of {self.chunk_size}")
+                        continue
+
+                    try:
+                        # check the whole vector before any of it goes into the sum
+                        check_values(m.get('value'), self.base)
+                        if len(m['value']) != self.num_values:
+                            raise ValueError(f"expected {self.num_values} values but received {len(m['value'])}")
+                        # a deadline that passes while the vector is being added shouldn't cut this client
+                        self.adding_values.add(user_id)
+                        # fold the vector into the running sum in one go (the payload is decoded straight into an array)
+                        await self.agg.add_async(m['value'])
+                    except ValueError as e:
+                        self.adding_values.discard(user_id)
+                        await self.reject_value(websocket, user_id, str(e))
+                        break
+                    await self.value_received(user_id)
+
+                if message_type == "value_chunk":
+                    if not self.expecting_value(user_id):
+                        continue
+
+                    expected_offset = self.received_coordinates.get(user_id, 0)
+                    try:
+                        check_values(m.get('value'), self.base)
+                        if self.chunk_size and len(m['value']) > self.chunk_size:
+                            raise ValueError(f"chunks can't be longer than {self.chunk_size} values")
+                        # clients send their chunks in order, so anything else would add some coordinates
+                        # twice (or not at all) while we count the client as done
+                        received = expected_offset + len(m['value'])
+                        if m.get('offset') != expected_offset or received > self.num_values or not len(m['value']):
+                            raise ValueError(f"expected values from offset {expected_offset} but received "
+                                             f"{len(m['value'])} at offset {m.get('offset')}")
+                    except ValueError as e:
+                        problem = str(e)
+                        if expected_offset == 0:
+                            print(f"[{self.id}] Dropping bad chunk from client {user_id}: {problem}")
+                            continue
+                        # part of this client's vector is in the sum already and can't be taken out again
+                        await self.abort(f"client {user_id} sent a bad value chunk ({problem})")
+                        return
+                    self.received_coordinates[user_id] = received
+
+                    # fold the chunk into the running sum straight away, so we never hold a client's full vector
+                    await self.agg.add_chunk_async(m['offset'], m['value'])
+                    if received == self.num_values:
+                        print(f"[{self.id}] Received all value chunks from client {user_id}")
+                        await self.value_received(user_id)
+
+                if message_type == "shares":
+                    # shares that arrive after the relay can't be used any more
+                    if self.phase != "shares" or user_id not in self.pub_keys:
+                        continue
+                    print(f"[{self.id}] Received shares from client {user_id}")
+
+                    for peer, bundle in m["shares"].items():
+                        if peer in self.pub_keys and peer != user_id:
+                            self.share_bundles.setdefault(peer, dict())[user_id] = bundle
+                    self.share_holders.add(user_id)
+                    await self.check_recovery_progress()
+
+                if message_type == "unmask_shares":
+                    if self.phase != "unmask" or user_id not in self.unmask_request[1]:
+                        continue
+                    dropped, survivors = self.unmask_request
+                    # only keep complete responses, so any threshold of them is enough to unmask
+                    if not (set(dropped) <= set(m["key_shares"]) and set(survivors) <= set(m["mask_shares"])):
+                        print(f"[{self.id}] Ignoring incomplete shares from client {user_id}")
+                        continue
+                    print(f"[{self.id}] Received unmask shares from client {user_id}")
+
+                    self.unmask_responses[user_id] = m
+                    await self.check_recovery_progress()
+
+            await websocket.wait_closed()
+
+        finally:
+            if user_id in self.connections:
+                del self.connections[user_id]
+            if not self.started:
+                # the round hasn't started yet, so someone else can take this client's spot
+                self.pub_keys.pop(user_id, None)
+                self.share_keys.pop(user_id, None)
+                self.num_admitted -= 1
+            elif self.recovery_threshold is not None and not self.finished:
+                # the rest of the cohort may have only been waiting on this client
+                print(f"[{self.id}] Client {user_id} dropped out.")
+                await self.check_recovery_progress()
+
+    async def value_received(self, user_id):
+        """
+        Called once a client's full masked vector has been added to the aggregate.
+        Once every client's is in, broadcast the result and close the session.
+        """
+        self.adding_values.discard(user_id)
+        self.value_senders.add(user_id)
+        if self.finished or self.adding_values:
+            # other clients' vectors are still being added, and the last of them moves the round on
+            return
+
+        if self.recovery_threshold is not None:
+            await self.check_recovery_progress()
+        elif self.value_senders >= self.cohort():
+            await self.finish()
+
+    async def reject_value(self, websocket, user_id, problem):
+        """
+        A client sent a value that can't go into the aggregate. In a dropout-tolerant round, the client
+        is dropped like one that disconnected (its handler should stop reading from it). Otherwise the
+        other clients' values are masked with it, so the round can't finish and is aborted.
+        """
+        print(f"[{self.id}] Rejecting value from client {user_id}: {problem}")
+        if self.recovery_threshold is None:
+            await self.abort(f"client {user_id} sent a bad value ({problem})")
+            return
+        try:
+            await self.send(websocket, encode({"type": "message", "message": f"Value rejected: {problem}"}))
+        except websockets.ConnectionClosed:
+            pass
+        await websocket.close()
+
+    def expecting_value(self, user_id):
+        # values only count if they arrive in the value phase from a client that's still in the round
+        # (in a dropout-tolerant round, one whose shares were relayed). With eager relaying, a client
+        # may have all of its peers' perturbations, and so send its value, before everyone else's are in.
+        if self.finished or user_id in self.value_senders or user_id in self.adding_values:
+            return False
+        if self.phase == "perturbations" and self.relay_mode == "eager":
+            return user_id in self.perturbation_senders and user_id in self.cohort()
+        if self.phase != "values":
+            return False
+        if self.recovery_threshold is not None:
+            return user_id in self.share_holders
+        return user_id in self.cohort()
+
+    def cohort(self):
+        """
+        The clients taking part in the round: everyone whose public key made it in and who hasn't been cut.
+        """
+        return set(self.pub_keys) - self.cut_clients
+
+    async def start_round(self):
+        """
+        Broadcast every client's public key and move on to the next phase.
+        """
+        self.started = True
+        # in "dh" mode clients derive their masks from the public keys alone, so they go straight to
+        # sending values (or their shares) and there is nothing to relay
+        if self.mask_mode != "dh":
+            if self.relay_mode == "batch":
+                self.relay_store = RelayStore(self.pub_keys, "perturbations", "perturbations", self.relay_dir)
+            self.enter_phase("perturbations")
+        elif self.recovery_threshold is not None:
+            self.enter_phase("shares")
+        else:
+            self.enter_phase("values")
+
+        if self.num_neighbors is None:
+            print(f"[{self.id}] Broadcasting public keys.")
+            await self.broadcast({"type": "public_key_broadcast", "public_keys": self.pub_keys,
+                                  "share_keys": self.share_keys})
+            return
+
+        # each client only hears about its neighbors, so those are the only ones it masks with
+        self.neighbors = neighbor_graph(self.pub_keys, self.num_neighbors, get_random_bytes(SEED_BYTES))
+        print(f"[{self.id}] Sending public keys of {self.num_neighbors} neighbors to each client.")
+        for (peer_id, peer_neighbors) in self.neighbors.items():
+            keys_to_send = peer_neighbors | {peer_id}
+            await self.send_if_connected(peer_id, encode({
+                "type": "public_key_broadcast",
+                "public_keys": {neighbor: self.pub_keys[neighbor] for neighbor in keys_to_send},
+                "share_keys": {neighbor: self.share_keys[neighbor] for neighbor in keys_to_send
+                               if neighbor in self.share_keys}}))
+
+    async def relay_perturbations(self):
+        """
+        Send each client the perturbations that the other clients made for it. Only perturbations
+        between clients that both sent theirs in are relayed, so the masks of a client that was cut
+        from this phase never make it into anyone's value.
+        """
+        self.enter_phase("values")
+        if self.relay_mode == "eager":
+            # everything has been forwarded already, but clients still waiting on a peer that was cut
+            # need to know who made it, so they stop waiting
+            if self.cut_counts["perturbations"]:
+                message = encode({"type": "perturbations", "perturbations": dict(),
+                                  "senders": sorted(self.perturbation_senders)})
+                await self.relay(self.perturbation_senders - self.value_senders, lambda peer_id: message,
+                                 time.perf_counter())
+            return
+
+        # each bundle is mapped in from its file right before it's sent, and dropped as soon as it's out,
+        # so at most relay_parallelism of them are in memory at once
+        await self.relay(self.perturbation_senders, self.relay_store.bundle, time.perf_counter(),
+                         self.relay_store.release)
+        self.relay_store.close()
+
+    async def forward_perturbations(self, sender, perturbations):
+        """
+        Eager relaying: pass a client's perturbations on to their recipients right away, one message
+        per recipient. If the sender's recipient is cut later on, so is the pair's mask, since the
+        recipient never sends a value and the sender never gets the recipient's perturbation back.
+        """
+        cohort = self.cohort()
+        messages = {peer: encode({"type": "perturbations", "perturbations": {sender: perturbation}})
+                    for (peer, perturbation) in perturbations.items() if peer in cohort and peer != sender}
+        await self.relay(messages, messages.get, self.phase_times["perturbations"])
+
+    async def relay(self, peer_ids, message_for, start, release=None):
+        """
+        Send each of the clients in peer_ids its message concurrently, so one slow reader doesn't hold
+        up everyone after it, and record how long after start each one was sent. message_for(client id)
+        gives a client's encoded message, and is only called once the message can go out. If given,
+        release(client id) is called once a client's message is out (or won't be).
+        Aborts the round if a client's connection doesn't take its message within send_timeout.
+        """
+        slots = asyncio.Semaphore(self.relay_parallelism)
+
+        async def relay_to(peer_id):
+            async with slots:
+                if self.finished:
+                    # the round was aborted while this client's message was waiting for a slot
+                    return True
+                try:
+                    await asyncio.wait_for(self.message_user(peer_id, message_for(peer_id)), self.send_timeout)
+                except (KeyError, websockets.ConnectionClosed):
+                    # this client has dropped out, which its handler will notice
+                    return True
+                except asyncio.TimeoutError:
+                    return False
+                finally:
+                    if release is not None:
+                        release(peer_id)
+            self.record_relay_latency(peer_id, time.perf_counter() - start)
+            return True
+
+        delivered = await asyncio.gather(*[relay_to(peer_id) for peer_id in peer_ids])
+        stalled = len(delivered) - sum(delivered)
+        if stalled and not self.finished:
+            # everyone else's value is masked with the stalled clients' perturbations, and they can't
+            # send theirs without their own, so the round can't finish
+            await self.abort(f"{stalled} clients didn't take their perturbations within {self.send_timeout} s")
+
+    def enter_phase(self, phase):
+        self.phase = phase
+        self.phase_times[phase] = time.perf_counter()
+        self.set_deadline()
+
+    def set_deadline(self):
+        # replace the timer for the previous phase (unless it's the one that got us here)
+        self.cancel_deadline()
+
+        seconds = self.deadlines.get(self.phase)
+        if seconds is not None:
+            self.deadline_task = asyncio.create_task(self.phase_deadline(self.phase, seconds))
+
+    def cancel_deadline(self):
+        if self.deadline_task is not None and self.deadline_task is not asyncio.current_task():
+            self.deadline_task.cancel()
+        self.deadline_task = None
+
+    async def phase_deadline(self, phase, seconds):
+        await asyncio.sleep(seconds)
+        if self.phase == phase and not self.finished:
+            await self.cut_stragglers()
+
+    async def cut_stragglers(self):
+        """
+        The current phase's deadline has passed: cut every client that hasn't done its part (or has
+        disconnected) and carry on with the rest, or abort if that isn't possible.
+        """
+        phase = self.phase
+        if phase == "keys":
+            candidates, done = set(self.connections) | set(self.pub_keys), set(self.pub_keys)
+        elif phase == "perturbations":
+            candidates, done = self.cohort(), self.perturbation_senders
+        elif phase == "shares":
+            candidates, done = self.cohort(), self.share_holders
+        elif phase == "values":
+            candidates = self.share_holders if self.recovery_threshold is not None else self.cohort()
+            done = self.value_senders | self.adding_values
+        elif phase == "unmask":
+            candidates, done = set(self.unmask_request[1]), set(self.unmask_responses)
+        else:
+            candidates, done = set(), set()
+
+        late = candidates - done - self.cut_clients
+        survivors = candidates & done
+        print(f"[{self.id}] Deadline for the {phase} phase passed with {len(late)} clients missing.")
+
+        if len(survivors) < self.min_survivors:
+            await self.abort(f"only {len(survivors)} clients made the {phase} deadline")
+            return
+        if phase == "values" and self.recovery_threshold is None:
+            await self.abort("clients missed the value deadline, and their masks can't be cancelled without dropout recovery")
+            return
+        if phase == "forward":
+            await self.abort("the root didn't send back the total in time")
+            return
+        if phase == "unmask":
+            # with enough responses we'd have finished already
+            await self.abort(f"only {len(survivors)} survivors sent their shares in time")
+            return
+
+        self.cut(late, phase)
+        if phase == "keys":
+            await self.start_round()
+        elif phase == "perturbations":
+            await self.relay_perturbations()
+        else:
+            await self.check_recovery_progress()
+
+    def cut(self, user_ids, phase):
+        """
+        Remove clients from the round for missing the deadline of the given phase.
+        """
+        self.cut_counts[phase] += len(user_ids)
+        self.cut_clients |= user_ids
+        for user_id in user_ids:
+            print(f"[{self.id}] Cutting client {user_id} for missing the {phase} deadline.")
+            self.pub_keys.pop(user_id, None)
+            self.share_keys.pop(user_id, None)
+            websocket = self.connections.pop(user_id, None)
+            if websocket is not None:
+                # close in the background, a straggler may be too slow to even finish the closing handshake
+                task = asyncio.create_task(self.close_cut_connection(websocket, phase))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+
+    async def close_cut_connection(self, websocket, phase):
+        try:
+            await self.send(websocket, encode({"type": "message", "message": f"Cut from the round for missing the {phase} deadline."}))
+        except websockets.ConnectionClosed:
+            pass
+        await websocket.close()
+
+    async def check_recovery_progress(self):
+        """
+        Move a dropout-tolerant round on to its next phase once every client that's still connected
+        has done its part of the current one, or abort if fewer than recovery_threshold are left.
+        """
+        if self.finished or not self.started:
+            return
+        connected = set(self.connections)
+
+        if self.phase == "shares":
+            if not self.share_holders or not connected <= self.share_holders:
+                return
+            if len(self.share_holders) < self.recovery_threshold:
+                await self.abort(f"only {len(self.share_holders)} clients shared their secrets")
+                return
+
+            self.enter_phase("values")
+            print(f"[{self.id}] Relaying shares from {len(self.share_holders)} clients.")
+            for peer_id in self.share_holders & connected:
+                bundles = {sender: bundle for (sender, bundle) in self.share_bundles.get(peer_id, dict()).items()
+                           if sender in self.share_holders}
+                await self.send_if_connected(peer_id, encode({"type": "shares", "shares": bundles}))
+
+        elif self.phase == "values":
+            # a vector that's still being added would be counted as dropped
+            if self.adding_values or not (connected & self.share_holders) <= self.value_senders:
+                return
+            survivors = sorted(self.value_senders)
+            if len(survivors) < self.recovery_threshold:
+                await self.abort(f"only {len(survivors)} clients sent their values")
+                return
+
+            dropped = sorted(self.share_holders - self.value_senders)
+            self.unmask_request = (dropped, survivors)
+            self.enter_phase("unmask")
+            print(f"[{self.id}] {len(dropped)} clients dropped out, asking survivors for shares.")
+            message = encode({"type": "unmask_request", "dropped": dropped, "survivors": survivors})
+            for peer_id in set(survivors) & connected:
+                await self.send_if_connected(peer_id, message)
+
+        elif len(self.unmask_responses) >= self.recovery_threshold:
+            if self.unmasking:
+                return
+            # from here on we're not waiting on anyone, so nothing more is late
+            self.unmasking = True
+            self.cancel_deadline()
+            try:
+                await self.unmask()
+            except ValueError as e:
+                await self.abort(f"unable to recover masks: {e}")
+                return
+            await self.finish()
+
+        elif connected & set(self.unmask_request[1]) <= set(self.unmask_responses):
+            await self.abort(f"only {len(self.unmask_responses)} survivors sent their shares")
+
+    async def unmask(self):
+        """
+        Reconstruct the dropped clients' private keys and the survivors' self-mask seeds from the
+        survivors' shares, and remove the masks they account for from the aggregate.
+        Raises ValueError if the shares don't reconstruct.
+        """
+        dropped, survivors = self.unmask_request
+        responses = list(self.unmask_responses.values())[:self.recovery_threshold]
+        correction = zero_mask(self.num_values, self.base)
+
+        for dropped_id in dropped:
+            dh_key = import_dh_key(combine_shares(
+                [tuple(response["key_shares"][dropped_id]) for response in responses], DH_SEED_BYTES))
+            for survivor_id in survivors:
+                seed = derive_pairwise_seed(dh_key, self.pub_keys[survivor_id], dropped_id, survivor_id)
+                mask = expand_seed(seed, self.num_values, self.base)
+                # the survivor added this mask if its id is smaller and subtracted it otherwise, so undo that
+                if survivor_id < dropped_id:
+                    correction = sub_mod(correction, mask, self.base)
+                else:
+                    correction = add_mod(correction, mask, self.base)
+
+        for survivor_id in survivors:
+            seed = combine_shares(
+                [tuple(response["mask_shares"][survivor_id]) for response in responses], SEED_BYTES)
+            correction = sub_mod(correction, expand_seed(seed, self.num_values, self.base), self.base)
+
+        await self.agg.add_chunk_async(0, correction)
+
+    async def finish(self):
+        """
+        Broadcast the result and close the session.
+        """
+        # every client's part is in, so nothing more is late
+        self.cancel_deadline()
+        result = await self.agg.result_async()
+        if self.finished:
+            # the round was aborted while the workers were reducing the sum
+            return
+        print(
+            f"✨🔐 SECURE AGGREGATION [{self.id}] 🔐✨ \n✨🔐    Result: {result}     🔐✨\n")
+
+        if self.forward_result is not None:
+            self.enter_phase("forward")
+            try:
+                result, num_clients = await self.forward_result(self, result)
+            except ConnectionError as e:
+                await self.abort(str(e))
+                return
+            if self.finished:
+                # the forward deadline passed while we were waiting
+                return
+            print(f"[{self.id}] Total over {num_clients} clients: {result}")
+
+        await self.broadcast({"type": "aggregation_result", "aggregation_result": result})
+        print(f"[{self.id}] Clients cut per phase: {self.cut_counts}")
+        print(f"[{self.id}] Closing session.")
+        self.outcome = "ok"
+        await self.close_connections()
+        print(f"[{self.id}] Session finished.\n", "*"*8, "\n")
+
+    async def broadcast(self, payload):
+        message = encode(payload, self.base)
+        self.record_sent(message, len(self.connections))
+        websockets.broadcast(
+            self.connections.values(), message)
+
+    async def abort(self, reason):
+        print(f"[{self.id}] Aborting round: {reason}")
+        print(f"[{self.id}] Clients cut per phase: {self.cut_counts}")
+        await self.broadcast({"type": "message", "message": f"Round aborted: {reason}"})
+        self.outcome = "aborted"
+        await self.close_connections()
+
+    async def send_if_connected(self, user_id, message):
+        try:
+            await self.message_user(user_id, message)
+        except (KeyError, websockets.ConnectionClosed):
+            # this client has dropped out, which its handler will notice
+            pass
+
+    async def message_user(self, user_id, message):
+        # raises KeyError if user disconnected
+        websocket = self.connections[user_id]
+        await self.send(websocket, message)  # may raise websockets.ConnectionClosed
+
+    async def send(self, websocket, message):
+        self.record_sent(message)
+        await websocket.send(message)
+
+    def record_sent(self, message, num_recipients=1):
+        message_type = wire_message_type(message)
+        self.bytes_sent[message_type] = self.bytes_sent.get(message_type, 0) + len(message) * num_recipients
+        if self.metrics is not None:
+            self.metrics.message_sent(message_type, len(message), num_recipients)
+
+    def record_received(self, user_id, message_type, size):
+        self.bytes_received[message_type] = self.bytes_received.get(message_type, 0) + size
+        latency = time.perf_counter() - self.phase_times[self.phase] if self.phase in self.phase_times else None
+        if latency is not None:
+            self.client_latencies.setdefault(user_id, dict()).setdefault(message_type, latency)
+        if self.metrics is not None:
+            self.metrics.message_received(message_type, size, latency)
+
+    def record_relay_latency(self, user_id, latency):
+        self.relay_latencies[user_id] = latency
+        if self.metrics is not None:
+            self.metrics.relay_sent(latency)
+
+    async def close_connections(self):
+        if not self.finished and self.phase_times:
+            self.end_time = time.perf_counter()
+            if self.on_round_end is not None:
+                self.on_round_end(self)
+        self.finished = True
+        self.agg.close()
+        if self.relay_store is not None:
+            self.relay_store.close()
+        if self.deadline_task is not None and self.deadline_task is not asyncio.current_task():
+            self.deadline_task.cancel()
+
+        # have to make a copy since you can't modify the dict while iterating over it
+        connections_to_close = copy.copy(list(self.connections.values()))
+
+        for connection in connections_to_close:
+            # note: closing connection also removes it from the dict thanks to the finally clause above
+            await connection.close()
+
+        self.connections = dict()
+
+    def discard(self):
+        """
+        Forget about the session once every client has left it: stop its deadline timer and free its
+        resources without ending the round, so nothing is logged or counted for it.
+        """
+        self.cancel_deadline()
+        self.on_round_end = None
+        self.finished = True
+        self.agg.close()
+        if self.relay_store is not None:
+            self.relay_store.close()
+
+    def round_summary(self):
+        """
+        A dict describing how the round went: its parameters, outcome, the seconds spent in each phase
+        it went through, the clients cut per phase, the bytes received and sent by message type, how
+        long each client took to send each type of message, how long after the perturbation relay started
+        each client's bundle was sent, how many bytes of perturbations the relay store kept in files, and the CPU time the server process used
+        meanwhile (which includes any other sessions running at the same time).
+        """
+        phases = list(self.phase_times.items())
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        durations = {phase: (phases[i + 1][1] if i + 1 < len(phases) else end_time) - start
+                     for (i, (phase, start)) in enumerate(phases)}
+        return {"session": self.id, "round": self.round_index, "outcome": self.outcome,
+                "num_clients": self.client_threshold, "num_survivors": len(self.value_senders),
+                "num_values": self.num_values, "base": self.base, "mask_mode": self.mask_mode,
+                "crypto_suite": self.crypto_suite, "relay_mode": self.relay_mode,
+                "phase_s": durations, "round_s": end_time - phases[0][1] if phases else 0.0,
+                "cut": dict(self.cut_counts),
+                "bytes_received": dict(self.bytes_received), "bytes_sent": dict(self.bytes_sent),
+                "client_latency_s": self.client_latencies, "relay_send_s": self.relay_latencies,
+                "relay_stored_bytes": self.relay_store.bytes_stored if self.relay_store is not None else 0,
+                "cpu_s": time.process_time() - self.cpu_start if self.cpu_start is not None else 0.0}
+
+
+def request_path(websocket):
+    # websockets >= 14 exposes the handshake request, older versions the path directly
+    request = getattr(websocket, "request", None)
+    return request.path if request is not None else websocket.path
+
+
+def parse_session_path(path: str, limits: dict = None):
+    """
+    Parse the path a client connected to into a session id and any session parameters it asked for, e.g.
+        /cohort-a?num_clients=10&base=1000000&num_values=100&mask_mode=seed&chunk_size=50&num_neighbors=4
+        /cohort-b?mask_mode=vector&crypto_suite=x25519-chacha20poly1305&relay_mode=eager
+    The parameters only take effect if this client is the one that creates the session.
+    limits maps parameters to the largest value a client may ask for (default: DEFAULT_SESSION_LIMITS).
+    Raises ValueError for malformed parameters or ones over their limit.
+    """
+    limits = limits if limits is not None else DEFAULT_SESSION_LIMITS
+    parts = urlsplit(path)
+    session_id = parts.path.strip("/") or "default"
+
+    params = dict()
+    for (key, values) in parse_qs(parts.query).items():
+        value = values[-1]
+        if key in ("num_clients", "base", "num_values", "chunk_size", "recovery_threshold", "num_neighbors"):
+            params[key] = int(value)
+            if params[key] <= 0:
+                raise ValueError(f"{key} must be positive")
+            if limits.get(key) is not None and params[key] > limits[key]:
+                raise ValueError(f"{key} can't be larger than {limits[key]}")
+        elif key == "mask_mode":
+            if value not in MASK_MODES:
+                raise ValueError(f"Unknown mask mode: {value}")
+            params[key] = value
+        elif key == "crypto_suite":
+            if value not in CRYPTO_SUITES:
+                raise ValueError(f"Unknown crypto suite: {value}")
+            params[key] = value
+        elif key == "relay_mode":
+            if value not in RELAY_MODES:
+                raise ValueError(f"Unknown relay mode: {value}")
+            params[key] = value
+        else:
+            raise ValueError(f"Unknown session parameter: {key}")
+    return session_id, params
+
+
+def max_message_size(limits: dict = None):
+    """
+    The largest message a client needs to send to a session within limits (default: DEFAULT_SESSION_LIMITS),
+    which is a value message with the most values of the widest base, or None if those aren't limited.
+    Never less than MIN_MESSAGE_SIZE. In "vector" mode a client's perturbations message holds a vector for
+    each of its peers, so long vectors in big cohorts need a larger limit than this.
+    """
+    limits = limits if limits is not None else DEFAULT_SESSION_LIMITS
+    if limits.get("num_values") is None or limits.get("base") is None:
+        return None
+    return max(limits["num_values"] * vector_width(limits["base"]) + MESSAGE_OVERHEAD, MIN_MESSAGE_SIZE)
+
+
+def parse_deadlines(specs):
+    """
+    Parse a list of "phase=seconds" strings (e.g. ["keys=30", "values=10"]) into a dict of deadlines.
+    Raises ValueError for unknown phases or bad numbers.
+    """
+    deadlines = dict()
+    for spec in specs:
+        phase, _, seconds = spec.partition("=")
+        if phase not in PHASES:
+            raise ValueError(f"Unknown phase: {phase} (phases are {', '.join(PHASES)})")
+        deadlines[phase] = float(seconds)
+        if deadlines[phase] <= 0:
+            raise ValueError("deadlines must be positive")
+    return deadlines
+
+
+def check_session_params(params: dict):
+    """
+    Check that a full set of session parameters (see parse_session_path) makes sense together.
+    Raises ValueError if not.
+    """
+    threshold = params.get("recovery_threshold")
+    if threshold is None:
+        return
+    if params.get("num_neighbors") is not None:
+        # survivors would only hold shares for their neighbors, which the unmask phase doesn't handle yet
+        raise ValueError("dropout recovery can't be combined with a sparse masking graph yet")
+    if params["mask_mode"] != "dh":
+        raise ValueError("dropout recovery needs the 'dh' mask mode")
+    if params.get("chunk_size"):
+        # chunks from a client that drops out halfway through can't be taken back out of the aggregate
+        raise ValueError("dropout recovery can't be combined with chunked values")
+    if threshold > params["num_clients"]:
+        raise ValueError("recovery_threshold can't be larger than num_clients")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under test live in client_server_system, next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
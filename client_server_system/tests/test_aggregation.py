@@ -0,0 +1,304 @@
+import asyncio
+import random
+import numpy as np
+import pytest
+from multiprocessing import shared_memory
+from aggregation import ModularAccumulator, ShardedAccumulator
+
+
+def random_vectors(num_vectors, num_values, base):
+    return [np.array([random.randrange(base) for _ in range(num_values)], dtype=np.uint64)
+            for _ in range(num_vectors)]
+
+
+def reference_sum(vectors, base):
+    # python ints, so nothing overflows
+    return [sum(int(v[i]) for v in vectors) % base for i in range(len(vectors[0]))]
+
+
+@pytest.mark.parametrize("base", [2, 1000, 2 ** 32, 2 ** 63 - 25, 2 ** 63])
+def test_modular_matches_reference(base):
+    vectors = random_vectors(8, 7, base)
+    agg = ModularAccumulator(7, base)
+    for v in vectors:
+        agg.add(v)
+    assert list(agg.result()) == reference_sum(vectors, base)
+    assert agg.count == 8
+
+
+def test_modular_reduces_before_overflow():
+    # the largest values that can come in, more times than the uint64 sum can hold them unreduced
+    base = 2 ** 63
+    agg = ModularAccumulator(4, base)
+    assert agg.max_pending == 1
+    vectors = [np.full(4, base - 1, dtype=np.uint64) for _ in range(5 * agg.max_pending + 3)]
+    for v in vectors:
+        agg.add(v)
+        assert agg.pending.max() <= agg.max_pending
+    assert list(agg.result()) == reference_sum(vectors, base)
+
+
+def test_modular_max_pending_adds_without_reducing():
+    base = 2 ** 62 + 1
+    agg = ModularAccumulator(3, base)
+    assert agg.max_pending == 2
+    vectors = [np.full(3, base - 1, dtype=np.uint64) for _ in range(agg.max_pending + 1)]
+    for v in vectors[:-1]:
+        agg.add(v)
+    # max_pending adds of base-1 on top of a reduced sum still fit in uint64
+    assert list(agg.pending) == [agg.max_pending]
+    assert [int(x) for x in agg.agg] == [agg.max_pending * (base - 1)] * 3
+    agg.add(vectors[-1])
+    assert list(agg.pending) == [1]
+    assert list(agg.result()) == reference_sum(vectors, base)
+
+
+def test_modular_big_base():
+    # bases above 2^63 don't fit uint64 sums, so they're summed as python ints
+    base = 2 ** 64 + 13
+    vectors = [np.array([base - 1, base - 2, 0, 2 ** 64 - 1], dtype=object) for _ in range(6)]
+    agg = ModularAccumulator(4, base)
+    assert agg.max_pending is None
+    for v in vectors:
+        agg.add(v)
+    assert list(agg.result()) == reference_sum(vectors, base)
+
+
+def test_modular_chunks_reduce_only_their_blocks():
+    base = 2 ** 63
+    agg = ModularAccumulator(10, base, block_size=4)
+    assert len(agg.pending) == 3
+    top = np.full(10, base - 1, dtype=np.uint64)
+    agg.add(top)
+
+    # chunks within the first and middle blocks reduce just that block before adding, leaving sums of 2(base-1)
+    agg.add_chunk(0, top[0:2])
+    agg.add_chunk(5, top[5:7])
+    assert list(agg.pending) == [1, 1, 1]
+    assert int(agg.agg[0]) == int(agg.agg[5]) == 2 * (base - 1)
+    assert int(agg.agg[4]) == base - 1
+
+    # a chunk crossing into the last block reduces both blocks it touches, and not the first one
+    agg.add_chunk(6, top[6:9])
+    assert list(agg.pending) == [1, 1, 1]
+    assert int(agg.agg[0]) == 2 * (base - 1)
+    assert int(agg.agg[5]) == 2 * (base - 1) % base
+    assert int(agg.agg[6]) == 2 * (base - 1) % base + base - 1
+
+    adds = [2, 2, 1, 1, 1, 2, 3, 2, 2, 1]
+    assert list(agg.result()) == [n * (base - 1) % base for n in adds]
+    assert list(agg.pending) == [0, 0, 0]
+
+
+def test_modular_chunked_adds_match_reference():
+    base = 2 ** 63 - 1
+    vectors = random_vectors(9, 11, base) + [np.full(11, base - 1, dtype=np.uint64)] * 3
+    agg = ModularAccumulator(11, base, block_size=3)
+    for v in vectors:
+        # chunks that start and end inside blocks as well as on their boundaries
+        for (start, end) in [(0, 2), (2, 3), (3, 8), (8, 8), (8, 11)]:
+            agg.add_chunk(start, v[start:end])
+    assert list(agg.result()) == reference_sum(vectors, base)
+
+
+def test_modular_reduce_range():
+    base = 1000
+    agg = ModularAccumulator(6, base, block_size=2)
+    agg.add(np.full(6, 999, dtype=np.uint64))
+    agg.add(np.full(6, 999, dtype=np.uint64))
+    agg.reduce(2, 4)
+    assert list(agg.agg) == [1998, 1998, 998, 998, 1998, 1998]
+    assert list(agg.pending) == [2, 0, 2]
+    agg.reduce(4)
+    assert list(agg.agg) == [1998, 1998, 998, 998, 998, 998]
+    assert list(agg.pending) == [2, 0, 0]
+
+
+def test_modular_rejects_bad_input():
+    agg = ModularAccumulator(4, 1000)
+    with pytest.raises(ValueError):
+        agg.add(np.zeros(3, dtype=np.uint64))
+    with pytest.raises(ValueError):
+        agg.add_chunk(2, np.zeros(3, dtype=np.uint64))
+    with pytest.raises(ValueError):
+        agg.add_chunk(-1, np.zeros(1, dtype=np.uint64))
+    # empty chunks are fine
+    agg.add_chunk(4, np.zeros(0, dtype=np.uint64))
+    assert list(agg.result()) == [0] * 4
+
+
+OUT_OF_RANGE = [
+    np.array([1, 2, 1000, 3], dtype=np.uint64),     # the base itself
+    np.array([1, 2, 2 ** 64 - 1, 3], dtype=np.uint64),  # would overflow the sum between reductions
+    np.array([1, -2, 3, 4], dtype=np.int64),        # negative
+    np.array([1.0, 2.0, 3.0, 4.0]),                 # not ints
+    np.array([1, 2, 3, 4], dtype=object),           # python ints for a base that fits uint64
+    np.array(["1", "2", "3", "4"]),
+    [1, 2, 3, 4],                                   # not an array
+]
+
+
+@pytest.mark.parametrize("values", OUT_OF_RANGE)
+def test_modular_rejects_values_out_of_range(values):
+    agg = ModularAccumulator(4, 1000)
+    agg.add(np.array([999, 0, 5, 6], dtype=np.uint16))
+    with pytest.raises(ValueError):
+        agg.add(values)
+    with pytest.raises(ValueError):
+        agg.add_chunk(1, values[1:3])
+    # nothing was added
+    assert list(agg.result()) == [999, 0, 5, 6]
+    assert agg.count == 1
+
+
+def test_modular_big_base_rejects_values_out_of_range():
+    base = 2 ** 64 + 13
+    agg = ModularAccumulator(2, base)
+    for values in ([base, 0], [-1, 0], [1.5, 0]):
+        with pytest.raises(ValueError):
+            agg.add(np.array(values, dtype=object))
+    agg.add(np.array([base - 1, 0], dtype=object))
+    assert list(agg.result()) == [base - 1, 0]
+
+
+@pytest.mark.parametrize("values", OUT_OF_RANGE)
+def test_sharded_rejects_values_out_of_range(values):
+    sharded = ShardedAccumulator(4, 1000, 2)
+    try:
+        sharded.add(np.array([999, 0, 5, 6], dtype=np.uint64))
+        with pytest.raises(ValueError):
+            sharded.add(values)
+        with pytest.raises(ValueError):
+            asyncio.run(sharded.add_chunk_async(1, values[1:3]))
+        assert list(sharded.result()) == [999, 0, 5, 6]
+    finally:
+        sharded.close()
+
+
+@pytest.mark.parametrize("base", [1000, 2 ** 32, 2 ** 63])
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_sharded_matches_modular(base, num_workers):
+    vectors = random_vectors(6, 10, base)
+    modular = ModularAccumulator(10, base)
+    sharded = ShardedAccumulator(10, base, num_workers)
+    try:
+        for v in vectors:
+            modular.add(v)
+            sharded.add(v)
+        assert list(sharded.result()) == list(modular.result()) == reference_sum(vectors, base)
+        assert sharded.count == modular.count == 6
+    finally:
+        sharded.close()
+
+
+def test_sharded_mixed_packing():
+    # the input buffer holds each vector as it was packed, and the workers widen their own slices
+    vectors = [np.array([999, 1, 2, 3, 500], dtype=dtype) for dtype in ("<u2", "<u4", ">u4", np.int64, np.uint64)]
+    sharded = ShardedAccumulator(5, 1000, 2)
+    try:
+        for v in vectors:
+            sharded.add(v)
+            sharded.add_chunk(1, v[2:4])
+        assert list(sharded.result()) == [995, 15, 25, 15, 500]
+    finally:
+        sharded.close()
+
+
+def test_sharded_chunks_on_shard_boundaries():
+    base = 2 ** 63
+    vectors = random_vectors(4, 10, base)
+    sharded = ShardedAccumulator(10, base, 3)
+    assert sharded.shards == [(0, 3), (3, 6), (6, 10)]
+    try:
+        for v in vectors:
+            # one chunk per shard, one crossing two boundaries, and one inside a shard
+            for (start, end) in [(0, 3), (3, 6), (6, 6), (6, 7), (7, 10)]:
+                sharded.add_chunk(start, v[start:end])
+        for v in vectors:
+            for (start, end) in [(0, 2), (2, 9), (9, 10)]:
+                sharded.add_chunk(start, v[start:end])
+        assert list(sharded.result()) == reference_sum(vectors + vectors, base)
+    finally:
+        sharded.close()
+
+
+def test_sharded_reduces_pending_sums():
+    # with a base this large the uint64 sum only has room for one unreduced add, so the workers
+    # have to reduce before every other add
+    base = 2 ** 63
+    vectors = [np.full(5, base - 1, dtype=np.uint64) for _ in range(7)] + random_vectors(5, 5, base)
+    sharded = ShardedAccumulator(5, base, 2)
+    assert sharded.max_pending == 1
+    try:
+        for v in vectors:
+            sharded.add(v)
+        assert list(sharded.result()) == reference_sum(vectors, base)
+    finally:
+        sharded.close()
+
+
+def test_sharded_async_matches_reference():
+    base = 2 ** 40
+    vectors = random_vectors(5, 8, base)
+
+    async def run():
+        sharded = ShardedAccumulator(8, base, 2)
+        try:
+            # the async methods take turns, so they can run concurrently
+            await asyncio.gather(*[sharded.add_async(v) for v in vectors])
+            await sharded.add_chunk_async(3, vectors[0][3:6])
+            return await sharded.result_async()
+        finally:
+            sharded.close()
+
+    expected = reference_sum(vectors, base)
+    for i in range(3, 6):
+        expected[i] = (expected[i] + int(vectors[0][i])) % base
+    assert list(asyncio.run(run())) == expected
+
+
+def test_sharded_close_during_reduce():
+    async def run():
+        sharded = ShardedAccumulator(8, 1000, 2)
+        await sharded.add_async(np.arange(8, dtype=np.uint64))
+        result = asyncio.create_task(sharded.result_async())
+        # let the reduce reach the workers, then close while it's being waited for
+        await asyncio.sleep(0)
+        sharded.close()
+        return sharded, await result
+
+    sharded, result = asyncio.run(run())
+    assert result is None
+    assert sharded.closed()
+
+
+def test_sharded_close_cleans_up():
+    sharded = ShardedAccumulator(6, 1000, 2)
+    sharded.add(np.arange(6, dtype=np.uint64))
+    processes = [process for (process, _) in sharded.workers]
+    names = [sharded.agg_memory.name, sharded.input_memory.name]
+
+    sharded.close()
+    assert not any(process.is_alive() for process in processes)
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+    # closing again is fine, but using it isn't
+    sharded.close()
+    with pytest.raises(ValueError):
+        sharded.add(np.arange(6, dtype=np.uint64))
+    with pytest.raises(ValueError):
+        sharded.result()
+
+    async def use_closed():
+        await sharded.add_async(np.arange(6, dtype=np.uint64))
+        return await sharded.result_async()
+
+    assert asyncio.run(use_closed()) is None
+
+
+def test_sharded_close_before_any_add():
+    sharded = ShardedAccumulator(6, 1000, 2)
+    assert list(sharded.result()) == [0] * 6
+    sharded.close()
+    assert sharded.workers is None
@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from crypto_engine import (CRYPTO_SUITES, CryptoEngine, suite_encrypt, suite_decrypt, generate_x25519_keypair,
+                           pairwise_key)
+from key_cache import KeyCache
+from key_manager import generate_keypair
+
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture(scope="module")
+def rsa_keypairs():
+    # RSA keys are slow to generate, so share a pair for every test in this module
+    return [generate_keypair(), generate_keypair()]
+
+
+def keypairs(suite, rsa_keypairs):
+    """ (public key, private key) for a sender and a recipient in the given suite. """
+    if suite == "rsa-oaep-eax":
+        return rsa_keypairs
+    return [generate_x25519_keypair(), generate_x25519_keypair()]
+
+
+def tampered(message, index):
+    """ message with the last byte of its index'th part flipped. """
+    parts = list(message)
+    part = bytearray(parts[index])
+    part[-1] ^= 1
+    parts[index] = bytes(part)
+    return tuple(parts)
+
+
+@pytest.mark.parametrize("suite", CRYPTO_SUITES)
+def test_round_trip(suite, rsa_keypairs):
+    (sender_pub, sender_priv), (recipient_pub, recipient_priv) = keypairs(suite, rsa_keypairs)
+    key_cache = KeyCache()
+    message = suite_encrypt(suite, sender_priv, recipient_pub, DATA, key_cache)
+    assert DATA not in b"".join(message)
+    assert suite_decrypt(suite, recipient_priv, sender_pub, message, key_cache) == DATA
+
+
+@pytest.mark.parametrize("suite", CRYPTO_SUITES)
+def test_tampered_ciphertext_rejected(suite, rsa_keypairs):
+    (sender_pub, sender_priv), (recipient_pub, recipient_priv) = keypairs(suite, rsa_keypairs)
+    message = suite_encrypt(suite, sender_priv, recipient_pub, DATA)
+    # every part of the message is authenticated: the wrapped key (RSA only), nonce, tag and ciphertext
+    for index in range(len(message)):
+        with pytest.raises(ValueError):
+            suite_decrypt(suite, recipient_priv, sender_pub, tampered(message, index))
+
+
+@pytest.mark.parametrize("suite", CRYPTO_SUITES[1:])
+def test_wrong_peer_rejected(suite):
+    (_, sender_priv), (recipient_pub, recipient_priv) = keypairs(suite, None)
+    other_pub, _ = generate_x25519_keypair()
+    message = suite_encrypt(suite, sender_priv, recipient_pub, DATA)
+    with pytest.raises(ValueError):
+        suite_decrypt(suite, recipient_priv, other_pub, message)
+
+
+def test_unknown_suite_rejected():
+    pub, seed = generate_x25519_keypair()
+    with pytest.raises(ValueError):
+        suite_encrypt("rot13", seed, pub, DATA)
+    with pytest.raises(ValueError):
+        suite_decrypt("rot13", seed, pub, (b"", b"", b""))
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_engine_map(use_processes):
+    suite = "x25519-chacha20poly1305"
+    (sender_pub, sender_priv), (recipient_pub, recipient_priv) = keypairs(suite, None)
+    chunks = [DATA[i:] for i in range(8)]
+
+    async def run(engine):
+        messages = await engine.map(suite_encrypt, [(suite, sender_priv, recipient_pub, c) for c in chunks])
+        return await engine.map(suite_decrypt, [(suite, recipient_priv, sender_pub, m) for m in messages])
+
+    engine = CryptoEngine(2, use_processes)
+    try:
+        assert asyncio.run(run(engine)) == chunks
+    finally:
+        engine.shutdown()
+
+
+@pytest.mark.parametrize("suite", ["x25519-chacha20poly1305", "x25519-aes-gcm"])
+def test_pairwise_keys_kept_by_caller(suite):
+    (sender_pub, sender_priv), (recipient_pub, recipient_priv) = generate_x25519_keypair(), generate_x25519_keypair()
+    sender_keys, recipient_keys = {}, {}
+    message = suite_encrypt(suite, sender_priv, recipient_pub, DATA, pairwise_keys=sender_keys)
+    assert suite_decrypt(suite, recipient_priv, sender_pub, message, pairwise_keys=recipient_keys) == DATA
+    # both ends keep the same key, and only in the dicts they passed in
+    assert list(sender_keys.values()) == list(recipient_keys.values())
+    assert list(sender_keys.values()) == [pairwise_key(sender_priv, recipient_pub)]
+    # a key from the dict is used as is
+    sender_keys[(sender_priv, recipient_pub)] = bytes(32)
+    with pytest.raises(ValueError):
+        suite_decrypt(suite, recipient_priv, sender_pub,
+                      suite_encrypt(suite, sender_priv, recipient_pub, DATA, pairwise_keys=sender_keys),
+                      pairwise_keys=recipient_keys)
@@ -0,0 +1,18 @@
+from key_manager import KeyPool
+
+
+def test_take_does_not_start_refill():
+    pool = KeyPool(size=2, key_bits=1024)
+    # an empty pool generates the keypair on the spot, and leaves it at that
+    assert pool.take() != pool.take()
+    assert pool.thread is None
+    assert pool.stats() == {"hits": 0, "misses": 2, "ready": 0}
+
+
+def test_fill_then_take():
+    pool = KeyPool(size=2, key_bits=1024)
+    pool.fill()
+    keypairs = {pool.take(), pool.take()}
+    assert len(keypairs) == 2
+    assert pool.thread is None
+    assert pool.stats() == {"hits": 2, "misses": 0, "ready": 0}
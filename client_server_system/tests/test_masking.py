@@ -0,0 +1,133 @@
+import random
+import numpy as np
+import pytest
+from masking import (SEED_BYTES, expand_seed, mask_dtype, to_mask_array, zero_mask, add_mod, sub_mod,
+                     encode_mask, decode_mask, generate_dh_key, import_dh_key, derive_pairwise_seed,
+                     neighbor_graph)
+
+
+SEED = bytes(range(SEED_BYTES))
+BASES = [2, 1000, 2 ** 32, 2 ** 63 - 25, 2 ** 63, 2 ** 64, 2 ** 64 + 13, 2 ** 256]
+
+
+@pytest.mark.parametrize("base", BASES)
+def test_expand_seed_deterministic(base):
+    mask = expand_seed(SEED, 50, base)
+    assert len(mask) == 50
+    assert mask.dtype == mask_dtype(base)
+    assert list(expand_seed(SEED, 50, base)) == list(mask)
+    assert list(expand_seed(bytes(SEED_BYTES), 50, base)) != list(mask)
+
+
+def test_expand_seed_prefix():
+    # the first values don't depend on how many are asked for
+    assert list(expand_seed(SEED, 1000, 1000)[:10]) == list(expand_seed(SEED, 10, 1000))
+
+
+@pytest.mark.parametrize("base", BASES)
+def test_expand_seed_in_range(base):
+    mask = expand_seed(SEED, 2000, base)
+    assert all(0 <= int(x) < base for x in mask)
+
+
+def test_expand_seed_uses_whole_range():
+    # rejection sampling for a base just above a power of two throws away almost half the candidates
+    base = 2 ** 10 + 1
+    counts = np.bincount(expand_seed(SEED, 200000, base).astype(np.int64), minlength=base)
+    # about 195 of each value, give or take 14 (the seed is fixed, so this can't flake)
+    assert len(counts) == base
+    assert counts.min() > 100
+    assert counts.max() < 300
+
+
+def reference(op, a, b, base):
+    return [op(int(x), int(y)) % base for (x, y) in zip(a, b)]
+
+
+@pytest.mark.parametrize("base", BASES)
+def test_add_sub_mod(base):
+    extremes = [0, 1, base - 1, base // 2]
+    a = to_mask_array(extremes + [random.randrange(base) for _ in range(20)], base)
+    b = to_mask_array(list(reversed(extremes)) + [random.randrange(base) for _ in range(20)], base)
+    assert list(add_mod(a, b, base)) == reference(int.__add__, a, b, base)
+    assert list(sub_mod(a, b, base)) == reference(int.__sub__, a, b, base)
+    assert list(sub_mod(add_mod(a, b, base), b, base)) == list(a)
+    assert list(sub_mod(a, a, base)) == list(zero_mask(len(a), base))
+
+
+@pytest.mark.parametrize("base", [2 ** 63, 2 ** 64 + 13])
+def test_add_mod_largest_values(base):
+    # (base - 1) + (base - 1) is the largest sum a uint64 mask ever has to hold
+    a = to_mask_array([base - 1] * 3, base)
+    assert list(add_mod(a, a, base)) == [base - 2] * 3
+    assert list(sub_mod(zero_mask(3, base), a, base)) == [1] * 3
+
+
+@pytest.mark.parametrize("base", BASES)
+def test_encode_decode_mask(base):
+    mask = expand_seed(SEED, 30, base)
+    decoded = decode_mask(encode_mask(mask, base), base)
+    assert decoded.dtype == mask_dtype(base)
+    assert list(decoded) == list(mask)
+
+
+def test_pairwise_seed_symmetric():
+    (key_a, pub_a), (key_b, pub_b), (key_c, pub_c) = [generate_dh_key() for _ in range(3)]
+    seed_ab = derive_pairwise_seed(key_a, pub_b, "a", "b")
+    assert len(seed_ab) == SEED_BYTES
+    # both ends of the pair get the same seed, whichever way round they pass the ids
+    assert derive_pairwise_seed(key_b, pub_a, "b", "a") == seed_ab
+    # but every pair gets its own
+    assert derive_pairwise_seed(key_a, pub_c, "a", "c") != seed_ab
+    assert derive_pairwise_seed(key_b, pub_c, "b", "c") != seed_ab
+
+
+def test_pairwise_seed_bound_to_ids_and_purpose():
+    (key_a, _), (_, pub_b) = generate_dh_key(), generate_dh_key()
+    seed = derive_pairwise_seed(key_a, pub_b, "a", "b")
+    assert derive_pairwise_seed(key_a, pub_b, "a", "x") != seed
+    assert derive_pairwise_seed(key_a, pub_b, "a", "b", purpose=b"shares") != seed
+
+
+def test_pairwise_seed_from_recovered_key():
+    # the server rebuilds a dropped client's key from its seed to recompute the client's masks
+    (key_a, _), (_, pub_b) = generate_dh_key(), generate_dh_key()
+    recovered = import_dh_key(key_a.seed)
+    assert derive_pairwise_seed(recovered, pub_b, "a", "b") == derive_pairwise_seed(key_a, pub_b, "a", "b")
+
+
+def connected(graph):
+    start = next(iter(graph))
+    seen, frontier = {start}, [start]
+    while frontier:
+        for neighbor in graph[frontier.pop()] - seen:
+            seen.add(neighbor)
+            frontier.append(neighbor)
+    return seen == set(graph)
+
+
+@pytest.mark.parametrize("num_clients", [2, 3, 4, 7, 10, 25, 64])
+@pytest.mark.parametrize("num_neighbors", [1, 2, 3, 4, 5, 8, 100])
+def test_neighbor_graph(num_clients, num_neighbors):
+    clients = [f"127.0.0.1:{i}" for i in range(num_clients)]
+    graph = neighbor_graph(clients, num_neighbors, SEED)
+    assert set(graph) == set(clients)
+    for (client, neighbors) in graph.items():
+        assert client not in neighbors
+        assert neighbors <= set(clients)
+        # masks cancel pairwise, so every edge has to go both ways
+        assert all(client in graph[neighbor] for neighbor in neighbors)
+    degrees = {len(neighbors) for neighbors in graph.values()}
+    # regular, with at least the neighbors asked for (odd counts are rounded up) unless that's everyone
+    assert len(degrees) == 1
+    degree = degrees.pop()
+    assert min(num_neighbors, num_clients - 1) <= degree <= min(num_neighbors + 1, num_clients - 1)
+    assert connected(graph)
+
+
+def test_neighbor_graph_depends_on_seed():
+    clients = [f"127.0.0.1:{i}" for i in range(30)]
+    graph = neighbor_graph(clients, 4, SEED)
+    # the same whatever order the clients are passed in
+    assert neighbor_graph(list(reversed(clients)), 4, SEED) == graph
+    assert neighbor_graph(clients, 4, bytes(SEED_BYTES)) != graph
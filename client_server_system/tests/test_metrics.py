@@ -0,0 +1,112 @@
+import asyncio
+import json
+import numpy as np
+import websockets
+from metrics import Histogram, ServerMetrics
+from websocket_server_vector import SecureAggServer
+from wire_format import encode, decode
+
+
+def test_histogram_render():
+    histogram = Histogram([1, 5])
+    for x in (0.5, 1, 3, 10):
+        histogram.observe(x)
+    assert histogram.render("secagg_x", {"type": "value"}) == [
+        'secagg_x_bucket{type="value",le="1"} 2',
+        'secagg_x_bucket{type="value",le="5"} 3',
+        'secagg_x_bucket{type="value",le="+Inf"} 4',
+        'secagg_x_sum{type="value"} 14.5',
+        'secagg_x_count{type="value"} 4',
+    ]
+    # without labels
+    assert histogram.render("secagg_x", dict())[-1] == "secagg_x_count 4"
+
+
+def test_render():
+    metrics = ServerMetrics()
+    metrics.message_received("value", 100, 0.02)
+    metrics.message_received("value", 300, None)
+    metrics.message_sent("perturbations", 1000, num_recipients=3)
+    metrics.relay_sent(0.3)
+    lines = metrics.render({"sessions_in_flight": ("Sessions currently in flight.", 2)}).splitlines()
+
+    assert lines[:3] == ["# HELP secagg_sessions_in_flight Sessions currently in flight.",
+                         "# TYPE secagg_sessions_in_flight gauge", "secagg_sessions_in_flight 2"]
+    for line in ['secagg_messages_received_total{type="value"} 2', 'secagg_bytes_received_total{type="value"} 400',
+                 'secagg_messages_sent_total{type="perturbations"} 3',
+                 'secagg_bytes_sent_total{type="perturbations"} 3000',
+                 "# TYPE secagg_rounds_total counter", "# TYPE secagg_round_duration_seconds histogram",
+                 'secagg_message_size_bytes_bucket{type="value",le="256"} 1',
+                 'secagg_message_size_bytes_count{type="value"} 2',
+                 # only one of the values came with a latency
+                 'secagg_client_latency_seconds_count{type="value"} 1',
+                 'secagg_relay_send_seconds_bucket{le="0.25"} 0', 'secagg_relay_send_seconds_bucket{le="0.5"} 1',
+                 "secagg_round_duration_seconds_count 0"]:
+        assert line in lines
+    # no round has ended, so there's nothing to count yet
+    assert not [line for line in lines if line.startswith("secagg_rounds_total")]
+
+
+def run_rounds(round_log):
+    """
+    Run two rounds of a two-client "dh" session on a real server: one that finishes and one that
+    aborts because a client sends a bad value. Returns the server.
+    """
+    server = SecureAggServer(2, 1000, 4, "dh", round_log=round_log)
+
+    async def run_round(port, values):
+        clients = [await websockets.connect(f"ws://localhost:{port}/") for _ in values]
+        try:
+            for websocket in clients:
+                assert decode(await websocket.recv())["type"] == "init_base_param"
+                await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+            for websocket in clients:
+                assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+            for (websocket, value) in zip(clients, values):
+                await websocket.send(encode({"type": "value", "value": np.array(value, dtype=np.uint64)}))
+            return decode(await asyncio.wait_for(clients[0].recv(), 5))
+        finally:
+            for websocket in clients:
+                await websocket.close()
+
+    async def run():
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            assert (await run_round(port, [[1, 2, 3, 4], [1, 2, 3, 4]]))["type"] == "aggregation_result"
+            assert (await run_round(port, [[1, 2, 1000, 4], [1, 2, 3, 4]]))["type"] == "message"
+            # let the server notice the clients are gone
+            await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    return server
+
+
+def test_round_log(tmp_path):
+    round_log = tmp_path / "rounds.jsonl"
+    server = run_rounds(str(round_log))
+    (finished, aborted) = [json.loads(line) for line in round_log.read_text().splitlines()]
+
+    assert (finished["session"], finished["round"], finished["outcome"]) == ("default", 0, "ok")
+    assert finished["num_clients"] == finished["num_survivors"] == 2
+    assert (finished["num_values"], finished["base"], finished["mask_mode"]) == (4, 1000, "dh")
+    assert list(finished["phase_s"]) == ["keys", "values"]
+    assert finished["round_s"] >= sum(finished["phase_s"].values()) - 1e-9
+    assert not any(finished["cut"].values())
+    assert set(finished["bytes_received"]) == {"public_key", "value"}
+    assert set(finished["bytes_sent"]) == {"init_base_param", "public_key_broadcast", "aggregation_result"}
+    # per client, then per message type
+    assert len(finished["client_latency_s"]) == 2
+    for latencies in finished["client_latency_s"].values():
+        assert set(latencies) == {"public_key", "value"}
+    assert finished["max_rss_kb"] > 0
+
+    assert (aborted["session"], aborted["round"], aborted["outcome"]) == ("default", 1, "aborted")
+    assert aborted["num_survivors"] == 0
+    assert "aggregation_result" not in aborted["bytes_sent"]
+
+    text = server.render_metrics()
+    assert 'secagg_rounds_total{outcome="aborted"} 1' in text
+    assert 'secagg_rounds_total{outcome="ok"} 1' in text
+    assert "secagg_round_duration_seconds_count 2" in text
+    assert 'secagg_phase_duration_seconds_count{phase="keys"} 2' in text
+    assert "secagg_sessions_in_flight 0" in text
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import numpy as np
+import pytest
+import websockets
+from relay_store import RelayStore
+from websocket_server_vector import SecureAggServer
+from wire_format import encode, decode
+
+
+def open_files(directory):
+    """ The number of files in directory that this process has open (the store unlinks its files, but
+    /proc still shows where they were). """
+    count = 0
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            count += os.readlink(f"/proc/self/fd/{fd}").startswith(str(directory))
+        except OSError:
+            pass
+    return count
+
+
+def test_bundle_round_trip(tmp_path):
+    store = RelayStore(["a", "b", "c"], "perturbations", "perturbations", str(tmp_path))
+    vector = np.array([1, 2, 3], dtype=np.uint16)
+    store.add("a", "b", b"b->a")
+    store.add("a", "c", vector)
+    store.add("b", "a", b"a->b")
+    try:
+        m = decode(bytes(store.bundle("a")))
+        assert m["type"] == "perturbations"
+        assert set(m["perturbations"]) == {"b", "c"}
+        assert m["perturbations"]["b"] == b"b->a"
+        assert list(m["perturbations"]["c"]) == [1, 2, 3]
+        assert decode(bytes(store.bundle("b"))) == {"type": "perturbations", "perturbations": {"a": b"a->b"}}
+        # nothing was sent to c
+        assert decode(bytes(store.bundle("c"))) == {"type": "perturbations", "perturbations": {}}
+        assert store.bytes_stored > len(b"b->a") + vector.nbytes + len(b"a->b")
+    finally:
+        store.close()
+
+
+def test_unknown_recipient(tmp_path):
+    store = RelayStore(["a", "b"], "perturbations", "perturbations", str(tmp_path))
+    with pytest.raises(KeyError):
+        store.add("c", "a", b"a->c")
+    assert not store.files
+
+
+def test_files_released(tmp_path):
+    store = RelayStore(["a", "b", "c"], "perturbations", "perturbations", str(tmp_path))
+    for recipient in ("a", "b"):
+        store.add(recipient, "c", b"c->" + recipient.encode())
+    # the files are unlinked right away, so nothing shows up in the directory even while they're in use
+    assert not os.listdir(tmp_path)
+    assert open_files(tmp_path) == 2
+
+    view = store.bundle("a")
+    store.release("a")
+    with pytest.raises(ValueError):
+        view[0]
+    assert open_files(tmp_path) == 1
+    assert set(store.files) == {"b"} and not store.maps
+
+    store.bundle("b")
+    store.close()
+    assert open_files(tmp_path) == 0
+    assert not store.files and not store.maps
+    # releasing twice is harmless
+    store.release("b")
+
+
+def test_files_released_after_round(tmp_path):
+    async def run():
+        server = SecureAggServer(2, 1000, 4, "vector", relay_mode="batch", relay_dir=str(tmp_path))
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            clients = [await websockets.connect(f"ws://localhost:{port}/") for _ in range(2)]
+            try:
+                for websocket in clients:
+                    assert decode(await websocket.recv())["type"] == "init_base_param"
+                    await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+                for websocket in clients:
+                    public_keys = decode(await websocket.recv())["public_keys"]
+                for websocket in clients:
+                    sender = "{}:{}".format(*websocket.local_address[:2])
+                    await websocket.send(encode({"type": "perturbations", "perturbations": {
+                        peer: f"{sender}->{peer}".encode() for peer in public_keys if peer != sender}}))
+                bundles = [decode(await asyncio.wait_for(websocket.recv(), 5)) for websocket in clients]
+                in_use = open_files(tmp_path)
+                for websocket in clients:
+                    await websocket.send(encode({"type": "value", "value": np.array([1, 2, 3, 4], dtype=np.uint64)}))
+                results = [decode(await asyncio.wait_for(websocket.recv(), 5)) for websocket in clients]
+                return bundles, in_use, results
+            finally:
+                for websocket in clients:
+                    await websocket.close()
+
+    bundles, in_use, results = asyncio.run(run())
+    for m in bundles:
+        assert m["type"] == "perturbations" and len(m["perturbations"]) == 1
+    # each bundle's file is dropped once it's been sent
+    assert in_use == 0
+    for m in results:
+        assert list(m["aggregation_result"]) == [2, 4, 6, 8]
+    assert open_files(tmp_path) == 0
@@ -0,0 +1,55 @@
+import random
+import pytest
+from secret_sharing import split_secret, combine_shares, pack_share, unpack_share, MAX_SECRET_BYTES
+
+
+SECRET = bytes(range(32))
+
+
+@pytest.mark.parametrize("num_shares, threshold", [(1, 1), (5, 1), (5, 3), (5, 5), (20, 11)])
+def test_any_threshold_shares_reconstruct(num_shares, threshold):
+    shares = split_secret(SECRET, num_shares, threshold)
+    assert len(shares) == num_shares
+    for _ in range(5):
+        subset = random.sample(shares, threshold)
+        assert combine_shares(subset, len(SECRET)) == SECRET
+
+
+def test_more_than_threshold_shares_reconstruct():
+    shares = split_secret(SECRET, 7, 4)
+    assert combine_shares(shares, len(SECRET)) == SECRET
+
+
+@pytest.mark.parametrize("num_shares, threshold", [(5, 3), (5, 5), (20, 11)])
+def test_fewer_than_threshold_shares_dont_reconstruct(num_shares, threshold):
+    shares = split_secret(SECRET, num_shares, threshold)
+    subset = random.sample(shares, threshold - 1)
+    try:
+        assert combine_shares(subset, len(SECRET)) != SECRET
+    except ValueError:
+        # sometimes the result is recognizably garbage
+        pass
+
+
+def test_duplicate_shares_rejected():
+    shares = split_secret(SECRET, 5, 3)
+    with pytest.raises(ValueError):
+        combine_shares([shares[0], shares[0], shares[1]], len(SECRET))
+
+
+@pytest.mark.parametrize("num_shares, threshold", [(5, 0), (5, 6)])
+def test_invalid_threshold_rejected(num_shares, threshold):
+    with pytest.raises(ValueError):
+        split_secret(SECRET, num_shares, threshold)
+
+
+def test_oversized_secret_rejected():
+    with pytest.raises(ValueError):
+        split_secret(bytes(MAX_SECRET_BYTES + 1), 5, 3)
+
+
+def test_pack_round_trip():
+    for share in split_secret(SECRET, 5, 3):
+        assert unpack_share(pack_share(share)) == share
+    with pytest.raises(ValueError):
+        unpack_share(pack_share(share)[:-1])
@@ -0,0 +1,509 @@
+import asyncio
+import numpy as np
+import pytest
+import websockets
+from session import parse_session_path, parse_deadlines, max_message_size, DEFAULT_SESSION_LIMITS, MIN_MESSAGE_SIZE
+from websocket_server_vector import SecureAggServer
+from wire_format import encode, decode
+
+
+def test_parse_session_path():
+    session_id, params = parse_session_path("/cohort-a?num_clients=10&base=1000&num_values=3&mask_mode=seed")
+    assert session_id == "cohort-a"
+    assert params == {"num_clients": 10, "base": 1000, "num_values": 3, "mask_mode": "seed"}
+    assert parse_session_path("/") == ("default", {})
+
+
+@pytest.mark.parametrize("query", ["num_clients=0", "base=-5", "num_values=x", "mask_mode=rot13",
+                                   "crypto_suite=rot13", "relay_mode=later", "colour=blue"])
+def test_malformed_params_rejected(query):
+    with pytest.raises(ValueError):
+        parse_session_path(f"/a?{query}")
+
+
+@pytest.mark.parametrize("key", ["num_clients", "num_values", "base", "chunk_size"])
+def test_params_over_limit_rejected(key):
+    limit = DEFAULT_SESSION_LIMITS[key]
+    assert parse_session_path(f"/a?{key}={limit}")[1] == {key: limit}
+    with pytest.raises(ValueError):
+        parse_session_path(f"/a?{key}={limit + 1}")
+
+
+def test_server_limits():
+    limits = {"num_values": 100}
+    assert parse_session_path("/a?num_values=100", limits)[1] == {"num_values": 100}
+    with pytest.raises(ValueError):
+        parse_session_path("/a?num_values=101", limits)
+    # parameters without a limit aren't capped
+    assert parse_session_path(f"/a?num_clients={10 ** 9}", limits)[1] == {"num_clients": 10 ** 9}
+
+
+def test_max_message_size():
+    # 10^7 values of a 2^256 base take 32 bytes each
+    assert max_message_size() > 32 * 10 ** 7
+    assert max_message_size() < 33 * 10 ** 7
+    assert max_message_size({"num_values": 10 ** 6, "base": 1000}) > 2 * 10 ** 6
+    # small sessions still get websockets' usual limit
+    assert max_message_size({"num_values": 100, "base": 1000}) == MIN_MESSAGE_SIZE
+    # no cap on the vectors, no cap on the messages
+    assert max_message_size({"num_values": 100}) is None
+
+
+def run_chunked_round(chunks, num_values=4, chunk_size=2, base=1000):
+    """
+    Run a one-client round in "vector" mode with chunked values on a real server, sending the given
+    (offset, values) chunks. Returns the message the server sent back after them.
+    """
+    async def run():
+        server = SecureAggServer(1, base, num_values, "vector", chunk_size)
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://localhost:{port}/") as websocket:
+                assert decode(await websocket.recv())["type"] == "init_base_param"
+                await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+                assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+                # there are no peers to make perturbations for
+                await websocket.send(encode({"type": "perturbations", "perturbations": {}}))
+                assert decode(await websocket.recv())["type"] == "perturbations"
+                for (offset, values) in chunks:
+                    await websocket.send(encode({"type": "value_chunk", "offset": offset,
+                                                 "value": np.array(values, dtype=np.uint64)}, base))
+                return await asyncio.wait_for(websocket.recv(), 5)
+
+    return decode(asyncio.run(run()))
+
+
+def test_chunked_value():
+    m = run_chunked_round([(0, [1, 2]), (2, [3, 4])])
+    assert m["type"] == "aggregation_result"
+    assert list(m["aggregation_result"]) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("bad_chunk", [
+    (2, [7, 7]),        # skipping the first chunk
+    (0, [7, 7, 7, 7, 7]),  # past the end
+    (0, [7, 7, 7]),     # longer than chunk_size
+])
+def test_bad_first_chunk_dropped(bad_chunk):
+    m = run_chunked_round([bad_chunk, (0, [1, 2]), (2, [3, 4])])
+    assert m["type"] == "aggregation_result"
+    assert list(m["aggregation_result"]) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("bad_chunk", [
+    (0, [7, 7]),        # the first chunk again
+    (2, [7, 7, 7]),     # past the end
+    (3, [7]),           # skipping a coordinate
+    (1, [7]),           # overlapping the first chunk
+])
+def test_bad_later_chunk_aborts(bad_chunk):
+    m = run_chunked_round([(0, [1, 2]), bad_chunk, (2, [3, 4])])
+    assert m["type"] == "message"
+    assert m["message"].startswith("Round aborted: client")
+
+
+def run_value_round(value, num_values=4, base=1000, aggregation_workers=None):
+    """
+    Run a one-client round in "dh" mode on a real server, sending the given value message payload.
+    Returns the message the server sent back after it.
+    """
+    async def run():
+        server = SecureAggServer(1, base, num_values, "dh", aggregation_workers=aggregation_workers)
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://localhost:{port}/") as websocket:
+                assert decode(await websocket.recv())["type"] == "init_base_param"
+                await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+                assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+                await websocket.send(encode({"type": "value", "value": value}))
+                return await asyncio.wait_for(websocket.recv(), 5)
+
+    return decode(asyncio.run(run()))
+
+
+@pytest.mark.parametrize("aggregation_workers", [None, 1])
+def test_value(aggregation_workers):
+    m = run_value_round(np.array([1, 2, 3, 4], dtype=np.uint64), aggregation_workers=aggregation_workers)
+    assert m["type"] == "aggregation_result"
+    assert list(m["aggregation_result"]) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("aggregation_workers", [None, 1])
+@pytest.mark.parametrize("value", [
+    "1,2,3,4",                                  # not a vector
+    np.array([1, 2, 3, 4], dtype=object),       # python ints, which only bases above 2^63 use
+    np.array([1, 2, 3], dtype=np.uint64),       # too short
+    np.array([1, 2, 1000, 4], dtype=np.uint64),  # out of range
+    None,
+])
+def test_bad_value_aborts(value, aggregation_workers):
+    # everyone else's value is masked with this client's, so the round can't go on without it
+    m = run_value_round(value, aggregation_workers=aggregation_workers)
+    assert m["type"] == "message"
+    assert m["message"].startswith("Round aborted: client")
+
+
+def test_whole_value_in_chunked_session_dropped():
+    async def run():
+        server = SecureAggServer(1, 1000, 4, "vector", 2)
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://localhost:{port}/") as websocket:
+                assert decode(await websocket.recv())["type"] == "init_base_param"
+                await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+                assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+                await websocket.send(encode({"type": "perturbations", "perturbations": {}}))
+                assert decode(await websocket.recv())["type"] == "perturbations"
+                await websocket.send(encode({"type": "value", "value": np.array([7, 7, 7, 7], dtype=np.uint64)}))
+                for (offset, values) in [(0, [1, 2]), (2, [3, 4])]:
+                    await websocket.send(encode({"type": "value_chunk", "offset": offset,
+                                                 "value": np.array(values, dtype=np.uint64)}))
+                return decode(await asyncio.wait_for(websocket.recv(), 5))
+
+    m = asyncio.run(run())
+    assert m["type"] == "aggregation_result"
+    assert list(m["aggregation_result"]) == [1, 2, 3, 4]
+
+
+def test_out_of_range_chunk_dropped():
+    m = run_chunked_round([(0, [1, 1000]), (0, [1, 2]), (2, [3, 4])])
+    assert m["type"] == "aggregation_result"
+    assert list(m["aggregation_result"]) == [1, 2, 3, 4]
+
+
+def test_bad_value_dropped_with_recovery():
+    # with dropout recovery the round goes on without the client, whose masks the survivors can cancel
+    async def run():
+        server = SecureAggServer(3, 1000, 4, "dh", recovery_threshold=2)
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            clients = [await websockets.connect(f"ws://localhost:{port}/") for _ in range(3)]
+            try:
+                for websocket in clients:
+                    assert decode(await websocket.recv())["type"] == "init_base_param"
+                    await websocket.send(encode({"type": "public_key", "public_key": "key", "share_key": "key"}))
+                for websocket in clients:
+                    assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+                    await websocket.send(encode({"type": "shares", "shares": {}}))
+                for websocket in clients:
+                    assert decode(await websocket.recv())["type"] == "shares"
+
+                (bad, *good) = clients
+                await bad.send(encode({"type": "value", "value": np.array([1, 2, 1000, 4], dtype=np.uint64)}))
+                rejection = decode(await asyncio.wait_for(bad.recv(), 5))
+                for websocket in good:
+                    await websocket.send(encode({"type": "value", "value": np.array([1, 2, 3, 4], dtype=np.uint64)}))
+                requests = [decode(await asyncio.wait_for(websocket.recv(), 5)) for websocket in good]
+                bad_id = "{}:{}".format(*bad.local_address[:2])
+                return rejection, requests, bad_id
+            finally:
+                for websocket in clients:
+                    await websocket.close()
+
+    rejection, requests, bad_id = asyncio.run(run())
+    assert rejection["message"].startswith("Value rejected")
+    for m in requests:
+        assert m["type"] == "unmask_request"
+        assert m["dropped"] == [bad_id]
+        assert len(m["survivors"]) == 2
+
+
+def test_session_kept_for_admitted_clients():
+    server = SecureAggServer(2, 1000, 4)
+    session = server.open_session("a", {})
+    # a queued client was let in, but its handler hasn't joined the session yet
+    session.admit()
+    server.release(session)
+    assert server.sessions["a"] is session
+    # it hung up before it got there
+    session.num_admitted -= 1
+    server.release(session)
+    assert "a" not in server.sessions
+
+
+def test_abandoned_session_not_logged():
+    # everyone left before the keys deadline, so there's no round to abort or count when it passes
+    async def run():
+        server = SecureAggServer(2, 1000, 4, deadlines={"keys": 0.1})
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://localhost:{port}/") as websocket:
+                assert decode(await websocket.recv())["type"] == "init_base_param"
+            await asyncio.sleep(0.3)
+        return server
+
+    server = asyncio.run(run())
+    assert not server.sessions
+    assert not server.metrics.rounds
+    assert not server.round_counts
+
+
+async def join_eager_round(port, num_clients):
+    """
+    Connect num_clients raw clients to an eager-relay server and publish their keys.
+    Returns their websockets and ids once the key broadcast is in.
+    """
+    clients = [await websockets.connect(f"ws://localhost:{port}/") for _ in range(num_clients)]
+    for websocket in clients:
+        m = decode(await websocket.recv())
+        assert (m["type"], m["relay_mode"]) == ("init_base_param", "eager")
+        await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+    for websocket in clients:
+        assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+    return clients, ["{}:{}".format(*websocket.local_address[:2]) for websocket in clients]
+
+
+def perturbations_for(ids, sender):
+    return encode({"type": "perturbations",
+                   "perturbations": {peer: f"{sender}->{peer}".encode() for peer in ids if peer != sender}})
+
+
+def value(values):
+    return encode({"type": "value", "value": np.array(values, dtype=np.uint64)})
+
+
+def test_eager_perturbations_before_key_broadcast_ignored():
+    async def run():
+        server = SecureAggServer(2, 1000, 4, "vector", relay_mode="eager")
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            early = await websockets.connect(f"ws://localhost:{port}/")
+            try:
+                assert decode(await early.recv())["type"] == "init_base_param"
+                await early.send(encode({"type": "public_key", "public_key": "key"}))
+                # the round hasn't started, so there's nobody to forward these to yet
+                await early.send(encode({"type": "perturbations", "perturbations": {"anyone": b"too early"}}))
+                late = await websockets.connect(f"ws://localhost:{port}/")
+                try:
+                    assert decode(await late.recv())["type"] == "init_base_param"
+                    await late.send(encode({"type": "public_key", "public_key": "key"}))
+                    for websocket in (early, late):
+                        assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+                    ids = ["{}:{}".format(*websocket.local_address[:2]) for websocket in (early, late)]
+
+                    await early.send(perturbations_for(ids, ids[0]))
+                    forwarded = decode(await asyncio.wait_for(late.recv(), 5))
+                    await late.send(perturbations_for(ids, ids[1]))
+                    assert decode(await asyncio.wait_for(early.recv(), 5))["perturbations"] == {
+                        ids[1]: f"{ids[1]}->{ids[0]}".encode()}
+                    await early.send(value([1, 2, 3, 4]))
+                    await late.send(value([10, 20, 30, 40]))
+                    result = decode(await asyncio.wait_for(early.recv(), 5))
+                    return ids, forwarded, result
+                finally:
+                    await late.close()
+            finally:
+                await early.close()
+
+    ids, forwarded, result = asyncio.run(run())
+    assert forwarded == {"type": "perturbations", "perturbations": {ids[0]: f"{ids[0]}->{ids[1]}".encode()}}
+    assert list(result["aggregation_result"]) == [11, 22, 33, 44]
+
+
+def test_eager_value_during_perturbations_phase():
+    # a client with every perturbation it needs can send its value before the others have sent theirs
+    async def run():
+        server = SecureAggServer(3, 1000, 4, "vector", relay_mode="eager")
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            clients, ids = await join_eager_round(port, 3)
+            (a, b, c) = clients
+            try:
+                await a.send(perturbations_for(ids, ids[0]))
+                await b.send(perturbations_for(ids, ids[1]))
+                await a.send(value([1, 2, 3, 4]))
+                # c hasn't sent its perturbations, so this value can't count
+                await c.send(value([500, 500, 500, 500]))
+                await asyncio.sleep(0.1)
+                phase = server.sessions["default"].phase
+                value_senders = set(server.sessions["default"].value_senders)
+
+                await c.send(perturbations_for(ids, ids[2]))
+                await b.send(value([10, 20, 30, 40]))
+                await c.send(value([100, 200, 300, 400]))
+                while (m := decode(await asyncio.wait_for(a.recv(), 5)))["type"] != "aggregation_result":
+                    assert m["type"] == "perturbations"
+                return ids, phase, value_senders, m
+            finally:
+                for websocket in clients:
+                    await websocket.close()
+
+    ids, phase, value_senders, m = asyncio.run(run())
+    assert phase == "perturbations"
+    assert value_senders == {ids[0]}
+    assert list(m["aggregation_result"]) == [111, 222, 333, 444]
+
+
+def test_eager_senders_sent_after_cut():
+    # clients still waiting on a peer that was cut hear who made it, those that already sent their value don't
+    async def run():
+        server = SecureAggServer(3, 1000, 4, "vector", deadlines={"perturbations": 0.3}, relay_mode="eager")
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            port = ws_server.sockets[0].getsockname()[1]
+            clients, ids = await join_eager_round(port, 3)
+            (a, b, c) = clients
+            try:
+                await a.send(perturbations_for(ids, ids[0]))
+                await b.send(perturbations_for(ids, ids[1]))
+                assert set(decode(await asyncio.wait_for(a.recv(), 5))["perturbations"]) == {ids[1]}
+                assert set(decode(await asyncio.wait_for(b.recv(), 5))["perturbations"]) == {ids[0]}
+                await a.send(value([1, 2, 3, 4]))
+                # c never sends its perturbations, so it's cut at the deadline
+                while (cut := decode(await asyncio.wait_for(c.recv(), 5)))["type"] == "perturbations":
+                    pass
+                senders = decode(await asyncio.wait_for(b.recv(), 5))
+                await b.send(value([10, 20, 30, 40]))
+                results = [decode(await asyncio.wait_for(websocket.recv(), 5)) for websocket in (a, b)]
+                return ids, cut, senders, results
+            finally:
+                for websocket in clients:
+                    await websocket.close()
+
+    ids, cut, senders, results = asyncio.run(run())
+    assert cut["message"] == "Cut from the round for missing the perturbations deadline."
+    assert senders == {"type": "perturbations", "perturbations": {}, "senders": sorted(ids[:2])}
+    for m in results:
+        assert m["type"] == "aggregation_result"
+        assert list(m["aggregation_result"]) == [11, 22, 33, 44]
+
+
+def test_parse_deadlines():
+    assert parse_deadlines([]) == {}
+    assert parse_deadlines(["keys=30", "values=2.5", "keys=10"]) == {"keys": 10.0, "values": 2.5}
+
+
+@pytest.mark.parametrize("spec", ["round=10", "keys", "keys=soon", "values=0", "values=-1"])
+def test_bad_deadlines_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_deadlines([spec])
+
+
+async def connect_clients(port, num_clients, num_keys=None):
+    """
+    Connect num_clients raw clients, the first num_keys of which (all by default) publish a key.
+    """
+    clients = [await websockets.connect(f"ws://localhost:{port}/") for _ in range(num_clients)]
+    for websocket in clients[:num_keys]:
+        assert decode(await websocket.recv())["type"] == "init_base_param"
+        await websocket.send(encode({"type": "public_key", "public_key": "key"}))
+    return clients
+
+
+async def next_message(websocket, message_type):
+    """ The next message of the given type, skipping the others. """
+    while (m := decode(await asyncio.wait_for(websocket.recv(), 5)))["type"] != message_type:
+        pass
+    return m
+
+
+def run_deadline_round(server, num_clients, num_keys, play):
+    """
+    Run a round on a real server with num_clients raw clients, num_keys of which publish a key, and
+    play(clients) doing the rest. Returns whatever play returns.
+    """
+    async def run():
+        async with websockets.serve(server.handler, "localhost", 0) as ws_server:
+            clients = await connect_clients(ws_server.sockets[0].getsockname()[1], num_clients, num_keys)
+            try:
+                return await play(clients)
+            finally:
+                for websocket in clients:
+                    await websocket.close()
+
+    return asyncio.run(run())
+
+
+def test_keys_deadline_cuts_stragglers():
+    server = SecureAggServer(3, 1000, 4, "dh", deadlines={"keys": 0.2})
+
+    async def play(clients):
+        (*on_time, straggler) = clients
+        broadcasts = [await next_message(websocket, "public_key_broadcast") for websocket in on_time]
+        cut = await next_message(straggler, "message")
+        for websocket in on_time:
+            await websocket.send(value([1, 2, 3, 4]))
+        return broadcasts, cut, [await next_message(websocket, "aggregation_result") for websocket in on_time]
+
+    broadcasts, cut, results = run_deadline_round(server, 3, 2, play)
+    for m in broadcasts:
+        assert len(m["public_keys"]) == 2
+    assert cut["message"] == "Cut from the round for missing the keys deadline."
+    for m in results:
+        assert list(m["aggregation_result"]) == [2, 4, 6, 8]
+    assert server.metrics.cut_clients["keys"] == sum(server.metrics.cut_clients.values()) == 1
+    assert server.metrics.rounds == {"ok": 1}
+
+
+def test_too_few_survivors_abort():
+    # one client isn't enough for a round, whatever its threshold
+    server = SecureAggServer(3, 1000, 4, "dh", deadlines={"keys": 0.2})
+
+    async def play(clients):
+        return await next_message(clients[0], "message")
+
+    m = run_deadline_round(server, 2, 1, play)
+    assert m["message"] == "Round aborted: only 1 clients made the keys deadline"
+    assert server.metrics.rounds == {"aborted": 1}
+    assert not any(server.metrics.cut_clients.values())
+
+
+def test_perturbations_deadline_cuts_stragglers():
+    server = SecureAggServer(3, 1000, 4, "vector", deadlines={"perturbations": 0.2})
+
+    async def play(clients):
+        for websocket in clients:
+            assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+        ids = ["{}:{}".format(*websocket.local_address[:2]) for websocket in clients]
+        (*on_time, straggler) = clients
+        for (sender, websocket) in zip(ids, on_time):
+            await websocket.send(perturbations_for(ids, sender))
+        bundles = [await next_message(websocket, "perturbations") for websocket in on_time]
+        cut = await next_message(straggler, "message")
+        for websocket in on_time:
+            await websocket.send(value([1, 2, 3, 4]))
+        results = [await next_message(websocket, "aggregation_result") for websocket in on_time]
+        return ids, bundles, cut, results
+
+    ids, bundles, cut, results = run_deadline_round(server, 3, 3, play)
+    # only the pair that both made it is relayed
+    assert bundles[0]["perturbations"] == {ids[1]: f"{ids[1]}->{ids[0]}".encode()}
+    assert bundles[1]["perturbations"] == {ids[0]: f"{ids[0]}->{ids[1]}".encode()}
+    assert cut["message"] == "Cut from the round for missing the perturbations deadline."
+    for m in results:
+        assert list(m["aggregation_result"]) == [2, 4, 6, 8]
+    assert server.metrics.cut_clients["perturbations"] == sum(server.metrics.cut_clients.values()) == 1
+
+
+def test_min_survivors_abort():
+    # the same straggler as above, but the server won't go on with fewer than 3 clients
+    server = SecureAggServer(3, 1000, 4, "vector", deadlines={"perturbations": 0.2}, min_survivors=3)
+
+    async def play(clients):
+        for websocket in clients:
+            assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+        ids = ["{}:{}".format(*websocket.local_address[:2]) for websocket in clients]
+        for (sender, websocket) in zip(ids, clients[:2]):
+            await websocket.send(perturbations_for(ids, sender))
+        return [await next_message(websocket, "message") for websocket in clients]
+
+    for m in run_deadline_round(server, 3, 3, play):
+        assert m["message"] == "Round aborted: only 2 clients made the perturbations deadline"
+    assert server.metrics.rounds == {"aborted": 1}
+    # nobody was cut, the round ended instead
+    assert not any(server.metrics.cut_clients.values())
+
+
+def test_values_deadline_without_recovery_aborts():
+    # everyone else's value is masked with the missing client's, so the round can't go on without it
+    server = SecureAggServer(3, 1000, 4, "dh", deadlines={"values": 0.2})
+
+    async def play(clients):
+        for websocket in clients:
+            assert decode(await websocket.recv())["type"] == "public_key_broadcast"
+        for websocket in clients[:2]:
+            await websocket.send(value([1, 2, 3, 4]))
+        return [await next_message(websocket, "message") for websocket in clients]
+
+    for m in run_deadline_round(server, 3, 3, play):
+        assert m["message"].startswith("Round aborted: clients missed the value deadline")
+    assert server.metrics.rounds == {"aborted": 1}
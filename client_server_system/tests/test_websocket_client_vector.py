@@ -0,0 +1,138 @@
+import itertools
+import pytest
+from types import SimpleNamespace
+import websocket_client_vector
+from masking import SEED_BYTES, encode_mask, expand_seed
+from secret_sharing import split_secret
+from websocket_client_vector import SecureAggClient
+
+
+CLIENTS = ["127.0.0.1:1", "127.0.0.1:2", "127.0.0.1:3", "127.0.0.1:4", "127.0.0.1:5"]
+a, b, c, d, e = CLIENTS
+
+
+def client_with_shares(threshold=3):
+    """ Client a in a dropout-tolerant round, holding shares from every client in CLIENTS. """
+    # the client only needs its connection for its id here
+    connection = SimpleNamespace(local_address=("127.0.0.1", 1))
+    client = SecureAggClient([1, 2], connection, keys=("public", "private"))
+    client.set_recovery_threshold(threshold)
+    key_shares = split_secret(b"key", len(CLIENTS), threshold)
+    mask_shares = split_secret(b"mask", len(CLIENTS), threshold)
+    client.received_shares = {peer: (key_shares[i], mask_shares[i]) for (i, peer) in enumerate(CLIENTS)}
+    return client
+
+
+def test_unmask_shares():
+    client = client_with_shares()
+    m = client.create_unmask_shares([e], [a, b, c, d])
+    assert set(m["key_shares"]) == {e}
+    assert set(m["mask_shares"]) == {a, b, c, d}
+
+
+def test_only_one_unmask_request_answered():
+    client = client_with_shares()
+    client.create_unmask_shares([e], [a, b, c, d])
+    # a second request could get us to hand over both kinds of share for d
+    with pytest.raises(ValueError):
+        client.create_unmask_shares([d, e], [a, b, c])
+
+
+def test_too_few_survivors_refused():
+    client = client_with_shares()
+    with pytest.raises(ValueError):
+        client.create_unmask_shares([c, d, e], [a, b])
+    # refusing doesn't use up our answer
+    client.create_unmask_shares([d, e], [a, b, c])
+
+
+@pytest.mark.parametrize("dropped, survivors", [([b], [a, b, c]), ([a], [b, c, d]),
+                                                ([e], [a, b, "127.0.0.1:6"])])
+def test_inconsistent_unmask_request_refused(dropped, survivors):
+    with pytest.raises(ValueError):
+        client_with_shares().create_unmask_shares(dropped, survivors)
+
+
+def eager_clients(values_by_client, base=1000):
+    """ Clients in an eager-relay round with the given values, keyed by id, with their public keys. """
+    clients = dict()
+    for (peer, values) in values_by_client.items():
+        host, port = peer.split(":")
+        client = SecureAggClient(values, SimpleNamespace(local_address=(host, int(port))), keys=("public", "private"))
+        client.set_base(base)
+        client.set_relay_mode("eager")
+        # a suite whose keys are cheap to generate
+        client.set_crypto_suite("x25519-chacha20poly1305")
+        clients[peer] = client
+    return clients, {peer: client.pub_key for (peer, client) in clients.items()}
+
+
+def test_eager_perturbation_before_key_broadcast():
+    clients, public_keys = eager_clients({a: [1, 2], b: [10, 20], c: [100, 200]})
+    for peer in (a, c):
+        clients[peer].create_perturbation_messages(public_keys)
+
+    # a's perturbation is forwarded to b before b has handled the key broadcast
+    assert clients[b].receive_perturbations({a: clients[a].perturbation_messages[b]}) is None
+    assert set(clients[b].pending_perturbations) == {a}
+    clients[b].create_perturbation_messages(public_keys)
+    assert clients[b].receive_perturbations({}) is None
+    assert not clients[b].pending_perturbations and clients[b].received_from == {a}
+
+    masked = {b: clients[b].receive_perturbations({c: clients[c].perturbation_messages[b]})}
+    for (peer, sender, other) in [(a, b, c), (c, a, b)]:
+        assert clients[peer].receive_perturbations({sender: clients[sender].perturbation_messages[peer]}) is None
+        masked[peer] = clients[peer].receive_perturbations({other: clients[other].perturbation_messages[peer]})
+    assert list(sum(masked.values()) % 1000) == [111, 222]
+
+
+def test_eager_senders_after_cut():
+    clients, public_keys = eager_clients({a: [1, 2], b: [10, 20], c: [100, 200]})
+    # c is cut before it sends its perturbations, so a and b never hear from it
+    for peer in (a, b):
+        clients[peer].create_perturbation_messages(public_keys)
+    masked = dict()
+    for (peer, sender) in [(a, b), (b, a)]:
+        assert clients[peer].receive_perturbations({sender: clients[sender].perturbation_messages[peer]}) is None
+        # until the server says who made it
+        masked[peer] = clients[peer].receive_perturbations({}, senders=[a, b])
+        assert masked[peer] is not None
+        # and only once
+        assert clients[peer].receive_perturbations({}, senders=[a, b]) is None
+    assert list(sum(masked.values()) % 1000) == [11, 22]
+
+
+def masking_client(mask_mode, monkeypatch):
+    """ Client a in a round with base 1000, whose perturbation seeds are 1, 2, ... in the order it makes them. """
+    counter = itertools.count(1)
+    monkeypatch.setattr(websocket_client_vector, "get_random_bytes",
+                        lambda num_bytes: next(counter).to_bytes(num_bytes, "big"))
+    client = SecureAggClient([1, 2, 3], SimpleNamespace(local_address=("127.0.0.1", 1)), keys=("public", "private"))
+    client.set_base(1000)
+    client.set_mask_mode(mask_mode)
+    return client
+
+
+def peer_perturbation(mask_mode, seed):
+    # what the peer sends us, decrypted
+    return seed if mask_mode == "seed" else encode_mask(expand_seed(seed, 3, 1000), 1000)
+
+
+@pytest.mark.parametrize("mask_mode, c_sends", [("vector", None), ("seed", None), ("vector", b"garbage")])
+def test_dropped_peer_same_as_never_masked(mask_mode, c_sends, monkeypatch):
+    # b's perturbation is folded in, then c is dropped: it never sends one, or sends one that doesn't decode
+    b_seed = b"b" * SEED_BYTES
+    client = masking_client(mask_mode, monkeypatch)
+    client.generate_perturbations({a: "key", b: "key", c: "key"})
+    client.fold_perturbation(b, peer_perturbation(mask_mode, b_seed))
+    if c_sends is not None:
+        client.fold_perturbation(c, c_sends)
+        assert c not in client.perturbation_seeds
+    masked = client.masked_values()
+
+    # the same client masking from scratch in a round without c
+    from_scratch = masking_client(mask_mode, monkeypatch)
+    from_scratch.generate_perturbations({a: "key", b: "key"})
+    from_scratch.fold_perturbation(b, peer_perturbation(mask_mode, b_seed))
+    assert list(masked) == list(from_scratch.masked_values())
+    assert set(client.perturbation_seeds) == set(from_scratch.perturbation_seeds) == {b}
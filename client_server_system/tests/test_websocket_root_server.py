@@ -0,0 +1,137 @@
+import asyncio
+import numpy as np
+import pytest
+import websockets
+from websocket_root_server import RootAggregator, RootLink
+from wire_format import encode, decode
+
+
+def partial_sum(values, base=1000, round_index=0):
+    return encode({"type": "partial_sum", "session": "a", "round": round_index,
+                   "value": np.array(values, dtype=np.uint64), "base": base, "num_clients": 2}, base)
+
+
+async def serve_root(root):
+    server = await websockets.serve(root.handler, "localhost", 0)
+    return server, f"ws://localhost:{server.sockets[0].getsockname()[1]}"
+
+
+def test_partial_sums_combined():
+    async def run():
+        root = RootAggregator(2)
+        server, uri = await serve_root(root)
+        async with server, websockets.connect(uri) as leaf_a, websockets.connect(uri) as leaf_b:
+            await leaf_a.send(partial_sum([1, 2, 999]))
+            await leaf_b.send(partial_sum([3, 4, 5]))
+            results = [decode(await asyncio.wait_for(leaf.recv(), 5)) for leaf in (leaf_a, leaf_b)]
+            return results, root.rounds
+
+    results, rounds = asyncio.run(run())
+    for m in results:
+        assert m["type"] == "aggregation_result"
+        assert list(m["aggregation_result"]) == [4, 6, 4]
+        assert m["num_clients"] == 4
+    assert not rounds
+
+
+@pytest.mark.parametrize("bad_partial_sum", [
+    partial_sum([3, 4, 5], base=1001),     # a different base
+    partial_sum([3, 4]),                   # a different length
+    partial_sum([3, 4, 1000]),             # out of range
+])
+def test_bad_partial_sum_drops_round(bad_partial_sum):
+    # the round can't be completed without the leaf, so both leaves are told to give up on it
+    async def run():
+        root = RootAggregator(2)
+        server, uri = await serve_root(root)
+        async with server, websockets.connect(uri) as leaf_a, websockets.connect(uri) as leaf_b:
+            await leaf_a.send(partial_sum([1, 2, 3]))
+            await leaf_b.send(bad_partial_sum)
+            replies = [decode(await asyncio.wait_for(leaf.recv(), 5)) for leaf in (leaf_a, leaf_b)]
+            return replies, root.rounds
+
+    replies, rounds = asyncio.run(run())
+    for m in replies:
+        assert m["type"] == "message"
+        assert (m["session"], m["round"]) == ("a", 0)
+    assert not rounds
+
+
+def test_round_times_out():
+    async def run():
+        root = RootAggregator(2, round_timeout=0.2)
+        server, uri = await serve_root(root)
+        async with server:
+            link = RootLink(uri)
+            try:
+                # the other leaf never sends its partial sum
+                with pytest.raises(ConnectionError, match="within 0.2 s"):
+                    await asyncio.wait_for(link.combine("a", 0, np.array([1, 2, 3], dtype=np.uint64), 1000, 2), 5)
+            finally:
+                await link.websocket.close()
+            return root.rounds
+
+    assert not asyncio.run(run())
+
+
+def test_leaf_disconnect_drops_round():
+    async def run():
+        root = RootAggregator(3)
+        server, uri = await serve_root(root)
+        async with server, websockets.connect(uri) as leaf_a:
+            async with websockets.connect(uri) as leaf_b:
+                await leaf_a.send(partial_sum([1, 2, 3]))
+                await leaf_b.send(partial_sum([1, 2, 3]))
+                await asyncio.sleep(0.1)
+            m = decode(await asyncio.wait_for(leaf_a.recv(), 5))
+            return m, root.rounds
+
+    m, rounds = asyncio.run(run())
+    assert m["type"] == "message"
+    assert "disconnected" in m["message"]
+    assert not rounds
+
+
+@pytest.mark.parametrize("uri", ["not a uri", "http://localhost:1"])
+def test_bad_root_uri(uri):
+    async def run():
+        link = RootLink(uri)
+        with pytest.raises(ConnectionError, match="Unable to reach"):
+            await link.combine("a", 0, np.array([1, 2, 3], dtype=np.uint64), 1000, 2)
+        return link
+
+    link = asyncio.run(run())
+    assert link.websocket is None and not link.pending
+
+
+def test_root_not_websocket():
+    # something is listening, but it doesn't speak websockets
+    async def answer(reader, writer):
+        await reader.readline()
+        writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(answer, "localhost", 0)
+        async with server:
+            link = RootLink(f"ws://localhost:{server.sockets[0].getsockname()[1]}")
+            with pytest.raises(ConnectionError, match="Unable to reach"):
+                await link.combine("a", 0, np.array([1, 2, 3], dtype=np.uint64), 1000, 2)
+
+    asyncio.run(run())
+
+
+def test_send_to_closed_root():
+    async def run():
+        server, uri = await serve_root(RootAggregator(2))
+        async with server:
+            link = RootLink(uri)
+            # a connection that closed before anything read from it noticed
+            link.websocket = await websockets.connect(uri)
+            await link.websocket.close()
+            with pytest.raises(ConnectionError, match="Lost the connection"):
+                await link.combine("a", 0, np.array([1, 2, 3], dtype=np.uint64), 1000, 2)
+            return link.pending
+
+    assert not asyncio.run(run())
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+import wire_format
+from wire_format import encode, decode, message_type, pack_vector, unpack_vector, encode_entry, dict_message_prefix
+
+
+@pytest.mark.parametrize("message", [
+    {"type": "message", "message": "hello"},
+    {"type": "init_base_param", "base": 2 ** 130 + 7, "mask_mode": "seed", "flag": True, "other": None,
+     "negative": -12345678901234567890, "ratio": 0.25},
+    {"type": "public_key_broadcast", "public_keys": {0: b"\x00\x01", 1: b"", 2: "pem"}},
+    {"type": "shares", "shares": {3: [b"a", b"b"], 4: []}, "survivors": [1, 2, 3]},
+])
+def test_round_trip(message):
+    assert decode(encode(message)) == message
+    assert message_type(encode(message)) == message["type"]
+
+
+@pytest.mark.parametrize("base", [2, 256, 257, 2 ** 16 + 1, 2 ** 40, 2 ** 64])
+def test_vector_round_trip(base):
+    values = np.array([0, 1, base - 1, base // 2], dtype=np.uint64)
+    m = decode(encode({"type": "value", "value": values}, base))
+    assert m["value"].tolist() == values.tolist()
+    assert unpack_vector(pack_vector(values, base)).tolist() == values.tolist()
+
+
+def test_big_vector_round_trip():
+    base = 2 ** 100
+    values = np.array([0, 1, base - 1], dtype=object)
+    m = decode(encode({"type": "value", "value": values}, base))
+    assert m["value"].tolist() == values.tolist()
+
+
+def test_dict_message_assembled_from_entries():
+    perturbations = {0: b"x", 5: np.arange(4, dtype=np.uint64)}
+    raw = dict_message_prefix("perturbations", "perturbations", len(perturbations)) + \
+        b"".join(encode_entry(sender, p) for (sender, p) in perturbations.items())
+    m = decode(raw)
+    assert m["perturbations"][0] == b"x"
+    assert m["perturbations"][5].tolist() == [0, 1, 2, 3]
+
+
+def test_unknown_message_type_rejected():
+    with pytest.raises(ValueError):
+        encode({"type": "not_a_type"})
+
+
+@pytest.mark.parametrize("message", [
+    {"type": "message", "message": "hello"},
+    {"type": "value", "value": np.arange(10, dtype=np.uint64)},
+    {"type": "init_base_param", "base": 2 ** 200},
+    {"type": "shares", "shares": {1: [b"abc"]}},
+])
+def test_truncated_rejected(message):
+    raw = encode(message)
+    for end in range(len(raw)):
+        with pytest.raises(ValueError):
+            decode(raw[:end])
+
+
+def test_trailing_bytes_rejected():
+    with pytest.raises(ValueError):
+        decode(encode({"type": "message", "message": "hello"}) + b"\x00")
+
+
+def test_deeply_nested_rejected():
+    # the message's fields are the first level
+    nested = [1]
+    for _ in range(wire_format.MAX_DEPTH - 2):
+        nested = [nested]
+    assert decode(encode({"type": "message", "message": nested}))["message"] == nested
+    with pytest.raises(ValueError):
+        decode(encode({"type": "message", "message": [nested]}))
+
+
+def test_deeply_nested_without_encoder_rejected():
+    # far deeper than the recursion limit, as a hostile sender might craft it
+    header = wire_format.HEADER.pack(wire_format.MAGIC, wire_format.VERSION, 1)
+    raw = header + (bytes([wire_format._LIST]) + (1).to_bytes(4, "little")) * 100000
+    with pytest.raises(ValueError):
+        decode(raw)
+
+
+def test_unknown_tag_rejected():
+    raw = bytearray(encode({"type": "message", "message": None}))
+    raw[-1] = 0xff
+    with pytest.raises(ValueError):
+        decode(bytes(raw))
+
+
+@pytest.mark.parametrize("header", [
+    b"XX\x01\x01",                                   # bad magic
+    wire_format.MAGIC + bytes([wire_format.VERSION + 1, 1]),  # unsupported version
+    wire_format.MAGIC + bytes([wire_format.VERSION, 0]),      # unknown message type
+    wire_format.MAGIC + bytes([wire_format.VERSION, 255]),
+])
+def test_bad_header_rejected(header):
+    with pytest.raises(ValueError):
+        decode(header + bytes([wire_format._DICT]) + bytes(4))
+    with pytest.raises(ValueError):
+        message_type(header)
+
+
+def test_unhashable_key_rejected():
+    header = wire_format.HEADER.pack(wire_format.MAGIC, wire_format.VERSION, 1)
+    # a dict with a single entry whose key is an (empty) list
+    raw = header + bytes([wire_format._DICT]) + (1).to_bytes(4, "little") + \
+        bytes([wire_format._LIST]) + bytes(4) + bytes([wire_format._NONE])
+    with pytest.raises(ValueError):
+        decode(raw)
+
+
+def test_invalid_vector_width_rejected():
+    raw = bytearray(encode({"type": "value", "value": np.arange(3, dtype=np.uint64)}))
+    # the width byte follows the field name and the VECTOR tag
+    raw[raw.index(bytes([wire_format._VECTOR, 8])) + 1] = 3
+    with pytest.raises(ValueError):
+        decode(bytes(raw))
+
+
+
+@pytest.mark.parametrize("fields", [None, 7, "value", [1, 2], np.arange(3, dtype=np.uint64)])
+def test_fields_not_a_dict_rejected(fields):
+    # a well-formed value, but not the dict of fields that every message is
+    parts = [wire_format.HEADER.pack(wire_format.MAGIC, wire_format.VERSION, 1)]
+    wire_format._encode_value(fields, parts, None)
+    with pytest.raises(ValueError):
+        decode(b"".join(parts))
@@ -1,12 +1,18 @@
 import asyncio
 import sys
+import time
 import websockets
 import argparse
-import random
-from Crypto.PublicKey import RSA
+from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
-from Crypto.Cipher import AES, PKCS1_OAEP
-import pickle
+from key_cache import default_key_cache
+from key_manager import KeyStore, default_key_pool, read_keypair
+from crypto_engine import (CryptoEngine, CRYPTO_SUITES, DEFAULT_CRYPTO_SUITE, generate_x25519_keypair,
+                           suite_encrypt, suite_decrypt)
+from wire_format import encode, decode
+from masking import (SEED_BYTES, expand_seed, generate_dh_key, derive_pairwise_seed,
+                     zero_mask, to_mask_array, add_mod, sub_mod, encode_mask, decode_mask)
+from secret_sharing import SHARE_BYTES, split_secret, pack_share, unpack_share
 
 
 class SecureAggClient:
@@ -14,25 +20,71 @@ class SecureAggClient:
     Initialized with:
         - a set of private values that will be aggregated (element-wise) with other clients
         - a websocket connection to the server
-        - a boolean indicating whether or not to generate a new RSA keypair """
+        - a boolean indicating whether or not to use a new RSA keypair (taken from key_manager.default_key_pool)
+        - (optionally) the cache of imported RSA keys to use, by default shared by all clients in the process
+        - (optionally) an RSA keypair as (public PEM, private PEM) to use instead of the one in ./keys, so
+          many clients in one process can share key material """
 
-    def __init__(self, values, connection, generate_keys=False):
+    def __init__(self, values, connection, generate_keys=False, key_cache=None, keys=None):
         # Base is received from the server
         self.base = None
-
-        # Generate RSA keys if necessary
+        # Mask mode is also received from the server ("vector", "seed" or "dh", see masking.py)
+        self.mask_mode = "vector"
+        # If the server sets a chunk size, the masked vector is uploaded in chunks of that many values
+        self.chunk_size = None
+        # How perturbations are encrypted, also received from the server (see crypto_engine.CRYPTO_SUITES)
+        self.crypto_suite = DEFAULT_CRYPTO_SUITE
+        # Whether the server relays perturbations in one bundle or forwards them as they arrive (see session.RELAY_MODES)
+        self.relay_mode = "batch"
+        # X25519 keypair, only generated when the server asks for "dh" mode
+        self.dh_key = None
+        self.dh_pub_key = None
+        # If the server sets a recovery threshold, we Shamir-share our mask secrets so the round survives dropouts
+        self.recovery_threshold = None
+        # X25519 keypair used only to encrypt shares to our peers (dropout recovery only)
+        self.share_key = None
+        self.share_pub_key = None
+        # Seed of the self-mask we add on top of the pairwise masks (dropout recovery only)
+        self.self_mask_seed = None
+        # The public keys of the cohort, from the key broadcast
+        self.public_keys = {}
+        self.share_keys = {}
+        # maps client ids -> (share of their X25519 private key, share of their self-mask seed) that they sent us
+        self.received_shares = {}
+        # whether we've answered the server's unmask request, since we only ever answer one per round
+        self.unmask_answered = False
+
+        # Get fresh RSA keys if necessary (from the shared pool, so this only waits for RSA.generate if nobody filled it)
         if generate_keys:
-            self.rsa_keys = RSA.generate(2048)
-            self.priv_key = self.rsa_keys.export_key()
-            self.pub_key = self.rsa_keys.publickey().export_key()
+            self.pub_key, self.priv_key = default_key_pool.take()
+        elif keys is not None:
+            self.pub_key, self.priv_key = keys
         else:
             self.init_keys_from_file(
                 "./keys/public.pem", "./keys/private.pem")
 
-        # Store the perturbations received from other clients
-        self.peer_perturbations = {}
-        # Store the perturbations that this client will send to other clients
+        # Imported RSA key objects and ciphers, so PEM strings are only parsed once
+        self.key_cache = key_cache if key_cache is not None else default_key_cache
+        # The keys we share with each peer under an X25519 crypto suite (see crypto_engine.pairwise_key).
+        # They're only kept for this round, so the key material goes away with the client
+        self.pairwise_keys = {}
+
+        # Running sum of the perturbations we made for our peers minus the ones they made for us (mod base).
+        # Every perturbation is folded in as soon as we have it, so we never hold more than this one vector
+        self.net_mask = None
+        # The seeds of the perturbations we made, so one can be taken back out of the net mask if its peer
+        # doesn't make it into the round
+        self.perturbation_seeds = {}
+        # The peers whose perturbations are in the net mask
+        self.received_from = set()
+        # Store the (encrypted) perturbations that this client will send to other clients
         self.perturbation_messages = {}
+        # With eager relaying: the perturbations that arrived before we could decrypt them, the clients the
+        # server says made it into the round (only sent if some were cut), and whether we've computed our
+        # masked values yet
+        self.pending_perturbations = {}
+        self.relay_senders = None
+        self.values_computed = False
         # The websocket connection to the server
         self.connection = connection
         # The client's ID, which is the IP address and port of the connection
@@ -45,131 +97,474 @@ class SecureAggClient:
     def set_base(self, base: int):
         self.base = base
 
+    def set_chunk_size(self, chunk_size):
+        self.chunk_size = chunk_size
+
+    def set_mask_mode(self, mask_mode: str):
+        self.mask_mode = mask_mode
+        if mask_mode == "dh" and self.dh_key is None:
+            self.dh_key, self.dh_pub_key = generate_dh_key()
+
+    def set_crypto_suite(self, crypto_suite: str):
+        """
+        Switch to the given crypto suite for perturbations. The X25519 suites replace our RSA keypair
+        with a fresh X25519 one. Raises ValueError for suites we don't support.
+        """
+        if crypto_suite not in CRYPTO_SUITES:
+            raise ValueError(f"Unsupported crypto suite: {crypto_suite}")
+        if crypto_suite != self.crypto_suite and crypto_suite != "rsa-oaep-eax":
+            self.pub_key, self.priv_key = generate_x25519_keypair()
+            self.pairwise_keys = {}
+        self.crypto_suite = crypto_suite
+
+    def set_relay_mode(self, relay_mode: str):
+        self.relay_mode = relay_mode
+
+    def set_recovery_threshold(self, recovery_threshold):
+        self.recovery_threshold = recovery_threshold
+        if recovery_threshold is not None and self.share_key is None:
+            self.share_key, self.share_pub_key = generate_dh_key()
+
+    def get_public_key(self):
+        """
+        The public key this client publishes: an X25519 key in "dh" mode, otherwise the key of our
+        crypto suite that peers use to encrypt perturbations for us.
+        """
+        return self.dh_pub_key if self.mask_mode == "dh" else self.pub_key
+
     def init_keys_from_file(self, pubkey_filepath, privkey_filepath):
-        with open(pubkey_filepath, "rb") as f:
-            self.pub_key = f.read()
-        with open(privkey_filepath, "rb") as f:
-            self.priv_key = f.read()
+        # only read from disk by the first client in the process
+        self.pub_key, self.priv_key = read_keypair(pubkey_filepath, privkey_filepath)
 
-    def create_perturbation_messages(self, public_key_dict):
+    def generate_perturbations(self, public_key_dict):
         """
-        Create perturbation vectors to send to each of the other clients.
-        Each message is encrypted with the public key of the recipient.
+        Generate this client's perturbation for each of the other clients in public_key_dict (with a sparse
+        masking graph, the server only sends us our neighbors' keys, so those are the only ones we mask with).
+        Returns a list of (peer, peer public key, plaintext to encrypt for that peer).
         """
 
         assert self.base is not None, "Base must be set before creating perturbations."
 
+        self.net_mask = zero_mask(self.num_values, self.base)
+        to_encrypt = []
         for peer, peer_pub_key_str in public_key_dict.items():
             if peer == self.id:
                 continue
 
-            # Generate random values for this peer and prep for encryption
-            peer_perturb_vals = [random.randint(
-                0, self.base-1) for _ in range(self.num_values)]
-            data = ",".join([str(val)
-                            for val in peer_perturb_vals]).encode("utf-8")
+            # Every perturbation is expanded from a fresh random seed
+            seed = get_random_bytes(SEED_BYTES)
+            peer_perturb_vals = expand_seed(
+                seed, self.num_values, self.base)
+            if self.mask_mode == "seed":
+                # Only send the peer the short seed; both of us expand it into the full mask locally
+                data = seed
+            else:
+                # Send the peer the full vector
+                data = encode_mask(peer_perturb_vals, self.base)
 
-            # Store the unencrypted perturbation value for this client to use when computing
-            # the value to send to the server
-            self.peer_perturbations[peer] = peer_perturb_vals
+            # Add the perturbation to our net mask right away, and only keep its seed
+            self.net_mask = add_mod(self.net_mask, peer_perturb_vals, self.base)
+            self.perturbation_seeds[peer] = seed
+            to_encrypt.append((peer, peer_pub_key_str, data))
 
-            # Use an AES session key so that we can encrypt arbitrarily large data.
-            # If we only used RSA, we'd be limited to the size of the key.
-            session_key = get_random_bytes(16)
+        return to_encrypt
 
-            # Encrypt the session key with the peer's public RSA key.
-            # Note that we're sending public keys as strings generated by the export_key
-            # method, so we need to convert them back to RSA objects.
-            peer_pub_key = RSA.import_key(peer_pub_key_str)
-            cipher_rsa = PKCS1_OAEP.new(peer_pub_key)
-            enc_session_key = cipher_rsa.encrypt(session_key)
+    def create_perturbation_messages(self, public_key_dict):
+        """
+        Create perturbation vectors to send to each of the other clients.
+        Each message is encrypted with the public key of the recipient.
+        """
+        # the X25519 suites need the senders' keys to decrypt what they send back
+        self.public_keys = public_key_dict
+        for (peer, peer_pub_key_str, data) in self.generate_perturbations(public_key_dict):
+            # Store the message that will be sent to the peer
+            self.perturbation_messages[peer] = self.encrypt_for_peer(
+                peer_pub_key_str, data)
 
-            # Encrypt the data with the AES session key
-            cipher_aes = AES.new(session_key, AES.MODE_EAX)
-            ciphertext, tag = cipher_aes.encrypt_and_digest(data)
+    async def create_perturbation_messages_parallel(self, public_key_dict, crypto_engine):
+        """
+        Same as create_perturbation_messages, but the per-peer encryptions run concurrently on the
+        crypto engine's workers instead of serially on the event loop.
+        """
+        self.public_keys = public_key_dict
+        to_encrypt = self.generate_perturbations(public_key_dict)
+        messages = await crypto_engine.map(
+            suite_encrypt, [(self.crypto_suite, self.priv_key, peer_pub_key_str, data) + self.key_cache_arg(crypto_engine)
+                            for (_, peer_pub_key_str, data) in to_encrypt])
 
-            # Store the message that will be sent to the peer
-            self.perturbation_messages[peer] = (
-                enc_session_key, cipher_aes.nonce, tag, ciphertext)
+        for ((peer, _, _), message) in zip(to_encrypt, messages):
+            self.perturbation_messages[peer] = message
+
+    def key_cache_arg(self, crypto_engine):
+        # worker processes can't share our caches (they use their own), but worker threads can
+        return () if crypto_engine.use_processes else (self.key_cache, self.pairwise_keys)
+
+    def encrypt_for_peer(self, peer_pub_key_str, data):
+        """
+        Encrypt data so that only the owner of peer_pub_key_str can read it (see crypto_engine.suite_encrypt).
+        """
+        return suite_encrypt(self.crypto_suite, self.priv_key, peer_pub_key_str, data, self.key_cache,
+                             self.pairwise_keys)
+
+    def decrypt_from_peer(self, peer_perturb_message, peer_pub_key_str=None):
+        """
+        Decrypt a message that the owner of peer_pub_key_str created with encrypt_for_peer.
+        """
+        return suite_decrypt(self.crypto_suite, self.priv_key, peer_pub_key_str, peer_perturb_message, self.key_cache,
+                             self.pairwise_keys)
 
     async def send_perturbations(self):
-        await self.connection.send(pickle.dumps({"type": "perturbations", "perturbations": self.perturbation_messages}))
+        await self.connection.send(encode({"type": "perturbations", "perturbations": self.perturbation_messages}))
+        # they're the server's problem now
+        self.perturbation_messages = {}
 
     def compute_values(self, received_peer_perturbations):
         """
         Compute the vector of masked values to send to the server.
         """
-        to_send = [0] * self.num_values
-
         for peer, peer_perturb_message in received_peer_perturbations.items():
+            if peer != self.id:
+                self.fold_perturbation(peer, self.decrypt_from_peer(peer_perturb_message, self.public_keys.get(peer)))
+        return self.masked_values()
+
+    async def compute_values_parallel(self, received_peer_perturbations, crypto_engine):
+        """
+        Same as compute_values, but the per-peer decryptions run concurrently on the crypto engine's workers.
+        """
+        peers = [peer for peer in received_peer_perturbations if peer != self.id]
+        raw_datas = await crypto_engine.map(
+            suite_decrypt, [(self.crypto_suite, self.priv_key, self.public_keys.get(peer),
+                             received_peer_perturbations[peer]) + self.key_cache_arg(crypto_engine)
+                            for peer in peers])
+        for (peer, raw_data) in zip(peers, raw_datas):
+            self.fold_perturbation(peer, raw_data)
+        return self.masked_values()
+
+    def receive_perturbations(self, received_peer_perturbations, senders=None):
+        """
+        Eager relaying: decrypt the perturbations the server forwarded to us as they arrive. senders is
+        the server's list of the clients whose perturbations made it into the round, if it sent one.
+        Returns the vector of masked values to send once we have a perturbation from every peer we're
+        waiting for, and None before that (and after).
+        """
+        for (peer, peer_perturb_message) in self.take_pending_perturbations(received_peer_perturbations, senders).items():
+            self.fold_perturbation(peer, self.decrypt_from_peer(peer_perturb_message, self.public_keys.get(peer)))
+        return self.compute_values_if_complete()
+
+    async def receive_perturbations_parallel(self, received_peer_perturbations, crypto_engine, senders=None):
+        """
+        Same as receive_perturbations, but the decryptions run on the crypto engine's workers.
+        """
+        pending = self.take_pending_perturbations(received_peer_perturbations, senders)
+        raw_datas = await crypto_engine.map(
+            suite_decrypt, [(self.crypto_suite, self.priv_key, self.public_keys.get(peer), message)
+                            + self.key_cache_arg(crypto_engine) for (peer, message) in pending.items()])
+        for (peer, raw_data) in zip(pending, raw_datas):
+            self.fold_perturbation(peer, raw_data)
+        return self.compute_values_if_complete()
+
+    def take_pending_perturbations(self, received_peer_perturbations, senders):
+        # perturbations can be forwarded to us before we've handled the key broadcast, and we need the
+        # senders' keys to decrypt them, so hold on to them until then
+        self.pending_perturbations.update({peer: peer_perturb_message for (peer, peer_perturb_message)
+                                           in received_peer_perturbations.items() if peer != self.id})
+        if senders is not None:
+            self.relay_senders = set(senders)
+        if not self.public_keys:
+            return {}
+        pending, self.pending_perturbations = self.pending_perturbations, {}
+        return pending
+
+    def compute_values_if_complete(self):
+        if self.values_computed or not self.public_keys:
+            return None
+        peers = set(self.public_keys) - {self.id}
+        if self.relay_senders is not None:
+            peers &= self.relay_senders
+        if not peers <= self.received_from:
+            return None
+        self.values_computed = True
+        return self.masked_values()
+
+    def fold_perturbation(self, peer, raw_data):
+        """
+        Subtract the (decrypted) perturbation a peer made for us from our net mask: together with the one
+        we made for them that's p_uv = s_uv - s_vu (mod base), which cancels out with the peer's p_vu.
+        """
+        if peer in self.received_from or peer not in self.perturbation_seeds:
+            return
+        self.received_from.add(peer)
+        if self.mask_mode == "seed":
+            # The peer sent us a seed, so expand it into their full mask
+            received_perturb_vals = expand_seed(
+                raw_data, self.num_values, self.base)
+        else:
+            try:
+                received_perturb_vals = decode_mask(raw_data, self.base)
+            except ValueError:
+                print(
+                    "Unable to decode recieved message. It may not be a valid list of ints.")
+                # leave this peer out of our mask altogether
+                self.drop_perturbation(peer)
+                return
+        self.net_mask = sub_mod(self.net_mask, received_perturb_vals, self.base)
+
+    def drop_perturbation(self, peer):
+        """
+        Take the perturbation we made for a peer back out of our net mask.
+        """
+        seed = self.perturbation_seeds.pop(peer)
+        self.net_mask = sub_mod(self.net_mask, expand_seed(seed, self.num_values, self.base), self.base)
+
+    def masked_values(self):
+        """
+        Add our values to the net mask. Peers we never got a perturbation from aren't in the round (their
+        perturbations were never relayed), so the ones we made for them come back out first.
+        """
+        for peer in [peer for peer in self.perturbation_seeds if peer not in self.received_from]:
+            self.drop_perturbation(peer)
+        return add_mod(self.net_mask, to_mask_array(self.values, self.base), self.base)
+
+    def compute_values_from_key_agreement(self, public_key_dict):
+        """
+        Compute the vector of masked values to send to the server in "dh" mode.
+        Each pairwise mask is expanded from a seed derived with X25519 key agreement, so no
+        perturbations have to be relayed through the server. The client with the smaller id adds
+        the mask and the other one subtracts it, so the masks cancel out in the aggregate.
+        """
+        assert self.base is not None, "Base must be set before computing values."
+
+        to_send = zero_mask(self.num_values, self.base)
+
+        for peer, peer_pub_key_str in public_key_dict.items():
             if peer == self.id:
                 continue
+
+            seed = derive_pairwise_seed(
+                self.dh_key, peer_pub_key_str, self.id, peer)
+            mask = expand_seed(seed, self.num_values, self.base)
+
+            if self.id < peer:
+                to_send = add_mod(to_send, mask, self.base)
             else:
-                # Decrypt the peer's message
-                enc_session_key, nonce, tag, ciphertext = peer_perturb_message
-                # First, decrypt the session key with the private RSA key
-                cipher_rsa = PKCS1_OAEP.new(RSA.import_key((self.priv_key)))
-                session_key = cipher_rsa.decrypt(enc_session_key)
-                # Then, decrypt the data with the AES session key
-                cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
-                raw_data = cipher_aes.decrypt_and_verify(ciphertext, tag)
-                try:
-                    received_perturb_val_str = raw_data.decode("utf-8")
-                    received_perturb_vals = [
-                        int(val) for val in received_perturb_val_str.split(",")]
-                except ValueError:
-                    print(
-                        "Unable to decode recieved message. It may not be a valid list of ints.")
-
-                # Compute the value to send to the server
-                for (idx, val) in enumerate(received_perturb_vals):
-                    s_uv = self.peer_perturbations[peer][idx]
-                    s_vu = val
-                    p_uv = (s_uv - s_vu) % self.base
-                    to_send[idx] += p_uv
-
-        return [(x + self.values[idx]) % self.base for (idx, x) in enumerate(to_send)]
+                to_send = sub_mod(to_send, mask, self.base)
+
+        return add_mod(to_send, to_mask_array(self.values, self.base), self.base)
+
+    def create_share_messages(self, public_key_dict, share_key_dict):
+        """
+        Dropout recovery: Shamir-share our X25519 private key and a fresh self-mask seed among the
+        cohort (see session.py). Peers are numbered by their position in the sorted list of client ids,
+        and each peer's pair of shares is encrypted under a key derived from our share keys.
+        """
+        assert self.recovery_threshold is not None, "Recovery threshold must be set before creating shares."
+
+        self.public_keys = public_key_dict
+        self.share_keys = share_key_dict
+        self.self_mask_seed = get_random_bytes(SEED_BYTES)
+
+        clients = sorted(public_key_dict)
+        key_shares = split_secret(
+            self.dh_key.seed, len(clients), self.recovery_threshold)
+        mask_shares = split_secret(
+            self.self_mask_seed, len(clients), self.recovery_threshold)
+
+        share_messages = {}
+        for (i, peer) in enumerate(clients):
+            if peer == self.id:
+                # we keep our own shares, and hand them over like everyone else's if the server asks
+                self.received_shares[peer] = (key_shares[i], mask_shares[i])
+                continue
+            share_messages[peer] = self.encrypt_shares(
+                peer, pack_share(key_shares[i]) + pack_share(mask_shares[i]))
+        return share_messages
+
+    def encrypt_shares(self, peer, data):
+        key = derive_pairwise_seed(
+            self.share_key, self.share_keys[peer], self.id, peer, b"shares")
+        cipher = AES.new(key, AES.MODE_EAX)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return cipher.nonce, tag, ciphertext
+
+    def decrypt_shares(self, peer, message):
+        """
+        Decrypt and parse a bundle of shares created by the peer's encrypt_shares.
+        Raises ValueError if it doesn't check out.
+        """
+        nonce, tag, ciphertext = message
+        key = derive_pairwise_seed(
+            self.share_key, self.share_keys[peer], self.id, peer, b"shares")
+        data = AES.new(key, AES.MODE_EAX, nonce).decrypt_and_verify(ciphertext, tag)
+        return unpack_share(data[:SHARE_BYTES]), unpack_share(data[SHARE_BYTES:])
+
+    def compute_values_with_recovery(self, received_shares):
+        """
+        Compute the masked vector in a dropout-tolerant round. We mask with exactly the peers whose
+        shares the server relayed to us (which are the ones the server can unmask for if they drop),
+        and add our self-mask on top.
+        """
+        for peer, message in received_shares.items():
+            try:
+                self.received_shares[peer] = self.decrypt_shares(peer, message)
+            except ValueError as e:
+                # we still have to mask with this peer, since the server counts on it
+                print(f"Unable to decrypt shares from {peer}: {e}")
+
+        to_send = self.compute_values_from_key_agreement(
+            {peer: self.public_keys[peer] for peer in received_shares})
+        self_mask = expand_seed(
+            self.self_mask_seed, self.num_values, self.base)
+        return add_mod(to_send, self_mask, self.base)
+
+    def create_unmask_shares(self, dropped, survivors):
+        """
+        Answer the server's unmask request with our shares of the dropped clients' private keys and
+        of the survivors' self-mask seeds. Raises ValueError for requests that could let the server
+        unmask an individual value: ones that ask for both kinds of share for the same client, name
+        fewer than recovery_threshold survivors, or come after we've already answered one this round
+        (a second request could name some of the first one's survivors as dropped).
+        """
+        if self.unmask_answered:
+            raise ValueError("Already answered an unmask request this round.")
+        if set(dropped) & set(survivors) or self.id in dropped:
+            raise ValueError("A client can't both have dropped out and survived.")
+        if len(set(survivors)) < self.recovery_threshold:
+            raise ValueError(f"Only {len(set(survivors))} survivors, fewer than the recovery threshold.")
+        try:
+            key_shares = {peer: list(self.received_shares[peer][0])
+                          for peer in dropped}
+            mask_shares = {peer: list(self.received_shares[peer][1])
+                           for peer in survivors}
+        except KeyError as e:
+            raise ValueError(f"No shares from client {e}")
+        self.unmask_answered = True
+        return {"type": "unmask_shares", "key_shares": key_shares, "mask_shares": mask_shares}
 
     async def send_val(self, to_send):
-        message = pickle.dumps(
-            {"type": "value", "value": to_send})
+        if self.chunk_size:
+            # stream the vector so that no single frame (or server-side buffer) has to hold all of it
+            for offset in range(0, self.num_values, self.chunk_size):
+                chunk = to_send[offset:offset + self.chunk_size]
+                await self.connection.send(encode(
+                    {"type": "value_chunk", "offset": offset, "value": chunk}, self.base))
+            return
+
+        # packed using the smallest int width that fits the base, see wire_format.py
+        message = encode(
+            {"type": "value", "value": to_send}, self.base)
         await self.connection.send(message)
 
 
-async def main(values, host, port):
-
-    async with websockets.connect(f"ws://{host}:{port}", ping_timeout=None, close_timeout=None) as websocket:
-        client = SecureAggClient(values, websocket)
+async def main(values, host, port, crypto_engine=None, session="", keys=None, timings=None):
+    """
+    Run one round of the protocol as a client. If a CryptoEngine is given, the per-peer encryption
+    and decryption runs on its workers, otherwise it runs serially on the event loop.
+    session is the path of the server session to join, optionally with session parameters
+    (e.g. "cohort-a?num_clients=10", see session.parse_session_path).
+    keys is an optional (public PEM, private PEM) RSA keypair to use instead of the one in ./keys.
+    If timings is a dict, it gets the time.perf_counter() at which we started connecting ("start"),
+    finished connecting ("connected") and first received each message type.
+    """
+    if timings is not None:
+        timings["start"] = time.perf_counter()
+
+    # max_size=None since the aggregation result is as long as our own vector, however big that is
+    async with websockets.connect(f"ws://{host}:{port}/{session}", ping_timeout=None, close_timeout=None, max_size=None) as websocket:
+        if timings is not None:
+            timings["connected"] = time.perf_counter()
+        client = SecureAggClient(values, websocket, keys=keys)
         print(f"I am Client [{client.id}]. Successfully connected to server.")
 
-        await websocket.send(pickle.dumps({"type": "public_key", "public_key": client.pub_key}))
-
         # Response to all messages received over the websocket from the server using the appropriate handler
         async for m_raw in websocket:
             try:
-                # Parse the message by unpickling
-                m = pickle.loads(m_raw)
+                # Parse the binary message (see wire_format.py)
+                m = decode(m_raw)
                 print(f"Received message of type: {m['type']}")
                 message_type = m["type"]
+                if timings is not None:
+                    timings.setdefault(message_type, time.perf_counter())
             except (TypeError, ValueError, KeyError) as e:
                 print(f"Error: {e}")
                 continue
 
             if message_type == 'public_key_broadcast':
-                # create perturbations and send to all peers
-                client.create_perturbation_messages(m['public_keys'])
-                await client.send_perturbations()
+                if client.recovery_threshold is not None:
+                    # share our secrets first, the masked value follows once the server relays everyone's shares
+                    share_messages = client.create_share_messages(
+                        m['public_keys'], m['share_keys'])
+                    await websocket.send(encode({"type": "shares", "shares": share_messages}))
+                elif client.mask_mode == "dh":
+                    # masks come straight from key agreement, so we can skip the perturbation round
+                    to_send = client.compute_values_from_key_agreement(
+                        m['public_keys'])
+                    await client.send_val(to_send)
+                else:
+                    # create perturbations and send to all peers
+                    if crypto_engine is not None:
+                        await client.create_perturbation_messages_parallel(m['public_keys'], crypto_engine)
+                    else:
+                        client.create_perturbation_messages(m['public_keys'])
+                    await client.send_perturbations()
+                    if client.relay_mode == "eager":
+                        # some of our peers' perturbations may have been forwarded to us before the keys
+                        to_send = client.receive_perturbations({})
+                        if to_send is not None:
+                            await client.send_val(to_send)
 
             elif message_type == 'init_base_param':
                 print(f"Received base parameter from server: {m['base']}")
                 client.set_base(m['base'])
+                # Older servers don't send a mask mode, in which case we use the original protocol
+                client.set_mask_mode(m.get('mask_mode', 'vector'))
+                client.set_chunk_size(m.get('chunk_size'))
+                client.set_recovery_threshold(m.get('recovery_threshold'))
+                client.set_relay_mode(m.get('relay_mode', 'batch'))
+                try:
+                    # Older servers don't send a crypto suite either
+                    client.set_crypto_suite(m.get('crypto_suite', DEFAULT_CRYPTO_SUITE))
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    return None
+                # Now that we know which kind of key the server wants, publish it
+                key_message = {"type": "public_key",
+                               "public_key": client.get_public_key()}
+                if client.recovery_threshold is not None:
+                    key_message["share_key"] = client.share_pub_key
+                await websocket.send(encode(key_message))
 
             elif message_type == 'perturbations':
-                to_send = client.compute_values(m["perturbations"])
+                if client.relay_mode == "eager":
+                    # decrypt each perturbation as it arrives, and send our value once we have them all
+                    if crypto_engine is not None:
+                        to_send = await client.receive_perturbations_parallel(
+                            m["perturbations"], crypto_engine, m.get("senders"))
+                    else:
+                        to_send = client.receive_perturbations(m["perturbations"], m.get("senders"))
+                    if to_send is not None:
+                        await client.send_val(to_send)
+                    continue
+                if crypto_engine is not None:
+                    to_send = await client.compute_values_parallel(m["perturbations"], crypto_engine)
+                else:
+                    to_send = client.compute_values(m["perturbations"])
+                await client.send_val(to_send)
+
+            elif message_type == 'shares':
+                to_send = client.compute_values_with_recovery(m['shares'])
                 await client.send_val(to_send)
 
+            elif message_type == 'unmask_request':
+                try:
+                    await websocket.send(encode(client.create_unmask_shares(m['dropped'], m['survivors'])))
+                except ValueError as e:
+                    print(f"Refusing unmask request: {e}")
+
             elif message_type == 'aggregation_result':
                 print(f"Final aggregation result 😎: {m['aggregation_result']}")
+                print(f"Key cache stats: {client.key_cache.stats()}")
+                # the round is over, so its pairwise keys are no use to anyone
+                client.pairwise_keys.clear()
                 return m['aggregation_result']
 
             elif message_type == 'message':
@@ -189,6 +584,19 @@ if __name__ == "__main__":
                         help="Hostname", type=int)
     parser.add_argument("-p", "--port",
                         help="Port", type=int)
+    parser.add_argument("-s", "--session",
+                        help="Session to join, optionally with parameters for the server e.g. 'cohort-a?num_clients=3'", type=str, default="")
+    parser.add_argument("-w", "--crypto_workers",
+                        help="Number of workers for per-peer encryption/decryption (default: 0, which runs it serially on the event loop)",
+                        type=int, default=0)
+    parser.add_argument("--key_store",
+                        help="Directory of per-identity RSA keypairs to use instead of ./keys (needs --identity)", type=str)
+    parser.add_argument("--identity",
+                        help="Name this client's keypair is stored under in the key store", type=str)
+    parser.add_argument("--max_key_uses",
+                        help="Rotate the stored keypair after it has been used for this many rounds", type=int)
+    parser.add_argument("--crypto_processes", action="store_true",
+                        help="Use a process pool instead of a thread pool for the crypto workers")
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -207,4 +615,17 @@ if __name__ == "__main__":
         print("Error: values must be a comma separated string of ints")
         exit(1)
 
-    asyncio.run(main(values, args.host, args.port))
+    keys = None
+    if args.key_store:
+        if not args.identity:
+            print("Error: --key_store needs an --identity")
+            exit(1)
+        keys = KeyStore(args.key_store, max_uses=args.max_key_uses).get(args.identity)
+
+    crypto_engine = None
+    if args.crypto_workers > 0:
+        crypto_engine = CryptoEngine(
+            args.crypto_workers, args.crypto_processes)
+
+    asyncio.run(main(values, args.host, args.port,
+                crypto_engine, args.session, keys))
@@ -0,0 +1,249 @@
+import asyncio
+import websockets
+import argparse
+import numpy as np
+from wire_format import encode, decode
+from aggregation import ModularAccumulator
+
+
+# the fields every partial_sum message has to have
+PARTIAL_SUM_FIELDS = ("session", "round", "value", "base", "num_clients")
+
+# by default, the seconds the root waits for every leaf's partial sum for a round before dropping it
+DEFAULT_ROUND_TIMEOUT = 300.0
+
+class RootAggregator:
+    """ Class representing the root of an aggregation tree.
+    Initialized with:
+        - the number of leaf servers (SecureAggServer instances started with a root) that contribute to each round
+        - (optionally) the seconds to wait for every leaf's partial sum for a round (None to wait forever)
+
+    Every leaf runs the secure aggregation protocol with its own sub-cohort of clients as usual, but
+    instead of broadcasting its aggregate it forwards it to the root as a partial_sum. Partial sums are
+    matched up by session id and round number (each leaf numbers the rounds of each session that reach the root, in order).
+    Once every leaf's partial sum for a round is in, the root adds them up modulo base and sends the
+    total back to the leaves, which pass it on to their clients.
+
+    The root never sees an individual client's value, only each leaf's sub-cohort sum (which the leaf
+    itself learns anyway).
+
+    If a leaf disconnects before a round it sent a partial sum for is complete, sends a partial sum that
+    can't be added to the others, or the round timeout passes before every leaf's is in, the root drops
+    the round and tells the leaves in it, which abort it. A partial sum that arrives after its round was
+    dropped starts the round over, and so is dropped in turn once the timeout passes. """
+
+    def __init__(self, num_leaves: int, round_timeout: float = DEFAULT_ROUND_TIMEOUT):
+        self.num_leaves = num_leaves
+        self.round_timeout = round_timeout
+        # maps (session id, round) -> the partial sums received so far for that round
+        self.rounds = dict()
+
+    async def handler(self, websocket):
+        leaf_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
+        print(f"Leaf connected: {leaf_id}")
+
+        try:
+            async for m_raw in websocket:
+                try:
+                    m = decode(m_raw)
+                    message_type = m["type"]
+                except (TypeError, ValueError, KeyError) as e:
+                    print(f"Unable to decode message from leaf {leaf_id}: {e}")
+                    continue
+
+                if message_type != "partial_sum":
+                    print(f"Received unknown message type: {message_type}")
+                    continue
+                missing = [field for field in PARTIAL_SUM_FIELDS if field not in m]
+                if missing:
+                    print(f"Dropping partial sum from leaf {leaf_id}: missing {', '.join(missing)}")
+                    await websocket.send(encode({"type": "message", "session": m.get("session"), "round": m.get("round"),
+                                                 "message": f"Partial sum is missing {', '.join(missing)}."}))
+                    continue
+
+                await self.add_partial_sum(websocket, leaf_id, m)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            print(f"Leaf disconnected: {leaf_id}")
+            await self.drop_leaf(websocket, leaf_id)
+
+    async def add_partial_sum(self, websocket, leaf_id, m):
+        if not (isinstance(m["session"], str) and isinstance(m["round"], int) and isinstance(m["base"], int)
+                and isinstance(m["value"], np.ndarray) and isinstance(m["num_clients"], int)):
+            print(f"Dropping partial sum from leaf {leaf_id}: malformed fields")
+            await websocket.send(encode({"type": "message", "session": m["session"], "round": m["round"],
+                                         "message": "Partial sum has malformed fields."}))
+            return
+
+        key = (m["session"], m["round"])
+        pending = self.rounds.get(key)
+        if pending is None:
+            pending = {"agg": ModularAccumulator(len(m["value"]), m["base"]), "base": m["base"],
+                       "leaves": [], "num_clients": 0, "expiry": None}
+            self.rounds[key] = pending
+            if self.round_timeout is not None:
+                pending["expiry"] = asyncio.create_task(self.expire_round(key, pending))
+
+        if websocket in pending["leaves"]:
+            # the first one has already been added to the total
+            print(f"Dropping second partial sum for [{key[0]}] round {key[1]} from leaf {leaf_id}")
+            return
+        if m["base"] != pending["base"]:
+            self.drop_round(key, f"Leaf {leaf_id} sent a partial sum mod {m['base']} instead of {pending['base']}.",
+                            [websocket])
+            return
+        try:
+            pending["agg"].add(m["value"])
+        except ValueError as e:
+            # the round can't be completed without this leaf
+            self.drop_round(key, f"Leaf {leaf_id} sent a bad partial sum: {e}", [websocket])
+            return
+        pending["leaves"].append(websocket)
+        pending["num_clients"] += m["num_clients"]
+        print(f"Received partial sum for [{key[0]}] round {key[1]} from leaf {leaf_id} "
+              f"({len(pending['leaves'])}/{self.num_leaves})")
+
+        if len(pending["leaves"]) == self.num_leaves:
+            del self.rounds[key]
+            if pending["expiry"] is not None:
+                pending["expiry"].cancel()
+            result = pending["agg"].result()
+            print(f"✨🔐 ROOT AGGREGATION [{key[0]}] round {key[1]} 🔐✨ ({pending['num_clients']} clients)\n"
+                  f"✨🔐    Result: {result}     🔐✨\n")
+            message = encode({"type": "aggregation_result", "aggregation_result": result, "session": key[0],
+                              "round": key[1], "num_clients": pending["num_clients"]}, pending["base"])
+            websockets.broadcast(pending["leaves"], message)
+
+    async def drop_leaf(self, websocket, leaf_id):
+        """
+        Forget the rounds a leaf that disconnected had sent a partial sum for, since it will never get
+        their total, and tell the other leaves in them to give up on those rounds.
+        """
+        for key in [key for (key, pending) in self.rounds.items() if websocket in pending["leaves"]]:
+            self.drop_round(key, f"Leaf {leaf_id} disconnected before the round was complete.")
+
+    async def expire_round(self, key, pending):
+        await asyncio.sleep(self.round_timeout)
+        if self.rounds.get(key) is pending:
+            self.drop_round(key, f"Not every leaf sent its partial sum within {self.round_timeout} s.")
+
+    def drop_round(self, key, reason, also_tell=()):
+        """
+        Forget a round that can't be completed and tell the leaves that sent a partial sum for it (and
+        those in also_tell) to give up on it.
+        """
+        pending = self.rounds.pop(key, None)
+        leaves = list(also_tell)
+        if pending is not None:
+            if pending["expiry"] is not None and pending["expiry"] is not asyncio.current_task():
+                pending["expiry"].cancel()
+            leaves += [leaf for leaf in pending["leaves"] if leaf not in leaves]
+        print(f"Dropping [{key[0]}] round {key[1]}: {reason}")
+        # leaves that have disconnected are skipped
+        websockets.broadcast(leaves, encode({"type": "message", "session": key[0], "round": key[1],
+                                             "message": reason}))
+
+
+class RootLink:
+    """ A leaf server's connection to the root aggregator.
+    Initialized with:
+        - the websocket URI of the root (e.g. ws://localhost:8000)
+
+    The connection is opened on first use and shared by all of the leaf's sessions. """
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.websocket = None
+        # maps (session id, round) -> future for the root's result
+        self.pending = dict()
+        self.lock = asyncio.Lock()
+        # the task reading the root's results off the current connection (the loop only keeps a weak reference)
+        self.reader_task = None
+
+    async def combine(self, session_id: str, round_index: int, partial_sum, base: int, num_clients: int):
+        """
+        Send this leaf's partial sum for a round to the root and wait for the total over all leaves.
+        Returns (total, number of clients across all leaves). Raises ConnectionError if the root goes away
+        or drops the round.
+        """
+        websocket = await self.connect()
+        waiter = asyncio.get_running_loop().create_future()
+        try:
+            self.pending[(session_id, round_index)] = waiter
+            try:
+                await websocket.send(encode({"type": "partial_sum", "session": session_id, "round": round_index,
+                                             "value": partial_sum, "base": base, "num_clients": num_clients}, base))
+            except websockets.ConnectionClosed as e:
+                raise ConnectionError(f"Lost the connection to the root aggregator: {e}")
+            return await waiter
+        finally:
+            self.pending.pop((session_id, round_index), None)
+
+    async def connect(self):
+        async with self.lock:
+            if self.websocket is None:
+                try:
+                    self.websocket = await websockets.connect(self.uri, max_size=None)
+                except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake, websockets.InvalidURI) as e:
+                    raise ConnectionError(f"Unable to reach the root aggregator at {self.uri}: {e}")
+                self.reader_task = asyncio.create_task(self.read_results(self.websocket))
+            return self.websocket
+
+    async def read_results(self, websocket):
+        try:
+            async for m_raw in websocket:
+                try:
+                    m = decode(m_raw)
+                except ValueError as e:
+                    print(f"Unable to decode message from the root: {e}")
+                    continue
+                waiter = self.pending.get((m.get("session"), m.get("round")))
+                if waiter is None or waiter.done():
+                    continue
+                if m["type"] == "aggregation_result":
+                    waiter.set_result((m["aggregation_result"], m["num_clients"]))
+                elif m["type"] == "message":
+                    # the root gave up on the round
+                    waiter.set_exception(ConnectionError(f"The root aggregator dropped the round: {m['message']}"))
+        except websockets.ConnectionClosed:
+            pass
+
+        # the connection is gone, so nothing that's still waiting will ever hear back
+        self.websocket = None
+        for waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError("Lost the connection to the root aggregator."))
+
+
+async def main(num_leaves, host, port, round_timeout=DEFAULT_ROUND_TIMEOUT):
+    root = RootAggregator(num_leaves, round_timeout)
+    async with websockets.serve(root.handler, host, port, max_size=None):
+        await asyncio.Future()  # run forever
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-l", "--num_leaves",
+                        help="Number of leaf servers that contribute to each round", type=int)
+    parser.add_argument("-h", "--host",
+                        help="Hostname", type=str)
+    parser.add_argument("-p", "--port",
+                        help="Port", type=int)
+    parser.add_argument("-t", "--round_timeout",
+                        help=f"Drop a round if not every leaf sends its partial sum within this many seconds, 0 to wait forever (default: {DEFAULT_ROUND_TIMEOUT:g})",
+                        type=float, default=DEFAULT_ROUND_TIMEOUT)
+    args = parser.parse_args()
+
+    if not args.num_leaves:
+        print("No leaf count specified, defaulting to 2")
+        args.num_leaves = 2
+    if not args.host:
+        print("No host specified, defaulting to localhost")
+        args.host = "localhost"
+    if not args.port:
+        print("No port specified, defaulting to 8000")
+        args.port = 8000
+
+    print(f"Running root aggregator on {args.host}:{args.port} with {args.num_leaves} leaves")
+    asyncio.run(main(args.num_leaves, args.host, args.port, args.round_timeout or None))
@@ -1,147 +1,290 @@
 import asyncio
 import websockets
 import argparse
+import resource
 import sys
-import pickle
-import copy
+from collections import deque
+from masking import MASK_MODES
+from crypto_engine import CRYPTO_SUITES, DEFAULT_CRYPTO_SUITE
+from wire_format import encode
+from websocket_root_server import RootLink
+from metrics import ServerMetrics, serve_metrics
+from session import (AggregationSession, RELAY_MODES, DEFAULT_RELAY_PARALLELISM, DEFAULT_SESSION_LIMITS,
+                     parse_session_path, parse_deadlines, check_session_params, request_path, max_message_size)
 
 
 class SecureAggServer:
     """ Class representing the server in the secure aggregation protocol.
     Initialized with:
         - the number of clients that will participate in the protocol
-        - the cryptographic value that will be used in modular arithmetic for maksing values """
-
-    def __init__(self, client_threshold: int, base: int, num_values: int):
-        # wait for this many clients to connect before running protocol
-        self.client_threshold = client_threshold
-        # maps client ids -> websocket connection
-        self.connections = dict()
-        # maps client ids -> client public keys
-        self.pub_keys = dict()
-        # the number of values each client has
-        self.num_values = num_values
-        # the cryptographic value that will be used in modular arithmetic
-        self.base = base
-        # nested dict: to_receive -> {perturbation_creator -> perturbation}
-        self.perturbations = dict()
-        # counter for number of perturbations received so far
-        self.num_perturbation_received = 0
-
-        # the final aggregation result
-        self.agg = [0] * self.num_values
-        # the number of value vectors received so far
-        self.received_value_count = 0
+        - the cryptographic value that will be used in modular arithmetic for maksing values
+        - the number of values in each client's vector
+        - the mask mode clients should use ("vector", "seed" or "dh", see masking.py)
+        - (optionally) the number of coordinates per chunk if clients should stream their values in chunks
+        - (optionally) the maximum number of sessions that can be in flight at once
+        - (optionally) a boolean indicating whether clients that arrive when their session is full should
+          wait for the next cohort instead of being turned away
+        - (optionally) a Shamir threshold that makes rounds tolerate dropouts, as long as that many clients
+          survive ("dh" mode only, see session.py)
+        - (optionally) a dict mapping phases to how many seconds clients get to finish them, after which
+          stragglers are cut from the round (see session.PHASES)
+        - (optionally) the fewest clients a round may continue with after stragglers are cut
+        - (optionally) the number of neighbors each client masks with in a sparse masking graph (default: everyone)
+        - (optionally) the number of worker processes each session splits the coordinates of its aggregate across
+        - (optionally) the URI of a root aggregator (websocket_root_server.py) to run as a leaf of an aggregation tree
+        - (optionally) a file to append a JSON line to for every round that ends (see log_round)
+        - (optionally) the crypto suite clients encrypt perturbations with (see crypto_engine.CRYPTO_SUITES)
+        - (optionally) the most perturbation bundles a session sends at once
+        - (optionally) the seconds a client's connection gets to take its perturbation bundle before the round is aborted
+        - (optionally) whether to relay perturbations in one bundle per client once they're all in, or
+          forward them as they arrive (see session.RELAY_MODES)
+        - (optionally) the directory sessions keep perturbations waiting to be relayed in (see relay_store.py)
+        - (optionally) a dict mapping session parameters to the largest value clients may ask for
+          (default: session.DEFAULT_SESSION_LIMITS)
+
+    The server keeps metrics on its traffic, clients and rounds (see metrics.py), which main can
+    serve over HTTP in the Prometheus text format.
+
+    The server can run several independent cohorts ("sessions", see session.py) at the same time.
+    Clients pick their session with the path they connect to (e.g. ws://host:port/cohort-a), and the
+    client that creates a session can override the parameters above for it in the query string.
+    Clients that connect to the root path all end up in the "default" session.
+
+    As a leaf of an aggregation tree, the server runs the protocol with its own clients as usual, but
+    forwards each session's aggregate to the root and broadcasts the total over all leaves instead. """
+
+    def __init__(self, client_threshold: int, base: int, num_values: int, mask_mode: str = "vector", chunk_size: int = None,
+                 max_sessions: int = 16, queue_clients: bool = False, recovery_threshold: int = None,
+                 deadlines: dict = None, min_survivors: int = None, num_neighbors: int = None,
+                 aggregation_workers: int = None, root: str = None, round_log: str = None,
+                 crypto_suite: str = DEFAULT_CRYPTO_SUITE, relay_parallelism: int = DEFAULT_RELAY_PARALLELISM,
+                 send_timeout: float = None, relay_mode: str = "batch", relay_dir: str = None,
+                 session_limits: dict = None):
+        # the parameters new sessions get unless the client creating them asks for something else
+        self.session_defaults = {"num_clients": client_threshold, "base": base, "num_values": num_values,
+                                 "mask_mode": mask_mode, "chunk_size": chunk_size,
+                                 "recovery_threshold": recovery_threshold, "num_neighbors": num_neighbors,
+                                 "crypto_suite": crypto_suite, "relay_mode": relay_mode}
+        # the largest session parameters a client may ask for, so that one client can't make us allocate
+        # an arbitrary amount of memory
+        self.session_limits = session_limits if session_limits is not None else DEFAULT_SESSION_LIMITS
+        # cap on the number of sessions in flight at once
+        self.max_sessions = max_sessions
+        # maps session ids -> session that new clients with that id join
+        self.sessions = dict()
+        # per-phase deadlines and the minimum-survivors floor, which apply to every session
+        self.deadlines = deadlines
+        self.min_survivors = min_survivors
+        # how many perturbation bundles each session sends at once, and how long each client's socket gets to take one
+        self.relay_parallelism = relay_parallelism
+        self.send_timeout = send_timeout
+        # where sessions keep the perturbations waiting to be relayed (see relay_store.py)
+        self.relay_dir = relay_dir
+        # number of processes each session adds up vectors with (None adds them up on the event loop)
+        self.aggregation_workers = aggregation_workers
+        # connection to the root aggregator if this server is a leaf of an aggregation tree
+        self.root_link = RootLink(root) if root else None
+        # maps session ids -> number of rounds numbered for that id, which the root matches leaves' sums up by
+        self.round_counts = dict()
+        # counters and histograms for every session, which also append round summaries to round_log if it's set
+        self.metrics = ServerMetrics(round_log)
+        # whether to keep clients waiting for the next cohort when their session is full
+        self.queue_clients = queue_clients
+        # maps session ids -> queue of (session params, future, socket) for clients waiting for the next cohort, in arrival order
+        self.waiting = dict()
 
     async def handler(self, websocket):
-        # Turn away new connections if we already have enough clients
-        if len(self.connections) >= self.client_threshold:
-            await websocket.send(pickle.dumps({"type": "message", "message": "Enough clients have already connected."}))
+        try:
+            session_id, params = parse_session_path(request_path(websocket), self.session_limits)
+            check_session_params({**self.session_defaults, **params})
+        except ValueError as e:
+            await websocket.send(encode({"type": "message", "message": f"Invalid session request: {e}"}))
             return
 
-        # Store new connection
-        user_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
-        print(f"Received connection from client: {user_id}")
-        self.connections[user_id] = websocket
-
-        # Send the client the base for this session
-        await websocket.send(pickle.dumps({"type": "init_base_param", "base": self.base}))
+        session = await self.admit(websocket, session_id, params)
+        if session is None:
+            return
 
-        # This big try block handles the client when it's connected, and the finally block
-        # removes it from the connections dict when it disconnects.
         try:
-            # For each message received over this socket
-            async for m_raw in websocket:
-                try:
-                    # Try to unpickle the message
-                    m = pickle.loads(m_raw)
-                    message_type = m["type"]
-                except (TypeError, ValueError, KeyError) as e:
-                    print(f"Unable to decode message: {m_raw}")
-                    print(f"Error: {e}")
-                    continue
-
-                if message_type == "public_key":
-                    print(f"Received public key from client {user_id}")
-
-                    # store the pub key
-                    self.pub_keys[user_id] = m["public_key"]
-
-                    # if this was the last one we needed, initialize perturbations dict with all client ids
-                    # and broadcast all public keys
-                    if len(self.pub_keys) == self.client_threshold:
-                        for peer_id in self.pub_keys:
-                            self.perturbations[peer_id] = dict()
-
-                        print("Broadcasting public keys.")
-                        await self.broadcast({"type": "public_key_broadcast", "public_keys": self.pub_keys})
-
-                if message_type == "perturbations":
-                    print(f"Received perturbations from client {user_id}")
-                    self.num_perturbation_received += 1
-
-                    for peer, perturbation_message in m["perturbations"].items():
-                        self.perturbations[peer][user_id] = perturbation_message
-
-                    # if we've received all perturbations, send each client their appropriate set of perturbations
-                    if self.num_perturbation_received == self.client_threshold:
-                        print("Received all perturbations.")
-                        for peer_id, peer_generated_perturbations in self.perturbations.items():
-                            await self.message_user(peer_id, pickle.dumps({"type": "perturbations", "perturbations": peer_generated_perturbations}))
-
-                if message_type == "value":
-                    print(f"Received value {m['value']} from client {user_id}")
-
-                    for (idx, x) in enumerate(m['value']):
-                        self.agg[idx] += x
-
-                    self.received_value_count += 1
-
-                    if self.received_value_count == self.client_threshold:
-                        for (idx, x) in enumerate(self.agg):
-                            self.agg[idx] = self.agg[idx] % self.base
-                        print(
-                            f"✨🔐 SECURE AGGREGATION 🔐✨ \n✨🔐    Result: {self.agg}     🔐✨\n")
-                        await self.broadcast({"type": "aggregation_result", "aggregation_result": self.agg})
-                        print("Resetting server state.")
-                        await self.close_connections_and_reset()
-                        print("Ready for new session.\n", "*"*8, "\n")
-
-            await websocket.wait_closed()
-
+            await session.handler(websocket)
+        finally:
+            self.release(session)
+
+    def release(self, session):
+        """
+        Called when one of a session's clients is gone. Forgets about the session once nobody is left in
+        it (unless it's already been replaced), and lets waiting clients into the spot that opened up.
+        """
+        # until the round starts, clients that were let in from the queue count towards num_admitted
+        # before they show up in the session's connections
+        if (not session.connections and self.sessions.get(session.id) is session
+                and (session.started or session.finished or not session.num_admitted)):
+            del self.sessions[session.id]
+            # without this, a pending deadline would still fire and log an aborted round nobody is in
+            session.discard()
+            print(f"Removed session [{session.id}] ({len(self.sessions)} in flight).")
+        # this client's spot (or the whole session) may have just opened up for someone who's waiting
+        self.admit_waiting(session.id)
+
+    async def admit(self, websocket, session_id, params):
+        """
+        Decide which session a new client joins. Returns None if the client was turned away.
+        If the session is full and queueing is on, this waits until the client gets into a later cohort.
+        """
+        session = self.open_session(session_id, params)
+        if session is None:
+            await websocket.send(encode({"type": "message", "message": "Too many sessions in flight."}))
+            return None
+
+        # only skip the line if there is no line
+        if session.has_room() and not self.waiting.get(session_id):
+            session.admit()
+            return session
+
+        if not self.queue_clients:
+            # Turn away new connections if we already have enough clients
+            await websocket.send(encode({"type": "message", "message": "Enough clients have already connected."}))
+            return None
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self.waiting.setdefault(session_id, deque())
+        queue.append((params, waiter, websocket))
+        # stop waiting if the client hangs up before it gets in, so it doesn't hold up the line
+        closed = asyncio.ensure_future(websocket.wait_closed())
+        try:
+            await websocket.send(encode({"type": "message",
+                                         "message": f"Session is full, you are number {len(queue)} in line for the next cohort."}))
+            print(f"[{session_id}] Queued client ({len(queue)} waiting).")
+            await asyncio.wait([waiter, closed], return_when=asyncio.FIRST_COMPLETED)
+            if waiter.done():
+                # even if the client just left, the session has counted it in, and its handler lets it back out
+                return waiter.result()
+            print(f"[{session_id}] Queued client left before it got in.")
+            waiter.cancel()
+            return None
         finally:
-            if user_id in self.connections:
-                del self.connections[user_id]
-
-    async def broadcast(self, unpickled_payload):
-        message = pickle.dumps(unpickled_payload)
-        websockets.broadcast(
-            self.connections.values(), message)
-
-    async def message_user(self, user_id, message):
-        # raises KeyError if user disconnected
-        websocket = self.connections[user_id]
-        await websocket.send(message)  # may raise websockets.ConnectionClosed
-
-    async def close_connections_and_reset(self):
-        # have to make a copy since you can't modify the dict while iterating over it
-        connections_to_close = copy.copy(list(self.connections.values()))
-
-        for connection in connections_to_close:
-            # note: closing connection also removes it from the dict thanks to the finally clause above
-            await connection.close()
-
-        self.connections = dict()
-        self.pub_keys = dict()
-        self.perturbations = dict()
-        self.num_perturbation_received = 0
-        self.agg = [0] * self.num_values
-        self.received_value_count = 0
-
-
-async def main(client_threshold, num_values, base, host, port):
-    server = SecureAggServer(client_threshold, base, num_values)
-    async with websockets.serve(server.handler, host, port):
+            closed.cancel()
+            if (params, waiter, websocket) in queue:
+                queue.remove((params, waiter, websocket))
+
+    def admit_waiting(self, session_id):
+        """
+        Move waiting clients (in arrival order) into the session for session_id while it has room,
+        starting a fresh session once the current one has finished.
+        """
+        queue = self.waiting.get(session_id)
+        while queue:
+            params, waiter, websocket = queue[0]
+            if waiter.done() or websocket.state is not websockets.State.OPEN:
+                # the client gave up or hung up while it was waiting
+                queue.popleft()
+                continue
+
+            session = self.open_session(session_id, params)
+            if session is None or not session.has_room():
+                break
+
+            queue.popleft()
+            session.admit()
+            waiter.set_result(session)
+
+        if queue is not None and not queue:
+            del self.waiting[session_id]
+
+    def open_session(self, session_id, params):
+        """
+        The session that new clients with this id should join, creating it if there isn't one (or
+        the last one has finished). Returns None if that would go over the session cap.
+        """
+        session = self.sessions.get(session_id)
+        if session is not None and not session.finished:
+            return session
+
+        # Replacing a finished session doesn't change how many are in flight, but starting a new one does
+        if session is None and len(self.sessions) >= self.max_sessions:
+            return None
+
+        session = self.create_session(session_id, params)
+        self.sessions[session_id] = session
+        print(f"Started session [{session_id}] ({len(self.sessions)} in flight).")
+        return session
+
+    def create_session(self, session_id, params):
+        session_params = {**self.session_defaults, **params}
+        session = AggregationSession(session_id, session_params["num_clients"], session_params["base"],
+                                     session_params["num_values"], session_params["mask_mode"],
+                                     session_params["chunk_size"], session_params["recovery_threshold"],
+                                     self.deadlines, self.min_survivors, session_params["num_neighbors"],
+                                     self.aggregation_workers, session_params["crypto_suite"],
+                                     self.relay_parallelism, self.send_timeout, session_params["relay_mode"],
+                                     self.relay_dir)
+        if self.root_link is not None:
+            session.forward_result = self.forward_to_root
+        session.metrics = self.metrics
+        session.on_round_end = self.log_round
+        return session
+
+    def log_round(self, session):
+        """
+        Record a session's round summary (see AggregationSession.round_summary) in the metrics and the
+        round log, along with the server process's peak resident set size so far.
+        """
+        if self.root_link is None:
+            self.number_round(session)
+        summary = session.round_summary()
+        summary["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.metrics.round_ended(summary)
+
+    def number_round(self, session):
+        """
+        Give a session's round the next number for its session id, unless it already has one. Leaves of
+        an aggregation tree only number the rounds that reach the root, so that leaves whose rounds
+        fail (or never start) stay in step with the others. Other servers number the rounds that end.
+        """
+        if session.round_index is None:
+            session.round_index = self.round_counts.get(session.id, 0)
+            self.round_counts[session.id] = session.round_index + 1
+
+    def render_metrics(self):
+        gauges = {
+            "sessions_in_flight": ("Sessions currently in flight.", len(self.sessions)),
+            "clients_connected": ("Clients currently connected to a session.",
+                                  sum(len(session.connections) for session in self.sessions.values())),
+            "clients_waiting": ("Clients queued for the next cohort of their session.",
+                                sum(len(queue) for queue in self.waiting.values())),
+            "max_rss_kb": ("Peak resident set size of the server process.",
+                           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        }
+        return self.metrics.render(gauges)
+
+    async def forward_to_root(self, session, result):
+        """
+        Swap a session's aggregate for the total over every leaf of the aggregation tree.
+        """
+        self.number_round(session)
+        print(f"[{session.id}] Forwarding round {session.round_index} to the root.")
+        return await self.root_link.combine(session.id, session.round_index, result, session.base,
+                                            len(session.value_senders))
+
+
+async def main(client_threshold, num_values, base, host, port, mask_mode="vector", chunk_size=None, max_sessions=16,
+               queue_clients=False, recovery_threshold=None, deadlines=None, min_survivors=None, num_neighbors=None,
+               aggregation_workers=None, root=None, round_log=None, metrics_port=None,
+               crypto_suite=DEFAULT_CRYPTO_SUITE, relay_parallelism=DEFAULT_RELAY_PARALLELISM, send_timeout=None,
+               relay_mode="batch", relay_dir=None, session_limits=None, max_size=None):
+    server = SecureAggServer(client_threshold, base,
+                             num_values, mask_mode, chunk_size, max_sessions, queue_clients, recovery_threshold,
+                             deadlines, min_survivors, num_neighbors, aggregation_workers, root, round_log,
+                             crypto_suite, relay_parallelism, send_timeout, relay_mode,
+                             relay_dir, session_limits)
+    # frames are read in full before we know who sent them, so cap them at the biggest one a client
+    # needs to send for the session parameters it may ask for (0 means no cap)
+    max_size = max_size if max_size is not None else max_message_size(server.session_limits)
+    async with websockets.serve(server.handler, host, port, max_size=max_size or None):
+        if metrics_port:
+            # only reachable from this machine
+            print(f"Serving metrics at http://localhost:{metrics_port}/metrics")
+            await serve_metrics(server.render_metrics, "localhost", metrics_port)
         await asyncio.Future()  # run forever
 
 
@@ -157,6 +300,61 @@ if __name__ == "__main__":
                         help="Port", type=int)
     parser.add_argument("-v", "--value_count",
                         help="Number of values", type=int)
+    parser.add_argument("-m", "--mask_mode",
+                        help="How clients exchange masks: 'vector' (full perturbation vectors), 'seed' (short seeds expanded locally) or 'dh' (seeds from X25519 key agreement, no perturbation round)",
+                        type=str, choices=MASK_MODES)
+    parser.add_argument("-e", "--crypto_suite",
+                        help="How clients encrypt perturbations for each other in 'vector' and 'seed' modes (default: rsa-oaep-eax)",
+                        type=str, choices=CRYPTO_SUITES, default=DEFAULT_CRYPTO_SUITE)
+    parser.add_argument("-c", "--chunk_size",
+                        help="Have clients stream their masked vectors in chunks of this many values (default: one message)", type=int)
+    parser.add_argument("-s", "--max_sessions",
+                        help="Maximum number of sessions (cohorts) in flight at once", type=int)
+    parser.add_argument("-q", "--queue", action="store_true",
+                        help="Keep clients that arrive when their session is full waiting for the next cohort instead of turning them away")
+    parser.add_argument("-t", "--recovery_threshold",
+                        help="Let rounds finish despite dropouts as long as this many clients survive (needs -m dh)", type=int)
+    parser.add_argument("-d", "--deadline", action="append", default=[],
+                        help="Seconds clients get for a phase before stragglers are cut, as phase=seconds (phases: keys, perturbations, shares, values, unmask, forward). Can be repeated.")
+    parser.add_argument("-k", "--num_neighbors",
+                        help="Have each client mask with only this many pseudo-randomly chosen neighbors instead of every other client (O(log n) is enough, e.g. 2*log2(n))", type=int)
+    parser.add_argument("-w", "--aggregation_workers",
+                        help="Split the coordinates of each aggregate across this many worker processes (for very long vectors)", type=int)
+    parser.add_argument("-r", "--root",
+                        help="Run as a leaf of an aggregation tree, forwarding every aggregate to the root aggregator at this URI (e.g. ws://localhost:8000)", type=str)
+    parser.add_argument("-l", "--round_log",
+                        help="Append a JSON line with the phase timings, traffic and outcome of every round to this file", type=str)
+    parser.add_argument("--metrics_port",
+                        help="Serve metrics in the Prometheus text format at http://localhost:<port>/metrics", type=int)
+    parser.add_argument("--relay_mode",
+                        help="'batch' relays each client's perturbations in one bundle once everyone's are in, 'eager' forwards each one as soon as it arrives (default: batch)",
+                        type=str, choices=RELAY_MODES, default="batch")
+    parser.add_argument("--relay_dir",
+                        help="Directory to keep perturbations in while they wait to be relayed (default: the system's temporary directory)",
+                        type=str)
+    parser.add_argument("--relay_parallelism",
+                        help=f"Send at most this many clients their perturbations at once (default: {DEFAULT_RELAY_PARALLELISM})",
+                        type=int, default=DEFAULT_RELAY_PARALLELISM)
+    parser.add_argument("--send_timeout",
+                        help="Abort a round if a client's connection doesn't take its perturbations within this many seconds (default: wait)",
+                        type=float)
+    parser.add_argument("--max_clients",
+                        help=f"Largest num_clients a client may ask for in its session path (default: {DEFAULT_SESSION_LIMITS['num_clients']})",
+                        type=int, default=DEFAULT_SESSION_LIMITS["num_clients"])
+    parser.add_argument("--max_values",
+                        help=f"Largest num_values a client may ask for in its session path (default: {DEFAULT_SESSION_LIMITS['num_values']})",
+                        type=int, default=DEFAULT_SESSION_LIMITS["num_values"])
+    parser.add_argument("--max_base",
+                        help="Largest base a client may ask for in its session path (default: 2^256)",
+                        type=int, default=DEFAULT_SESSION_LIMITS["base"])
+    parser.add_argument("--max_chunk_size",
+                        help=f"Largest chunk_size a client may ask for in its session path (default: {DEFAULT_SESSION_LIMITS['chunk_size']})",
+                        type=int, default=DEFAULT_SESSION_LIMITS["chunk_size"])
+    parser.add_argument("--max_message_size",
+                        help="Largest message in bytes a client may send, 0 for no limit (default: enough for a value message within the limits above; 'vector' mode perturbations for long vectors may need more)",
+                        type=int)
+    parser.add_argument("--min_survivors",
+                        help="Abort a round rather than continue with fewer than this many clients after cutting stragglers (default: the recovery threshold, or 2)", type=int)
 
     args = parser.parse_args()
 
@@ -175,7 +373,32 @@ if __name__ == "__main__":
     if not args.value_count:
             print("No value count specified, defaulting to 5")
             args.value_count = 5
+    if not args.max_sessions:
+        print("No session cap specified, defaulting to 16")
+        args.max_sessions = 16
+    if not args.mask_mode:
+        print("No mask mode specified, defaulting to vector")
+        args.mask_mode = "vector"
+
+    try:
+        check_session_params({"num_clients": args.num_clients, "mask_mode": args.mask_mode,
+                              "chunk_size": args.chunk_size, "recovery_threshold": args.recovery_threshold,
+                              "num_neighbors": args.num_neighbors})
+        deadlines = parse_deadlines(args.deadline)
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+
+    # every client holds a socket open, and in "batch" relay mode a file for its perturbations too
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
 
     print(
         f"Running server on {args.host}:{args.port} with client_threshold = {args.num_clients} ")
-    asyncio.run(main(args.num_clients, args.value_count, args.base, args.host, args.port))
+    asyncio.run(main(args.num_clients, args.value_count,
+                args.base, args.host, args.port, args.mask_mode, args.chunk_size, args.max_sessions, args.queue,
+                args.recovery_threshold, deadlines, args.min_survivors, args.num_neighbors,
+                args.aggregation_workers, args.root, args.round_log, args.metrics_port, args.crypto_suite,
+                args.relay_parallelism, args.send_timeout, args.relay_mode, args.relay_dir,
+                {"num_clients": args.max_clients, "num_values": args.max_values, "base": args.max_base,
+                 "chunk_size": args.max_chunk_size}, args.max_message_size))
@@ -0,0 +1,297 @@
+import struct
+import numpy as np
+
+
+"""
+
+Versioned binary framing for the messages exchanged by websocket_client_vector.py and websocket_server_vector.py.
+
+Every message starts with a fixed header:
+
+    magic (2 bytes, b"SA") | version (u8) | message type (u8)
+
+followed by the remaining fields of the message dict, encoded as tagged values (all integers little-endian):
+
+    NONE / FALSE / TRUE                        tag only
+    INT     u16 length | signed integer        (arbitrary size, so huge bases work)
+    FLOAT   f64
+    BYTES   u32 length | raw bytes
+    STR     u32 length | utf-8
+    LIST    u32 count  | values                (tuples are sent as lists)
+    DICT    u32 count  | key, value, key, value...
+    VECTOR  u8 width   | u32 count | count packed unsigned ints of `width` bytes (1, 2, 4 or 8)
+    BIGVEC  u16 width  | u32 count | count packed unsigned ints of `width` bytes (for bases > 64 bits)
+
+Numpy arrays are packed with the smallest width that can hold base-1, and VECTOR fields are decoded
+with np.frombuffer as a read-only view of the received message, so nothing is copied or parsed per value.
+Unlike pickle, decoding never runs code from the sender.
+
+"""
+
+MAGIC = b"SA"
+VERSION = 1
+HEADER = struct.Struct("<2sBB")
+
+# Every message type in the protocol, in wire code order (code = index + 1). Only ever append to this list!
+MESSAGE_TYPES = [
+    "public_key",
+    "init_base_param",
+    "public_key_broadcast",
+    "perturbations",
+    "value",
+    "aggregation_result",
+    "message",
+    "value_chunk",
+    "shares",
+    "unmask_request",
+    "unmask_shares",
+    "partial_sum",
+]
+_TYPE_CODES = {name: code for (code, name) in enumerate(MESSAGE_TYPES, start=1)}
+
+(_NONE, _FALSE, _TRUE, _INT, _FLOAT, _BYTES, _STR,
+ _LIST, _DICT, _VECTOR, _BIGVEC) = range(11)
+
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_F64 = struct.Struct("<d")
+
+# How many levels of lists and dicts (counting the message's own fields) a message we decode may have.
+# The protocol itself never goes past 3.
+MAX_DEPTH = 8
+
+
+def vector_width(base):
+    """
+    Number of bytes used to pack each value of a vector mod base: the smallest of 1, 2, 4 or 8 that
+    fits ceil(log2(base)) bits, or the exact number of bytes needed if that's more than 8.
+    """
+    if base is None:
+        return 8
+    num_bytes = (max((base - 1).bit_length(), 1) + 7) // 8
+    for width in (1, 2, 4, 8):
+        if num_bytes <= width:
+            return width
+    return num_bytes
+
+
+def encode(message: dict, base=None) -> bytes:
+    """
+    Encode a message dict (which must have a "type" field) as a binary frame. Numpy arrays in the
+    message are packed using the width for base (8 bytes per value if no base is given).
+    """
+    try:
+        code = _TYPE_CODES[message["type"]]
+    except KeyError:
+        raise ValueError(f"Unknown message type: {message.get('type')}")
+
+    parts = [HEADER.pack(MAGIC, VERSION, code)]
+    _encode_value({k: v for (k, v) in message.items() if k != "type"}, parts, base)
+    return b"".join(parts)
+
+
+def decode(raw) -> dict:
+    """
+    Decode a binary frame created by encode back into a message dict. Raises ValueError on malformed input.
+    """
+    view = memoryview(raw)
+    try:
+        code = _decode_header(view)
+        message, offset = _decode_value(view, HEADER.size)
+        if not isinstance(message, dict):
+            raise ValueError("Message fields are not a dict.")
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed message: {e}")
+
+    if offset != len(view):
+        raise ValueError("Trailing bytes after message.")
+    message["type"] = MESSAGE_TYPES[code - 1]
+    return message
+
+
+def message_type(raw) -> str:
+    """
+    The type of a binary frame created by encode, read from its header without decoding the rest.
+    Raises ValueError on malformed input.
+    """
+    try:
+        return MESSAGE_TYPES[_decode_header(memoryview(raw)) - 1]
+    except struct.error as e:
+        raise ValueError(f"Malformed message: {e}")
+
+
+def _decode_header(view):
+    magic, version, code = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Message is not a secure aggregation frame.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire format version: {version}")
+    if not 1 <= code <= len(MESSAGE_TYPES):
+        raise ValueError(f"Unknown message type code: {code}")
+    return code
+
+
+def dict_message_prefix(message_type: str, field: str, count: int) -> bytes:
+    """
+    The start of encode({"type": message_type, field: d}) for a dict d with count entries. Following
+    it with each of d's entries encoded by encode_entry gives the whole message, so a message like that
+    can be put together piece by piece (e.g. in a file, see relay_store.py). The prefix has the same
+    length whatever the count.
+    """
+    try:
+        code = _TYPE_CODES[message_type]
+    except KeyError:
+        raise ValueError(f"Unknown message type: {message_type}")
+    parts = [HEADER.pack(MAGIC, VERSION, code), _U8.pack(_DICT) + _U32.pack(1)]
+    _encode_value(field, parts, None)
+    parts.append(_U8.pack(_DICT) + _U32.pack(count))
+    return b"".join(parts)
+
+
+def encode_entry(key, value, base=None) -> bytes:
+    """
+    One key-value pair of a dict, encoded like encode does inside a message (see dict_message_prefix).
+    """
+    parts = []
+    _encode_value(key, parts, base)
+    _encode_value(value, parts, base)
+    return b"".join(parts)
+
+
+def pack_vector(values, base) -> bytes:
+    """
+    Pack a single vector (e.g. a perturbation before it is encrypted) without a message header.
+    """
+    parts = []
+    _encode_value(values, parts, base)
+    return b"".join(parts)
+
+
+def unpack_vector(raw):
+    """
+    Inverse of pack_vector. Returns a (read-only) numpy array.
+    """
+    try:
+        vector, offset = _decode_value(memoryview(raw), 0)
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed vector: {e}")
+    if not isinstance(vector, np.ndarray) or offset != len(raw):
+        raise ValueError("Data is not a packed vector.")
+    return vector
+
+
+def _encode_value(value, parts, base):
+    if value is None:
+        parts.append(_U8.pack(_NONE))
+    elif isinstance(value, (bool, np.bool_)):
+        parts.append(_U8.pack(_TRUE if value else _FALSE))
+    elif isinstance(value, (int, np.integer)):
+        value = int(value)
+        num_bytes = (value.bit_length() + 8) // 8  # +1 bit for the sign
+        parts.append(_U8.pack(_INT) + _U16.pack(num_bytes))
+        parts.append(value.to_bytes(num_bytes, "little", signed=True))
+    elif isinstance(value, float):
+        parts.append(_U8.pack(_FLOAT) + _F64.pack(value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(_U8.pack(_BYTES) + _U32.pack(len(value)))
+        parts.append(bytes(value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        parts.append(_U8.pack(_STR) + _U32.pack(len(data)))
+        parts.append(data)
+    elif isinstance(value, np.ndarray):
+        _encode_vector(value, parts, base)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_U8.pack(_LIST) + _U32.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts, base)
+    elif isinstance(value, dict):
+        parts.append(_U8.pack(_DICT) + _U32.pack(len(value)))
+        for (k, v) in value.items():
+            _encode_value(k, parts, base)
+            _encode_value(v, parts, base)
+    else:
+        raise TypeError(f"Can't encode value of type {type(value)}")
+
+
+def _encode_vector(vector, parts, base):
+    width = vector_width(base)
+    if base is None and vector.dtype == object:
+        # no base to size the values by, so fall back to the widest value in the vector
+        width = max(vector_width(int(max(vector, default=0)) + 1), 8)
+
+    if width <= 8 and vector.dtype != object:
+        parts.append(_U8.pack(_VECTOR) + _U8.pack(width) + _U32.pack(len(vector)))
+        parts.append(vector.astype(f"<u{width}", copy=False).tobytes())
+    else:
+        parts.append(_U8.pack(_BIGVEC) + _U16.pack(width) + _U32.pack(len(vector)))
+        parts.append(b"".join(int(x).to_bytes(width, "little") for x in vector))
+
+
+def _decode_value(view, offset, depth=0):
+    tag = view[offset]
+    offset += 1
+    if tag in (_LIST, _DICT) and depth >= MAX_DEPTH:
+        raise ValueError(f"Message is nested more than {MAX_DEPTH} levels deep.")
+
+    if tag == _NONE:
+        return None, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _INT:
+        (num_bytes,) = _U16.unpack_from(view, offset)
+        offset += _U16.size
+        data = _checked_slice(view, offset, num_bytes)
+        return int.from_bytes(data, "little", signed=True), offset + num_bytes
+    if tag == _FLOAT:
+        return _F64.unpack_from(view, offset)[0], offset + _F64.size
+    if tag in (_BYTES, _STR):
+        (length,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        data = _checked_slice(view, offset, length)
+        return (bytes(data) if tag == _BYTES else str(data, "utf-8")), offset + length
+    if tag == _LIST:
+        (count,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    if tag == _DICT:
+        (count,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        d = dict()
+        for _ in range(count):
+            k, offset = _decode_value(view, offset, depth + 1)
+            v, offset = _decode_value(view, offset, depth + 1)
+            d[k] = v
+        return d, offset
+    if tag == _VECTOR:
+        (width,) = _U8.unpack_from(view, offset)
+        (count,) = _U32.unpack_from(view, offset + _U8.size)
+        offset += _U8.size + _U32.size
+        if width not in (1, 2, 4, 8):
+            raise ValueError(f"Invalid vector width: {width}")
+        data = _checked_slice(view, offset, width * count)
+        # zero-copy: the array is a view of the received message
+        return np.frombuffer(data, dtype=f"<u{width}"), offset + width * count
+    if tag == _BIGVEC:
+        (width,) = _U16.unpack_from(view, offset)
+        (count,) = _U32.unpack_from(view, offset + _U16.size)
+        offset += _U16.size + _U32.size
+        data = _checked_slice(view, offset, width * count)
+        vector = np.array([int.from_bytes(data[i*width:(i+1)*width], "little")
+                           for i in range(count)], dtype=object)
+        return vector, offset + width * count
+
+    raise ValueError(f"Unknown value tag: {tag}")
+
+
+def _checked_slice(view, offset, length):
+    if offset + length > len(view):
+        raise ValueError("Message is truncated.")
+    return view[offset:offset + length]
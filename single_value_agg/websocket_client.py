@@ -5,11 +5,16 @@ import json
 import websockets
 import argparse
 import random
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
-from Crypto.Cipher import AES, PKCS1_OAEP
 import pickle
 import threading
+import os
+
+# the key cache, key manager and crypto suites live with the vector client
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'client_server_system'))
+from key_cache import default_key_cache
+from key_manager import KeyStore, default_key_pool
+from crypto_engine import CRYPTO_SUITES, DEFAULT_CRYPTO_SUITE, generate_x25519_keypair, suite_encrypt, suite_decrypt
 
 
 """
@@ -27,13 +32,17 @@ to read the data being sent, but we don't have to worry about it tampering with
 
 
 class SecureAggClient:
-    def __init__(self, value, connection):
+    def __init__(self, value, connection, key_cache=None, keys=None):
         self.base = None
+        self.crypto_suite = DEFAULT_CRYPTO_SUITE
+        self.key_cache = key_cache if key_cache is not None else default_key_cache
+        # the keys we share with each peer under an X25519 suite, kept only as long as this client (see crypto_engine.py)
+        self.pairwise_keys = {}
 
-        self.rsa_keys = RSA.generate(2048)
-        self.priv_key = self.rsa_keys.export_key()
-        self.pub_key = self.rsa_keys.publickey().export_key()
+        # a fresh keypair per session unless we're given one, from the shared pool (generated on the spot if it's empty)
+        self.pub_key, self.priv_key = keys if keys is not None else default_key_pool.take()
 
+        self.public_keys = {}
         self.peer_perturbations = {}
         self.perturbation_messages = {}
         self.connection = connection
@@ -43,8 +52,18 @@ class SecureAggClient:
     def set_base(self, base: int):
         self.base = base
 
+    def set_crypto_suite(self, crypto_suite: str):
+        # see crypto_engine.py, raises ValueError for suites we don't support
+        if crypto_suite not in CRYPTO_SUITES:
+            raise ValueError(f"Unsupported crypto suite: {crypto_suite}")
+        if crypto_suite != self.crypto_suite and crypto_suite != "rsa-oaep-eax":
+            self.pub_key, self.priv_key = generate_x25519_keypair()
+            self.pairwise_keys = {}
+        self.crypto_suite = crypto_suite
+
     def create_perturbation_messages(self, public_key_dict):
         assert self.base is not None, "Base must be set before creating perturbations."
+        self.public_keys = public_key_dict
 
         for peer, peer_pub_key_str in public_key_dict.items():
             if peer == self.id:
@@ -58,24 +77,11 @@ class SecureAggClient:
             # the value to send to the server
             self.peer_perturbations[peer] = peer_perturb_val
 
-            # Use an AES session key so that we can encrypt arbitrarily large data.
-            # If we only used RSA, we'd be limited to the size of the key.
-            session_key = get_random_bytes(16)
-
-            # Encrypt the session key with the peer's public RSA key.
-            # Note that we're sending public keys as strings generated by the export_key
-            # method, so we need to convert them back to RSA objects.
-            peer_pub_key = RSA.import_key(peer_pub_key_str)
-            cipher_rsa = PKCS1_OAEP.new(peer_pub_key)
-            enc_session_key = cipher_rsa.encrypt(session_key)
-
-            # Encrypt the data with the AES session key
-            cipher_aes = AES.new(session_key, AES.MODE_EAX)
-            ciphertext, tag = cipher_aes.encrypt_and_digest(data)
-
-            # Store the message that will be sent to the peer
-            self.perturbation_messages[peer] = (
-                enc_session_key, cipher_aes.nonce, tag, ciphertext)
+            # Encrypt it for the peer with the session's crypto suite (hybrid RSA-OAEP + AES-EAX by default,
+            # which lets us encrypt data of any size, see crypto_engine.py) and store the message that will
+            # be sent to the peer
+            self.perturbation_messages[peer] = suite_encrypt(
+                self.crypto_suite, self.priv_key, peer_pub_key_str, data, self.key_cache, self.pairwise_keys)
 
     async def send_perturbations(self):
         await self.connection.send(pickle.dumps({"type": "perturbations", "perturbations": self.perturbation_messages}))
@@ -86,14 +92,9 @@ class SecureAggClient:
             if peer == self.id:
                 continue
             else:
-                # Decrypt the peer's message
-                enc_session_key, nonce, tag, ciphertext = peer_perturb_message
-                # First, decrypt the session key with the private RSA key
-                cipher_rsa = PKCS1_OAEP.new(self.rsa_keys)
-                session_key = cipher_rsa.decrypt(enc_session_key)
-                # Then, decrypt the data with the AES session key
-                cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
-                raw_data = cipher_aes.decrypt_and_verify(ciphertext, tag)
+                # Decrypt the peer's message (the X25519 suites need the peer's public key for that)
+                raw_data = suite_decrypt(self.crypto_suite, self.priv_key, self.public_keys.get(peer),
+                                         peer_perturb_message, self.key_cache, self.pairwise_keys)
                 try:
                     received_perturb_val = int(raw_data.decode("utf-8"))
                 except ValueError:
@@ -112,14 +113,12 @@ class SecureAggClient:
         await self.connection.send(message)
 
 
-async def main(value, host, port):
+async def main(value, host, port, keys=None):
 
     async with websockets.connect(f"ws://{host}:{port}") as websocket:
-        client = SecureAggClient(value, websocket)
+        client = SecureAggClient(value, websocket, keys=keys)
         print(f"I am Client [{client.id}]. Successfully connected to server.")
 
-        await websocket.send(pickle.dumps({"type": "public_key", "public_key": client.pub_key}))
-
         async for m_raw in websocket:
             try:
                 m = pickle.loads(m_raw)
@@ -137,6 +136,14 @@ async def main(value, host, port):
             elif message_type == 'init_base_param':
                 print(f"Received base parameter from server: {m['base']}")
                 client.set_base(m['base'])
+                try:
+                    # Older servers don't send a crypto suite, in which case we use the original one
+                    client.set_crypto_suite(m.get('crypto_suite', DEFAULT_CRYPTO_SUITE))
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    return None
+                # Now that we know which kind of key the server wants, publish it
+                await websocket.send(pickle.dumps({"type": "public_key", "public_key": client.pub_key}))
 
             elif message_type == 'perturbations':
                 to_send = client.compute_value(m["perturbations"])
@@ -144,6 +151,8 @@ async def main(value, host, port):
 
             elif message_type == 'aggregation_result':
                 print(f"Final aggregation result 😎: {m['aggregation_result']}")
+                print(f"Key cache stats: {client.key_cache.stats()}")
+                client.pairwise_keys.clear()
                 return m['aggregation_result']
 
             elif message_type == 'message':
@@ -163,6 +172,12 @@ if __name__ == "__main__":
                         help="Hostname", type=int)
     parser.add_argument("-p", "--port",
                         help="Port", type=int)
+    parser.add_argument("--key_store",
+                        help="Directory of per-identity RSA keypairs to use instead of a fresh one (needs --identity)", type=str)
+    parser.add_argument("--identity",
+                        help="Name this client's keypair is stored under in the key store", type=str)
+    parser.add_argument("--max_key_uses",
+                        help="Rotate the stored keypair after it has been used for this many rounds", type=int)
     args = parser.parse_args()
 
     if len(sys.argv) < 1:
@@ -175,4 +190,11 @@ if __name__ == "__main__":
     if not args.port:
         args.port = 8001
 
-    asyncio.run(main(args.value, args.host, args.port))
+    keys = None
+    if args.key_store:
+        if not args.identity:
+            print("Error: --key_store needs an --identity")
+            exit(1)
+        keys = KeyStore(args.key_store, max_uses=args.max_key_uses).get(args.identity)
+
+    asyncio.run(main(args.value, args.host, args.port, keys))
@@ -5,6 +5,12 @@ import json
 import sys
 import pickle
 import copy
+import os
+
+# the crypto suites live with the vector client
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'client_server_system'))
+from crypto_engine import CRYPTO_SUITES, DEFAULT_CRYPTO_SUITE
 
 """
 Run this with parameter n for how many clients to accept before running the aggregation.
@@ -26,13 +32,15 @@ Then, each client sends their masked value to the server using all the perturbat
 
 
 class SecureAggServer:
-    def __init__(self, client_threshold, base):
+    def __init__(self, client_threshold, base, crypto_suite=DEFAULT_CRYPTO_SUITE):
         # wait for this many clients to connect before running protocol
         self.client_threshold = client_threshold
         self.connections = dict()  # maps hostname:port -> websocket connection
         self.pub_keys = dict()  # maps hostname:port -> public key
 
         self.base = base
+        # how clients encrypt perturbations for each other (see crypto_engine.py)
+        self.crypto_suite = crypto_suite
 
         # nested dict: to_receive -> {perturbation_creator -> perturbation}
         self.perturbations = dict()
@@ -54,7 +62,7 @@ class SecureAggServer:
         self.connections[user_id] = websocket
 
         # Send the client the base for this session
-        await websocket.send(pickle.dumps({"type": "init_base_param", "base": self.base}))
+        await websocket.send(pickle.dumps({"type": "init_base_param", "base": self.base, "crypto_suite": self.crypto_suite}))
 
         # This big try block handles the client when it's connected, and the finally block
         # removes it from the connections dict when it disconnects.
@@ -144,8 +152,8 @@ class SecureAggServer:
         self.received_value_count = 0
 
 
-async def main(client_threshold, base, host, port):
-    server = SecureAggServer(client_threshold, base)
+async def main(client_threshold, base, host, port, crypto_suite=DEFAULT_CRYPTO_SUITE):
+    server = SecureAggServer(client_threshold, base, crypto_suite)
     async with websockets.serve(server.handler, host, port):
         await asyncio.Future()  # run forever
 
@@ -160,6 +168,9 @@ if __name__ == "__main__":
                         help="Hostname", type=str)
     parser.add_argument("-p", "--port",
                         help="Port", type=int)
+    parser.add_argument("-e", "--crypto_suite",
+                        help="How clients encrypt perturbations for each other (default: rsa-oaep-eax)",
+                        type=str, choices=CRYPTO_SUITES, default=DEFAULT_CRYPTO_SUITE)
 
     args = parser.parse_args()
 
@@ -175,4 +186,4 @@ if __name__ == "__main__":
 
     print(
         f"Running server on {args.host}:{args.port} with client_threshold = {args.num_clients} ")
-    asyncio.run(main(args.num_clients, args.base, args.host, args.port))
+    asyncio.run(main(args.num_clients, args.base, args.host, args.port, args.crypto_suite))